@@ -0,0 +1,179 @@
+"""
+Admission control for provisioning requests.
+
+Two checks run before work is queued:
+
+* rate: Redis token buckets per caller and per provision_identity prefix, so
+  one runaway integration cannot starve other tenants;
+* backlog: the identities queued or being issued divided by the measured
+  issuance throughput estimates how long a new identity would wait. Requests
+  that would push that past ADMISSION_LATENCY_BUDGET are refused with a
+  Retry-After telling the caller when the backlog will have drained enough.
+
+Both sides count identities, not broker messages: a batch chunk is one
+message carrying many identities. The backlog is a sorted set of the queued
+identities scored by a deadline PROVISION_INFLIGHT_TTL ahead; an identity
+leaves it when issued, and one lost with a killed worker or a revoked task
+drops out once its deadline passes. Throughput counts every issued identity,
+whether it ran as a task, inside a batch chunk or inline from the key pool.
+"""
+import math
+import time
+import redis
+from config import Config
+
+THROUGHPUT_BUCKET_SECONDS = 10
+THROUGHPUT_WINDOW_BUCKETS = 6
+THROUGHPUT_KEY = "admission:completed:{}"
+BUCKET_KEY = "admission:bucket:{}"
+PENDING_KEY = "admission:pending"  # sorted set: provision_identity -> deadline
+
+# Refill and charge several token buckets atomically; tokens are only taken if
+# every bucket can pay. ARGV: now, then (rate, capacity, cost) per key.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    local cost = math.min(tonumber(ARGV[i * 3 + 1]), capacity)
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - math.min(tonumber(ARGV[i * 3 + 1]), capacity)
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+
+broker = redis.Redis.from_url(Config.CELERY_BROKER_URL, decode_responses=True)
+_token_bucket = broker.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+class AdmissionDenied(Exception):
+    """Raised when a request is refused; carries the HTTP status and Retry-After seconds."""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def caller_id(request):
+    """Identify the caller of a request for rate limiting."""
+    return request.headers.get('X-Caller-Id') or request.remote_addr or 'unknown'
+
+
+def check_rate(caller, provision_identities):
+    """Charge the caller's and each identity prefix's token bucket, or raise AdmissionDenied (429).
+
+    A request larger than a bucket's burst is charged the full burst, so big
+    batches are admitted but leave the bucket empty.
+    """
+    prefixes = {}
+    for provision_identity in provision_identities:
+        prefix = provision_identity[:Config.ADMISSION_PREFIX_LENGTH]
+        prefixes[prefix] = prefixes.get(prefix, 0) + 1
+
+    keys = [BUCKET_KEY.format(f"caller:{caller}")]
+    args = [time.time(), Config.ADMISSION_CALLER_RATE, Config.ADMISSION_CALLER_BURST, len(provision_identities)]
+    for prefix, count in prefixes.items():
+        keys.append(BUCKET_KEY.format(f"prefix:{prefix}"))
+        args.extend([Config.ADMISSION_PREFIX_RATE, Config.ADMISSION_PREFIX_BURST, count])
+
+    wait = float(_token_bucket(keys=keys, args=args))
+    if wait > 0:
+        raise AdmissionDenied("Provisioning rate limit exceeded", 429, wait)
+
+
+def queue_depth():
+    """Number of identities queued or being issued."""
+    pipe = broker.pipeline()
+    pipe.zremrangebyscore(PENDING_KEY, '-inf', time.time())
+    pipe.zcard(PENDING_KEY)
+    return pipe.execute()[1]
+
+
+def add_pending(*provision_identities):
+    """Put identities on the backlog. Call before publishing, so a fast worker never completes first."""
+    if provision_identities:
+        deadline = time.time() + Config.PROVISION_INFLIGHT_TTL
+        pipe = broker.pipeline(transaction=False)
+        pipe.zadd(PENDING_KEY, {provision_identity: deadline for provision_identity in provision_identities})
+        pipe.expire(PENDING_KEY, Config.PROVISION_INFLIGHT_TTL)
+        pipe.execute()
+
+
+def release_pending(*provision_identities):
+    """Take identities off the backlog, e.g. when publishing them failed."""
+    if provision_identities:
+        broker.zrem(PENDING_KEY, *provision_identities)
+
+
+def throughput():
+    """Identities issued per second over the last minute, or None if unmeasured."""
+    current = int(time.time() // THROUGHPUT_BUCKET_SECONDS)
+    keys = [THROUGHPUT_KEY.format(current - i) for i in range(1, THROUGHPUT_WINDOW_BUCKETS + 1)]
+    counts = [int(count) for count in broker.mget(keys) if count]
+    if not counts:
+        return None
+    return sum(counts) / (THROUGHPUT_BUCKET_SECONDS * THROUGHPUT_WINDOW_BUCKETS)
+
+
+def record_completion(provision_identity=None):
+    """Count one issued identity towards the measured throughput.
+    provision_identity: the identity put on the backlog by add_pending, which it now leaves
+    (None for inline provisioning, which never queued)
+    """
+    key = THROUGHPUT_KEY.format(int(time.time() // THROUGHPUT_BUCKET_SECONDS))
+    pipe = broker.pipeline(transaction=False)
+    pipe.incr(key)
+    pipe.expire(key, THROUGHPUT_BUCKET_SECONDS * (THROUGHPUT_WINDOW_BUCKETS + 2))
+    if provision_identity is not None:
+        pipe.zrem(PENDING_KEY, provision_identity)
+    pipe.execute()
+
+
+def check_backlog(cost=1):
+    """Refuse new work (503) if it would wait longer than the latency budget. cost: identities to add."""
+    depth = queue_depth() + cost
+    if depth <= Config.ADMISSION_MIN_QUEUE_DEPTH:
+        # A short queue says nothing about capacity: completions then only reflect demand
+        return
+
+    rate = throughput()
+    if rate is None:
+        # No completions measured yet: fall back to a plain depth limit
+        if depth > Config.ADMISSION_MAX_QUEUE_DEPTH:
+            raise AdmissionDenied("Provisioning backlog is full", 503, Config.ADMISSION_LATENCY_BUDGET)
+        return
+
+    allowed_depth = rate * Config.ADMISSION_LATENCY_BUDGET
+    if depth > allowed_depth:
+        raise AdmissionDenied("Provisioning backlog exceeds latency budget", 503, (depth - allowed_depth) / rate)
+
+
+def status():
+    """Current queue depth, throughput and estimated wait, for monitoring."""
+    depth = queue_depth()
+    rate = throughput()
+    return {
+        "queue_depth": depth,
+        "throughput_per_second": rate,
+        "estimated_wait_seconds": round(depth / rate, 1) if rate else None,
+        "latency_budget_seconds": Config.ADMISSION_LATENCY_BUDGET,
+    }
@@ -5,131 +5,320 @@ It wil be used by the main site (myisp.com) to generate new vpn clients for mikr
  and listen for a successful connection as well as sending mikrotik commands to perform specif jobs.
 It will also be accessed with Mikrotik to fetch these certs and install them on behalf of the user
 """
-import os
-from flask import Flask, jsonify, send_file, send_from_directory,request
-import openvpn_api
-from celery.result import AsyncResult
+from celery import states
+from celery.utils import uuid
+from flask import Flask, jsonify, request, Response, stream_with_context
 from config import Config
 from security import validate_provision_identity, generate_secret, require_secret
-from tasks import generate_certificate,celery
+from tasks import generate_certificate,celery,dispatch_batch,get_batch_status,issue_client,record_provisioning_throughput
+import keypool
+import inflight
+import servers
+from helper import client_exists, openvpn_config_response, client_header, read_cached
+from hotspot import hotspot_assets, asset_response
+from admission import (AdmissionDenied, caller_id, check_rate, check_backlog, add_pending, release_pending,
+                       status as admission_status)
+from status_log import status_log
+from management import lookup_client
+from task_status import read_task_meta, read_task_metas, wait_for_task, iter_task_states, task_status_payload
+from metrics import instrument_app, metrics_response
+from health import readiness
 from werkzeug.urls import url_quote
-import redis
 import json
 from main import admin_routs
 
 app = Flask(__name__)
 app.config.from_object(Config)
+instrument_app(app)
+
+# No connection to the OpenVPN management interface is made here: the
+# management monitor (management.py) holds the one shared connection and
+# publishes the client table to Redis, so importing the app never blocks.
+
+
+def warm_up():
+    """Load shared read-only state once, before gunicorn forks its workers (--preload).
+
+    Every step is optional: whatever fails here is loaded lazily on first use.
+    """
+    from pki import get_backend
+
+    steps = []
+    for server in servers.all_servers():
+        steps.append((f"CA certificate of {server.name}",
+                      lambda server=server: read_cached(f"{server.pki_dir}/ca.crt")))
+        steps.append((f"client config header of {server.name}", lambda server=server: client_header(server)))
+        if Config.PKI_BACKEND == "cryptography":
+            steps.append((f"CA signing key of {server.name}",
+                          lambda server=server: get_backend(server.pki_dir)._load_ca()))
+    steps.append(("hotspot assets", lambda: [hotspot_assets.get(Config.HOTSPOT_TEMPLATE_DIR, form)
+                                             for form in ("login.html", "rlogin.html")]))
+    steps.append(("templates", lambda: [app.jinja_env.get_template(name) for name in app.jinja_env.list_templates()]))
+
+    for name, load in steps:
+        try:
+            load()
+        except Exception as e:
+            print(f"Warm-up: {name} not loaded: {str(e)}")
+
+
+def admission_denied_response(error):
+    """429/503 response for a refused provisioning request."""
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, error.status_code
+
+
+def provisioning_response(payload, status_code, idempotency=None):
+    """Respond with the secret added, storing the response for Idempotency-Key replay."""
+    if idempotency is not None:
+        # The secret is derived from the identity, so it is never stored
+        inflight.remember(*idempotency, payload, status_code)
+    payload = dict(payload, secret=generate_secret(payload["provision_identity"]))
+    return jsonify(payload), status_code
+
+
+def in_flight_response(provision_identity, work, idempotency=None):
+    """202 pointing a retry at the task (or batch) already provisioning this identity."""
+    return provisioning_response(dict({
+        "status": "processing",
+        "provision_identity": provision_identity,
+        "duplicate": True
+    }, **work), 202, idempotency)
 
-# Initialize OpenVPN API
-try:
-    print(f"Attempting to connect to OpenVPN management at {Config.VPN_HOST}:{Config.VPN_PORT}")
-    v = openvpn_api.VPN(Config.VPN_HOST, Config.VPN_PORT)
-    # Test connection
-    status = v.get_status()
-    print(f"Successfully connected to OpenVPN management at {Config.VPN_HOST}:{Config.VPN_PORT}")
-    print(f"OpenVPN server version: {status.version}")
-    print(f"Connected clients: {len(status.client_list) if hasattr(status, 'client_list') else 0}")
-except Exception as e:
-    print(f"WARNING: Failed to connect to OpenVPN management interface: {str(e)}")
-    print(f"Using host: {Config.VPN_HOST}, port: {Config.VPN_PORT}")
-    print(f"Exception type: {type(e).__name__}")
-    v = None  # Set to None so we can check later
 
 @app.route('/mikrotik/openvpn/create_provision/<provision_identity>', methods=["POST"])
 def mtk_create_new_provision(provision_identity):
     """Create a new openVPN client with given name.
     provision_identity: its just like name instance  (e.g client1,client2,...)
+    A retry while the identity is still being provisioned, or with the same
+    Idempotency-Key header, returns the original task id instead of new work.
     """
-    # with REQUEST_LATENCY.labels(endpoint='/create_provision').time():
+    claimed = False
     try:
+        idempotency = None
+        if request.headers.get('Idempotency-Key'):
+            idempotency = (caller_id(request), request.headers['Idempotency-Key'])
+            replayed = inflight.replay(*idempotency)
+            if replayed is not None:
+                payload, status_code = replayed
+                if payload.get("provision_identity") != provision_identity:
+                    return jsonify({"error": "Idempotency-Key was used for another provision identity"}), 422
+                return provisioning_response(payload, status_code)
+
+        work = inflight.current(provision_identity)
+        if work is not None:
+            return in_flight_response(provision_identity, work, idempotency)
+
         # Check if client already exists
-        client_conf_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
-        if os.path.exists(client_conf_path):
-            # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='400').inc()
+        if client_exists(provision_identity):
             return jsonify({"error": "Client already exists"}), 400
 
-        # Start async certificate generation
-        task = generate_certificate.delay(provision_identity)
+        if Config.ADMISSION_ENABLED:
+            check_rate(caller_id(request), [provision_identity])
 
-        # Generate and return the secret
-        secret = generate_secret(provision_identity)
+        task_id = uuid()
+        work = inflight.claim(provision_identity, task_id=task_id)
+        if work is not None:
+            return in_flight_response(provision_identity, work, idempotency)
+        claimed = True
+        # A task finishing between the checks above releases its claim only after the client exists
+        if client_exists(provision_identity):
+            return jsonify({"error": "Client already exists"}), 400
 
-        # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='202').inc()
-        return jsonify({
+        # With a pre-generated key only signing remains, so finish in this request
+        if Config.KEY_POOL_INLINE_PROVISION:
+            result = issue_client(provision_identity, pooled_only=True)
+            if result is not None:
+                record_provisioning_throughput()
+                # Retries that got this task id while it ran can poll the outcome
+                celery.backend.store_result(task_id, result, states.SUCCESS)
+                if result['status'] != 'success':
+                    return jsonify({
+                        "status": "error",
+                        "message": result['message'],
+                        "provision_identity": provision_identity,
+                        "state": "failed"
+                    }), 400
+                return provisioning_response({
+                    "status": "success",
+                    "task_id": task_id,
+                    "provision_identity": provision_identity,
+                    "state": "completed"
+                }, 201, idempotency)
+
+        if Config.ADMISSION_ENABLED:
+            check_backlog()
+
+        # Start async certificate generation; the task releases the claim when done
+        add_pending(provision_identity)
+        try:
+            generate_certificate.apply_async((provision_identity,), task_id=task_id)
+        except Exception:
+            release_pending(provision_identity)
+            raise
+        claimed = False
+
+        return provisioning_response({
             "status": "processing",
-            "task_id": task.id,
-            "provision_identity": provision_identity,
-            "secret": secret
-        }), 202
+            "task_id": task_id,
+            "provision_identity": provision_identity
+        }, 202, idempotency)
 
+    except AdmissionDenied as e:
+        return admission_denied_response(e)
     except ValueError as e:
-        # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='400').inc()
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='500').inc()
         return jsonify({"error": "Internal server error"}), 500
+    finally:
+        if claimed:
+            inflight.release(provision_identity)
+
+
+@app.route('/mikrotik/openvpn/provision/batch', methods=["POST"])
+def mtk_create_provision_batch():
+    """Create many openVPN clients in one call.
+    Body: {"provision_identities": ["client1", "client2", ...]}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        identities = data.get("provision_identities")
+        if not isinstance(identities, list) or not identities:
+            return jsonify({"error": "provision_identities must be a non-empty list"}), 400
+        if len(identities) > Config.PROVISION_BATCH_MAX_SIZE:
+            return jsonify({"error": f"At most {Config.PROVISION_BATCH_MAX_SIZE} identities per batch"}), 400
+
+        accepted = []
+        rejected = []
+        for provision_identity in dict.fromkeys(identities):
+            if not isinstance(provision_identity, str) or not provision_identity.isalnum():
+                rejected.append({"provision_identity": provision_identity, "error": "Invalid client name"})
+                continue
+            try:
+                validate_provision_identity(provision_identity)
+            except ValueError as e:
+                rejected.append({"provision_identity": provision_identity, "error": str(e)})
+                continue
+            if client_exists(provision_identity):
+                rejected.append({"provision_identity": provision_identity, "error": "Client already exists"})
+                continue
+            accepted.append(provision_identity)
+
+        if not accepted:
+            return jsonify({"error": "No valid identities to provision", "rejected": rejected}), 400
+
+        if Config.ADMISSION_ENABLED:
+            check_rate(caller_id(request), accepted)
+            check_backlog(len(accepted))
+
+        # Identities already being provisioned keep their original task
+        batch_id = uuid()
+        in_flight = inflight.claim_many(accepted, batch_id)
+        for provision_identity, work in in_flight.items():
+            rejected.append(dict({"provision_identity": provision_identity,
+                                  "error": "Provisioning already in progress"}, **work))
+        claimed = [identity for identity in accepted if identity not in in_flight]
+        if not claimed:
+            return jsonify({"error": "No valid identities to provision", "rejected": rejected}), 409
+        try:
+            dispatch_batch(claimed, batch_id)
+        except Exception:
+            inflight.release(*claimed)
+            raise
+        accepted = claimed
+
+        return jsonify({
+            "status": "processing",
+            "batch_id": batch_id,
+            "count": len(accepted),
+            "provisions": [
+                {"provision_identity": identity, "secret": generate_secret(identity)}
+                for identity in accepted
+            ],
+            "rejected": rejected
+        }), 202
+
+    except AdmissionDenied as e:
+        return admission_denied_response(e)
+    except Exception as e:
+        print(f"Error creating provision batch: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/mikrotik/openvpn/provision/batch/<batch_id>')
+def get_batch_task_status(batch_id):
+    """Get per-identity progress of a provisioning batch."""
+    try:
+        status = get_batch_status(batch_id)
+        if status is None:
+            return jsonify({"error": "Batch not found"}), 404
+        return jsonify(status), 200 if status["state"] == "completed" else 202
+    except Exception as e:
+        print(f"Error getting batch status: {str(e)}")
+        return jsonify({"error": f"Error getting batch status: {str(e)}"}), 500
+
+
+@app.route('/mikrotik/openvpn/admission')
+def get_admission_status():
+    """Get provisioning queue depth, measured throughput and estimated wait."""
+    try:
+        return jsonify(admission_status()), 200
+    except Exception as e:
+        return jsonify({"error": f"Error reading admission status: {str(e)}"}), 500
+
+
+@app.route('/mikrotik/openvpn/pool')
+def get_key_pool_status():
+    """Get depth and refill statistics of the pre-generated key pool."""
+    try:
+        return jsonify(keypool.status()), 200
+    except Exception as e:
+        return jsonify({"error": f"Error reading key pool: {str(e)}"}), 500
+
+
+@app.route('/mikrotik/openvpn/servers')
+def get_server_status():
+    """Get capacity and current load of every VPN server clients are placed on."""
+    try:
+        return jsonify({"placement": Config.VPN_PLACEMENT, "servers": servers.status()}), 200
+    except Exception as e:
+        return jsonify({"error": f"Error reading server status: {str(e)}"}), 500
+
+
+@app.route('/health')
+def get_health():
+    """Liveness: the process is up and serving requests."""
+    return jsonify({"status": "ok"}), 200
+
+
+@app.route('/health/ready')
+def get_readiness():
+    """Readiness: Redis, PKI, management monitor and status file, each check time-bounded."""
+    payload, status_code = readiness()
+    return jsonify(payload), status_code
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus metrics of all workers."""
+    return metrics_response()
 
 
 @app.route('/mikrotik/openvpn/task/<task_id>')
 def get_task_status(task_id):
-    """Get the status of a certificate generation task."""
+    """Get the status of a certificate generation task.
+    wait: optional seconds to hold the request until the task finishes (long-poll)
+    """
     try:
-        task_result = AsyncResult(task_id, app=celery)
-        
-        # Force result retrieval
-        if task_result.ready():
-            result = task_result.get()
-            if result['status'] == 'success':
-                return jsonify({
-                    "status": "success",
-                    "message": "Certificate generated successfully",
-                    "provision_identity": result.get('provision_identity'),
-                    "task_id": task_id,
-                    "state": "completed"
-                }), 200
-            else:
-                return jsonify({
-                    "status": "error",
-                    "message": result.get('message', 'Unknown error'),
-                    "provision_identity": result.get('provision_identity'),
-                    "task_id": task_id,
-                    "state": "failed"
-                }), 400
+        wait = min(request.args.get('wait', 0, type=float), Config.TASK_LONG_POLL_MAX_WAIT)
+        if wait > 0:
+            meta = wait_for_task(task_id, wait)
         else:
-            # If not ready, check Redis directly
-            r = redis.Redis(
-                host=Config.REDIS_HOST,
-                port=Config.REDIS_PORT,
-                db=Config.REDIS_DB,
-                password=Config.REDIS_PASSWORD,
-                decode_responses=True
-            )
-            redis_key = f"celery-task-meta-{task_id}"
-            if r.exists(redis_key):
-                result = r.get(redis_key)
-                result_data = json.loads(result)
-                if result_data['status'] == 'SUCCESS':
-                    return jsonify({
-                        "status": "success",
-                        "message": "Certificate generated successfully",
-                        "provision_identity": result_data['result']['provision_identity'],
-                        "task_id": task_id,
-                        "state": "completed"
-                    }), 200
-                else:
-                    return jsonify({
-                        "status": "error",
-                        "message": result_data.get('result', {}).get('message', 'Unknown error'),
-                        "task_id": task_id,
-                        "state": "failed"
-                    }), 400
-            
-            return jsonify({
-                "status": "pending",
-                "message": "Certificate generation in progress",
-                "task_id": task_id,
-                "state": task_result.state
-            }), 202
+            meta = read_task_meta(task_id)
+
+        payload, status_code = task_status_payload(task_id, meta)
+        return jsonify(payload), status_code
     except Exception as e:
         print(f"Error getting task status: {str(e)}")
         return jsonify({
@@ -139,15 +328,64 @@ def get_task_status(task_id):
         }), 500
 
 
+@app.route('/mikrotik/openvpn/tasks/status', methods=["POST"])
+def get_task_statuses():
+    """Get the status of many certificate generation tasks in one call.
+    Body: {"task_ids": ["...", ...]}; each task is reported as by get_task_status
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        task_ids = data.get("task_ids")
+        if not isinstance(task_ids, list) or not task_ids or not all(isinstance(i, str) for i in task_ids):
+            return jsonify({"error": "task_ids must be a non-empty list of strings"}), 400
+        if len(task_ids) > Config.TASK_STATUS_BATCH_MAX:
+            return jsonify({"error": f"At most {Config.TASK_STATUS_BATCH_MAX} task ids per request"}), 400
+
+        tasks = {}
+        counts = {}
+        for task_id, meta in read_task_metas(task_ids).items():
+            payload, _ = task_status_payload(task_id, meta)
+            tasks[task_id] = payload
+            counts[payload["state"]] = counts.get(payload["state"], 0) + 1
+        return jsonify({"tasks": tasks, "counts": counts}), 200
+    except Exception as e:
+        print(f"Error getting task statuses: {str(e)}")
+        return jsonify({"error": f"Error getting task statuses: {str(e)}"}), 500
+
+
+@app.route('/mikrotik/openvpn/task/<task_id>/events')
+def stream_task_status(task_id):
+    """Server-Sent Events stream of a task's state transitions, closed once it finishes."""
+    timeout = min(request.args.get('timeout', Config.TASK_STREAM_MAX_SECONDS, type=float),
+                  Config.TASK_STREAM_MAX_SECONDS)
+
+    def generate():
+        try:
+            for meta in iter_task_states(task_id, timeout, heartbeat=Config.TASK_STREAM_HEARTBEAT):
+                if meta is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                payload, _ = task_status_payload(task_id, meta)
+                yield f"event: {payload['state']}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            print(f"Error streaming task status: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'status': 'error', 'task_id': task_id})}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
 @app.route("/mikrotik/openvpn/key")
 @require_secret
 def mtk_openvpn(provision_identity,secret):
     """Returning openVPN client of a given provision_identity"""
     try:
-        path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
-        if not os.path.exists(path):
+        response = openvpn_config_response(provision_identity)
+        if response is None:
             return jsonify({"error": "Configuration not found"}), 404
-        return send_file(path, as_attachment=True)
+        return response
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
 
@@ -155,105 +393,18 @@ def mtk_openvpn(provision_identity,secret):
 @app.route("/server/ip/")
 @require_secret
 def getIpAddress(provision_identity, secret):
-    """Get client IP from OpenVPN status log file"""
+    """Get client IP from the live management table, or the indexed status log"""
     try:
-        print(f"Getting IP for provision_identity: {provision_identity}")
-        
-        # Path to the OpenVPN status log file
-        status_file = "/var/log/openvpn/openvpn-status.log"
-        
-        if not os.path.exists(status_file):
-            print(f"OpenVPN status file not found at {status_file}")
-            return jsonify({"error": "OpenVPN status file not found"}), 404
-            
-        # Read and parse the status file
-        with open(status_file, 'r') as f:
-            content = f.read()
-            
-        print("\nOpenVPN Status Log Content:")
-        print("-" * 50)
-        print(content)
-        print("-" * 50)
-        
-        # Re-read for actual parsing
-        with open(status_file, 'r') as f:
-            lines = f.readlines()
-        
-        # Find both CLIENT_LIST and ROUTING_TABLE sections
-        client_list_section = False
-        routing_table_section = False
-        headers = {}
-        
-        for line in lines:
-            line = line.strip()
-            
-            # Detect section headers
-            if line.startswith("HEADER,CLIENT_LIST,"):
-                client_headers = line.split(',')[2:]  # Skip "HEADER" and "CLIENT_LIST"
-                headers["CLIENT_LIST"] = client_headers
-                client_list_section = True
-                routing_table_section = False
-                continue
-                
-            if line.startswith("HEADER,ROUTING_TABLE,"):
-                routing_headers = line.split(',')[2:]  # Skip "HEADER" and "ROUTING_TABLE"
-                headers["ROUTING_TABLE"] = routing_headers
-                routing_table_section = True
-                client_list_section = False
-                continue
-                
-            # Process CLIENT_LIST entries
-            if line.startswith("CLIENT_LIST,"):
-                parts = line.split(',')
-                if len(parts) > 1:
-                    common_name = parts[1]
-                    real_address = parts[2].split(':')[0] if len(parts) > 2 else None
-                    virtual_address = parts[3] if len(parts) > 3 else None
-                    
-                    print(f"Client entry - Common Name: '{common_name}', Real Address: '{real_address}', Virtual: '{virtual_address}'")
-                    
-                    # Try to match by common name
-                    if common_name == provision_identity:
-                        ip = virtual_address if virtual_address and virtual_address.strip() else real_address
-                        print(f"Found client match by common name: {provision_identity}, IP: {ip}")
-                        return jsonify({"ip": ip}), 200
-                        
-            # Process ROUTING_TABLE entries
-            if line.startswith("ROUTING_TABLE,"):
-                parts = line.split(',')
-                if len(parts) > 2:
-                    virtual_address = parts[1]
-                    common_name = parts[2]
-                    
-                    print(f"Routing entry - Virtual Address: '{virtual_address}', Common Name: '{common_name}'")
-                    
-                    # Try to match by common name
-                    if common_name == provision_identity:
-                        print(f"Found routing match by common name: {provision_identity}, IP: {virtual_address}")
-                        return jsonify({"ip": virtual_address}), 200
-        
-        # If client is not found in the standard entries, let's check if there's any connection with a matching IP
-        # This is a fallback for non-standard configurations
-        for line in lines:
-            line = line.strip()
-            parts = line.split(',')
-            
-            # Look for any line that contains the provision identity
-            if provision_identity in line:
-                print(f"Found line containing '{provision_identity}': {line}")
-                
-                # Extract IP-like strings from the line
-                import re
-                ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-                ips = re.findall(ip_pattern, line)
-                
-                if ips:
-                    print(f"Found potential IP(s) in line containing '{provision_identity}': {ips}")
-                    return jsonify({"ip": ips[0]}), 200
-        
-        print(f"\nNo client found with provision_identity: {provision_identity}")
-        return jsonify({"error": "Client not connected"}), 404
-        
+        session = lookup_client(provision_identity)
+        if session is None:
+            return jsonify({"error": "Client not connected"}), 404
+
+        ip = session['vpn_ip'] or session['real_ip']
+        return jsonify({"ip": ip}), 200
+
+    except FileNotFoundError:
+        print(f"OpenVPN status file not found at {status_log.path}")
+        return jsonify({"error": "OpenVPN status file not found"}), 404
     except Exception as e:
         print(f"Error reading status file: {str(e)}")
         return jsonify({"error": f"Error reading status file: {str(e)}"}), 500
@@ -267,7 +418,9 @@ def mtk_hostpot_ui(provision_identity, secret, form):
     try:
         if form not in ["login.html", "rlogin.html"]:
             return jsonify({"error": "Form not found"}), 404
-        return send_from_directory(Config.HOTSPOT_TEMPLATE_DIR, form)
+        return asset_response(hotspot_assets.get(Config.HOTSPOT_TEMPLATE_DIR, form))
+    except FileNotFoundError:
+        return jsonify({"error": "Form not found"}), 404
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
 
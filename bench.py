@@ -0,0 +1,418 @@
+"""
+Offline benchmark of the provisioning API.
+
+    python bench.py [--sizes 1000,10000,100000] [--requests 200] [--provisions 50]
+                    [--redis-url redis://localhost:6379/15] [--pki-backend cryptography|easyrsa]
+                    [--output bench_output.json] [--baseline previous.json --tolerance 0.25]
+
+Everything runs against a throwaway directory: a freshly generated CA and
+PKI, a stub easyrsa that signs with openssl, a client registry and synthetic
+OpenVPN status logs with the requested numbers of clients. Redis is an
+in-process fakeredis (requirements-dev.txt) unless --redis-url points at a
+local server (use a spare database, it is flushed). Requests go through Flask's test client, so the
+numbers are application cost without network or gunicorn overhead.
+
+Measured:
+  * create_provision throughput on the inline pooled-key path,
+  * task/<id>, /mikrotik/openvpn/key (full and 304) p50/p99,
+  * /server/ip/ p50/p99 from the status file and from the live table,
+  * status log parse time and admin dashboard render time per log size.
+
+Results are written as JSON. With --baseline, any p99 (or throughput) more
+than --tolerance worse than the baseline is reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+STUB_EASYRSA = """#!/bin/sh
+# Offline stand-in for easyrsa: only the commands the app uses, signed with openssl
+PKI=""
+for arg in "$@"; do
+    case "$arg" in --pki-dir=*) PKI="${arg#--pki-dir=}" ;; esac
+done
+while [ $# -gt 0 ]; do
+    case "$1" in --*) shift ;; *) break ;; esac
+done
+case "$1" in
+    gen-req)
+        openssl req -new -newkey rsa:2048 -nodes -batch -subj "/CN=$2" \\
+            -keyout "$PKI/private/$2.key" -out "$PKI/reqs/$2.req" 2>/dev/null ;;
+    sign-req)
+        openssl x509 -req -in "$PKI/reqs/$3.req" -CA "$PKI/ca.crt" -CAkey "$PKI/private/ca.key" \\
+            -set_serial "0x$(openssl rand -hex 16)" -days 825 -out "$PKI/issued/$3.crt" 2>/dev/null ;;
+    revoke|gen-crl) ;;
+    *) echo "stub easyrsa: unsupported command $1" >&2; exit 1 ;;
+esac
+"""
+
+
+def build_environment(root, args):
+    """Create the temp PKI and directories and point Config at them (before any app import)."""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    pki_dir = f"{root}/pki"
+    for sub in ("issued", "private", "reqs", "certs_by_serial"):
+        os.makedirs(f"{pki_dir}/{sub}", exist_ok=True)
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench-ca")])
+    now = datetime.datetime.utcnow()
+    ca = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    with open(f"{pki_dir}/ca.crt", 'wb') as f:
+        f.write(ca.public_bytes(serialization.Encoding.PEM))
+    with open(f"{pki_dir}/private/ca.key", 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    open(f"{pki_dir}/index.txt", 'w').close()
+    with open(f"{pki_dir}/serial", 'w') as f:
+        f.write("01\n")
+
+    easyrsa = f"{root}/easyrsa"
+    with open(easyrsa, 'w') as f:
+        f.write(STUB_EASYRSA)
+    os.chmod(easyrsa, 0o755)
+
+    os.environ.update({
+        "PKI_DIR": pki_dir,
+        "PKI_BACKEND": args.pki_backend,
+        "EASYRSA_PATH": easyrsa,
+        "KEY_POOL_DIR": f"{pki_dir}/pool",
+        "KEY_POOL_INLINE_PROVISION": "true",
+        "KEY_POOL_LOW_WATERMARK": "0",  # the pool is filled up front, no refills while measuring
+        "VPN_CLIENT_DIR": f"{root}/client",
+        "CLIENT_REGISTRY_PATH": f"{root}/registry/clients.db",
+        "VPN_STATUS_FILE": f"{root}/openvpn-status.log",
+        "VPN_CRL_PATH": f"{root}/crl.pem",
+        "HOTSPOT_TEMPLATE_DIR": f"{root}/hotspot",
+        "OVPN_DELIVERY": "render",
+        "ADMISSION_ENABLED": "false",
+        "CELERY_METRICS_PORT": "0",
+        # Nothing listens here: the management connection fails fast instead of timing out
+        "VPN_HOST": "127.0.0.1",
+        "VPN_PORT": "1",
+    })
+    os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    os.environ.pop("prometheus_multiproc_dir", None)
+
+    if args.redis_url:
+        os.environ["CELERY_BROKER_URL"] = args.redis_url
+        os.environ["CELERY_RESULT_BACKEND"] = args.redis_url
+        from urllib.parse import urlparse
+        url = urlparse(args.redis_url)
+        os.environ.update({
+            "REDIS_HOST": url.hostname or "localhost",
+            "REDIS_PORT": str(url.port or 6379),
+            "REDIS_DB": (url.path or "/0").lstrip('/') or "0",
+        })
+        if url.password:
+            os.environ["REDIS_PASSWORD"] = url.password
+    else:
+        # Celery talks to Redis through kombu, so give it in-memory transports instead
+        os.environ["CELERY_BROKER_URL"] = "memory://"
+        os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+        use_fakeredis()
+
+
+def use_fakeredis():
+    """Route every redis.Redis created by the app to one in-process fakeredis server."""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("bench.py needs either --redis-url or the fakeredis package for an in-process Redis")
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    class BenchRedis(fakeredis.FakeRedis):
+        def __init__(self, *args, **kwargs):
+            pool = kwargs.pop('connection_pool', None)
+            if pool is not None:
+                kwargs['decode_responses'] = pool.connection_kwargs.get('decode_responses', False)
+            kwargs['server'] = server
+            super().__init__(*args, **kwargs)
+
+        @classmethod
+        def from_url(cls, url, **kwargs):
+            return cls(decode_responses=kwargs.get('decode_responses', False))
+
+    redis.Redis = redis.StrictRedis = BenchRedis
+
+
+def percentile(sorted_samples, p):
+    index = max(0, min(len(sorted_samples) - 1, math.ceil(p / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(name, samples, clients=None, errors=0, **extra):
+    samples = sorted(samples)
+    result = {
+        "name": name,
+        "clients": clients,
+        "count": len(samples),
+        "errors": errors,
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+    result.update(extra)
+    return result
+
+
+def measure(name, count, call, clients=None, ok=(200,)):
+    """Time count calls of call(i); responses outside ok count as errors."""
+    samples = []
+    errors = 0
+    for i in range(count):
+        started = time.perf_counter()
+        response = call(i)
+        samples.append(time.perf_counter() - started)
+        if response.status_code not in ok:
+            errors += 1
+    return summarize(name, samples, clients, errors)
+
+
+def client_name(i):
+    return f"bench{i:06d}"
+
+
+def vpn_ip(i):
+    return f"10.{8 + i // 65536}.{(i // 256) % 256}.{i % 256}"
+
+
+def write_status_log(path, size):
+    """Write an OpenVPN status-version 2 file with size connected clients."""
+    lines = [
+        "TITLE,OpenVPN 2.5.9 x86_64-pc-linux-gnu",
+        "TIME,2024-01-01 00:00:00,1704067200",
+        "HEADER,CLIENT_LIST,Common Name,Real Address,Virtual Address,Virtual IPv6 Address,Bytes Received,"
+        "Bytes Sent,Connected Since,Connected Since (time_t),Username,Client ID,Peer ID,Data Channel Cipher",
+    ]
+    for i in range(size):
+        lines.append(f"CLIENT_LIST,{client_name(i)},198.51.{(i // 256) % 256}.{i % 256}:{1024 + i % 60000},"
+                     f"{vpn_ip(i)},,{i * 7},{i * 11},2024-01-01 00:00:00,1704067200,UNDEF,{i},{i},AES-256-GCM")
+    lines.append("HEADER,ROUTING_TABLE,Virtual Address,Common Name,Real Address,Last Ref,Last Ref (time_t)")
+    for i in range(size):
+        lines.append(f"ROUTING_TABLE,{vpn_ip(i)},{client_name(i)},198.51.{(i // 256) % 256}.{i % 256}:"
+                     f"{1024 + i % 60000},2024-01-01 00:00:05,1704067205")
+    lines.append("GLOBAL_STATS,Max bcast/mcast queue length,0")
+    lines.append("END")
+    content = "\n".join(lines) + "\n"
+    with open(path, 'w') as f:
+        f.write(content)
+    return content
+
+
+def run(args):
+    import registry
+    import keypool
+    import management
+    from app import app
+    from config import Config
+    from security import generate_secret
+    from status_log import parse_status, status_log
+    from redis_client import redis_client
+
+    results = []
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'admin'
+    rng = random.Random(args.seed)
+
+    # Provisioning: pre-generate the keys, then time the inline request path
+    started = time.perf_counter()
+    keypool.refill(low=args.provisions + 1, high=args.provisions)
+    results.append(summarize("key_pool_refill", [time.perf_counter() - started],
+                             keys=keypool.depth()))
+
+    provisioned = [f"prov{i:06d}" for i in range(args.provisions)]
+    started = time.perf_counter()
+    result = measure("create_provision", len(provisioned),
+                     lambda i: client.post(f"/mikrotik/openvpn/create_provision/{provisioned[i]}"),
+                     ok=(201, 202))
+    result["requests_per_second"] = round(len(provisioned) / (time.perf_counter() - started), 2)
+    results.append(result)
+
+    secrets = {name: generate_secret(name) for name in provisioned}
+    results.append(measure("ovpn_key", args.requests, lambda i: client.get(
+        "/mikrotik/openvpn/key", query_string={
+            "provision_identity": provisioned[i % len(provisioned)],
+            "secret": secrets[provisioned[i % len(provisioned)]]})))
+    etags = {}
+    for name in provisioned:
+        etags[name] = client.get("/mikrotik/openvpn/key", query_string={
+            "provision_identity": name, "secret": secrets[name]}).headers.get("ETag")
+    results.append(measure("ovpn_key_not_modified", args.requests, lambda i: client.get(
+        "/mikrotik/openvpn/key", query_string={
+            "provision_identity": provisioned[i % len(provisioned)],
+            "secret": secrets[provisioned[i % len(provisioned)]]},
+        headers={"If-None-Match": etags[provisioned[i % len(provisioned)]]}), ok=(304,)))
+
+    task_ids = [f"bench-task-{i}" for i in range(args.requests)]
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.set(f"celery-task-meta-{task_id}", json.dumps({
+            "status": "SUCCESS", "task_id": task_id,
+            "result": {"status": "success", "message": "ok", "provision_identity": "bench"}}))
+    pipe.execute()
+    results.append(measure("task_status", len(task_ids),
+                           lambda i: client.get(f"/mikrotik/openvpn/task/{task_ids[i]}")))
+    results.append(measure("task_status_bulk", 10, lambda i: client.post(
+        "/mikrotik/openvpn/tasks/status", json={"task_ids": task_ids}), clients=len(task_ids)))
+
+    for size in args.sizes:
+        content = write_status_log(Config.VPN_STATUS_FILE, size)
+        samples = []
+        for _ in range(3):
+            started = time.perf_counter()
+            parse_status(content)
+            samples.append(time.perf_counter() - started)
+        results.append(summarize("status_parse", samples, size))
+
+        with registry.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO clients (name, created_at) VALUES (?, '2024-01-01 00:00:00')",
+                [(client_name(i),) for i in range(size)]
+            )
+
+        names = [client_name(rng.randrange(size)) for _ in range(args.requests)]
+        name_secrets = {name: generate_secret(name) for name in set(names)}
+
+        def server_ip(i):
+            return client.get("/server/ip/", query_string={
+                "provision_identity": names[i], "secret": name_secrets[names[i]]})
+
+        status_log.refresh()
+        results.append(measure("server_ip_status_file", len(names), server_ip, size))
+
+        # Same lookups against the Redis table kept by the management monitor
+        management.live_clients.redis.delete(management.CLIENTS_KEY)
+        for chunk in range(0, size, 5000):
+            management.live_clients.redis.hset(management.CLIENTS_KEY, mapping={
+                client_name(i): json.dumps({"common_name": client_name(i), "vpn_ip": vpn_ip(i)})
+                for i in range(chunk, min(size, chunk + 5000))
+            })
+        management.live_clients.redis.set(management.ALIVE_KEY, 1)
+        results.append(measure("server_ip_live_table", len(names), server_ip, size))
+        results.append(measure("admin_dashboard", max(10, args.requests // 10),
+                               lambda i: client.get("/"), size))
+        results.append(measure("admin_dashboard_search", max(10, args.requests // 10),
+                               lambda i: client.get("/", query_string={"q": "bench0001"}), size))
+        management.live_clients.redis.delete(management.ALIVE_KEY)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of results more than tolerance worse than the baseline."""
+    previous = {(r["name"], r["clients"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["name"], result["clients"]))
+        if before is None:
+            continue
+        if before.get("p99_ms") and result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{result['name']} ({result['clients']} clients): "
+                               f"p99 {before['p99_ms']}ms -> {result['p99_ms']}ms")
+        if before.get("requests_per_second") and \
+                result.get("requests_per_second", 0) < before["requests_per_second"] * (1 - tolerance):
+            regressions.append(f"{result['name']}: {before['requests_per_second']} -> "
+                               f"{result['requests_per_second']} requests/s")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda value: [int(size) for size in value.split(",")],
+                        help="comma separated numbers of connected clients in the synthetic status logs")
+    parser.add_argument("--requests", type=int, default=200, help="requests per latency measurement")
+    parser.add_argument("--provisions", type=int, default=50, help="clients to provision")
+    parser.add_argument("--redis-url", help="local Redis to use instead of in-process fakeredis (flushed)")
+    parser.add_argument("--pki-backend", default="cryptography", choices=("cryptography", "easyrsa"))
+    parser.add_argument("--output", default="bench_output.json", help="JSON results file, - for stdout")
+    parser.add_argument("--baseline", help="previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory(prefix="vpn-bench-") as root:
+        build_environment(root, args)
+        if args.redis_url:
+            import redis
+            redis.Redis.from_url(args.redis_url).flushdb()
+
+        started = time.time()
+        # The app logs per request; keep it out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = run(args)
+
+    report = {
+        "meta": {
+            "started_at": datetime.datetime.utcfromtimestamp(started).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "duration_seconds": round(time.time() - started, 1),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pki_backend": args.pki_backend,
+            "redis": "local" if args.redis_url else "fakeredis",
+            "requests": args.requests,
+        },
+        "results": results,
+    }
+
+    summary = sys.stderr if args.output == "-" else sys.stdout
+    for result in results:
+        clients = f"{result['clients']:>7}" if result["clients"] is not None else " " * 7
+        extra = f"  {result['requests_per_second']} req/s" if "requests_per_second" in result else ""
+        print(f"{result['name']:<24}{clients}  p50 {result['p50_ms']:>9.3f}ms  p99 {result['p99_ms']:>9.3f}ms"
+              f"  errors {result['errors']}{extra}", file=summary)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,130 @@
-#config.py
+"""
+Settings of the one Celery app (tasks.celery): queues, routing and priorities.
 
-from celery import Celery
+Work is split by workload class so that a burst of slow jobs never delays
+provisioning:
+
+* provisioning    - certificate issuance the main site waits for
+* pki-maintenance - key pool refills and CRL rebuilds
+* router-io       - RouterOS commands over the VPN, slow and bursty
+* housekeeping    - connection history, traffic sampling and compaction
+
+Each queue is served by its own worker (`python celery_config.py <queue>`),
+sized by WORKER_SETTINGS: concurrency, prefetch and time limits. Within a
+queue, messages are ordered by priority; with the Redis broker 0 is the highest, so
+a single provisioning request is taken before the chunks of a large batch.
+"""
+import sys
+from kombu import Queue
 from config import Config
-import os
-
-# Docker Redis configuration
-REDIS_HOST = os.getenv('REDIS_HOST', 'redis')  # Using Docker service name
-REDIS_PORT = os.getenv('REDIS_PORT', '6379')  # Using internal Redis port
-REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
-REDIS_DB = os.getenv('REDIS_DB', '0')
-
-# Construct Redis URL
-redis_url = f"redis://{f':{REDIS_PASSWORD}@' if REDIS_PASSWORD else ''}{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
-
-# Initialize Celery
-celery = Celery('vpn_tasks',
-                broker=redis_url,
-                backend=redis_url)
-
-# Configure Celery
-celery.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
-    timezone='UTC',
-    enable_utc=True,
-    task_track_started=True,
-    task_time_limit=300,  # 5 minutes
-    worker_max_tasks_per_child=1,  # Restart worker after each task
-    broker_connection_retry_on_startup=True,
-    broker_connection_retry=True,
-    broker_connection_max_retries=10
-) 
\ No newline at end of file
+
+PROVISIONING = 'provisioning'
+PKI_MAINTENANCE = 'pki-maintenance'
+ROUTER_IO = 'router-io'
+HOUSEKEEPING = 'housekeeping'
+
+PRIORITY_STEPS = list(range(10))
+PROVISION_PRIORITY = 0
+DEFAULT_PRIORITY = 5
+BATCH_PRIORITY = 8
+
+WORKER_SETTINGS = {
+    PROVISIONING: {
+        'concurrency': Config.CELERY_PROVISIONING_CONCURRENCY,
+        'prefetch_multiplier': 1,  # a prefetched batch chunk would not yield to a higher priority
+        'time_limit': 300,
+        'soft_time_limit': 240,
+    },
+    PKI_MAINTENANCE: {
+        'concurrency': Config.CELERY_PKI_MAINTENANCE_CONCURRENCY,
+        'prefetch_multiplier': 1,
+        'time_limit': 900,
+        'soft_time_limit': 840,
+    },
+    ROUTER_IO: {
+        'concurrency': Config.CELERY_ROUTER_IO_CONCURRENCY,
+        'prefetch_multiplier': 1,
+        'time_limit': 3600,
+        'soft_time_limit': 3540,
+    },
+    HOUSEKEEPING: {
+        'concurrency': Config.CELERY_HOUSEKEEPING_CONCURRENCY,
+        'prefetch_multiplier': 4,
+        'time_limit': 600,
+        'soft_time_limit': 540,
+    },
+}
+
+broker_url = Config.CELERY_BROKER_URL
+result_backend = Config.CELERY_RESULT_BACKEND
+task_serializer = 'json'
+accept_content = ['json']
+result_serializer = 'json'
+timezone = 'UTC'
+enable_utc = True
+task_track_started = True
+worker_max_tasks_per_child = Config.CELERY_WORKER_MAX_TASKS_PER_CHILD  # PKI updates are serialised by pki.pki_lock
+broker_connection_retry_on_startup = True
+broker_connection_retry = True
+broker_connection_max_retries = 10
+
+task_queues = [Queue(name) for name in WORKER_SETTINGS]
+task_default_queue = HOUSEKEEPING
+task_default_priority = DEFAULT_PRIORITY
+task_routes = {
+    'tasks.generate_certificate': {'queue': PROVISIONING, 'priority': PROVISION_PRIORITY},
+    'tasks.refill_key_pool': {'queue': PKI_MAINTENANCE},
+    'tasks.process_revocations': {'queue': PKI_MAINTENANCE},
+    'tasks.run_router_command': {'queue': ROUTER_IO},
+    'tasks.snapshot_session_history': {'queue': HOUSEKEEPING},
+    'tasks.sample_traffic': {'queue': HOUSEKEEPING},
+    'tasks.compact_session_history': {'queue': HOUSEKEEPING},
+}
+# Redis emulates priorities with one list per step: "<queue>" for 0, "<queue>:<n>" otherwise
+broker_transport_options = {
+    'priority_steps': PRIORITY_STEPS,
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+
+beat_schedule = {
+    'refill-key-pool': {
+        'task': 'tasks.refill_key_pool',
+        'schedule': Config.KEY_POOL_REFILL_INTERVAL,
+    },
+    'snapshot-session-history': {
+        'task': 'tasks.snapshot_session_history',
+        'schedule': Config.HISTORY_SNAPSHOT_INTERVAL,
+    },
+    'sample-traffic': {
+        'task': 'tasks.sample_traffic',
+        'schedule': Config.TRAFFIC_SAMPLE_INTERVAL,
+    },
+    'compact-session-history': {
+        'task': 'tasks.compact_session_history',
+        'schedule': Config.HISTORY_COMPACT_INTERVAL,
+    },
+}
+
+
+def worker_argv(queue):
+    """Command line of a worker consuming only the given queue, sized for its workload."""
+    if queue not in WORKER_SETTINGS:
+        raise ValueError(f"Unknown queue {queue!r}, expected one of {', '.join(WORKER_SETTINGS)}")
+    settings = WORKER_SETTINGS[queue]
+    return [
+        'worker',
+        '--loglevel=info',
+        f'--queues={queue}',
+        f'--hostname={queue}@%h',
+        f"--concurrency={settings['concurrency']}",
+        f"--prefetch-multiplier={settings['prefetch_multiplier']}",
+        f"--time-limit={settings['time_limit']}",
+        f"--soft-time-limit={settings['soft_time_limit']}",
+        '-O', 'fair',
+    ]
+
+
+if __name__ == '__main__':
+    from tasks import celery
+    celery.worker_main(worker_argv(sys.argv[1] if len(sys.argv) > 1 else PROVISIONING))
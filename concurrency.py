@@ -0,0 +1,42 @@
+"""
+Support for serving with gevent workers as well as sync ones.
+
+With GUNICORN_WORKER_CLASS=gevent, gunicorn_config.py monkey-patches the
+standard library before the app is imported, so sockets (Redis, RouterOS,
+OpenVPN management), subprocess (openssl, easyrsa), time.sleep (PKI lock
+polling), threading and queue all become cooperative. The remaining places
+that would hold up every greenlet in a worker are handled here:
+
+* CPU-heavy parsing (the OpenVPN status file) runs on gevent's pool of real
+  threads via run_blocking();
+* SQLite connections stay per OS thread (thread_local()) instead of one per
+  greenlet, which would open a connection for every concurrent request;
+* task status waiters share one Redis subscription per worker
+  (task_status.TaskWatcher) instead of one connection each.
+"""
+import threading
+
+
+def is_gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def thread_local():
+    """A threading.local bound to OS threads, also when threading is patched by gevent."""
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        return threading.local()
+    return get_original('threading', 'local')()
+
+
+def run_blocking(function, *args):
+    """Run CPU-bound work off the gevent hub so other requests keep being served."""
+    if is_gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(function, args)
+    return function(*args)
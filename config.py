@@ -11,16 +11,122 @@ class Config:
     VPN_HOST = os.getenv('VPN_HOST', '34.60.44.191')
     VPN_PORT = int(os.getenv('VPN_PORT', 1194))
     VPN_CLIENT_DIR = os.getenv('VPN_CLIENT_DIR', '/etc/openvpn/client')
+    VPN_STATUS_FILE = os.getenv('VPN_STATUS_FILE', '/var/log/openvpn/openvpn-status.log')
+    CLIENT_REGISTRY_PATH = os.getenv('CLIENT_REGISTRY_PATH', '/etc/openvpn/registry/clients.db')
+
+    # Connection history (history.py)
+    SESSION_HISTORY_PATH = os.getenv('SESSION_HISTORY_PATH', '/etc/openvpn/registry/history.db')
+    HISTORY_RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', 30))  # then downsampled to daily rows
+    HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 365))
+    HISTORY_SNAPSHOT_INTERVAL = int(os.getenv('HISTORY_SNAPSHOT_INTERVAL', 60))  # status file servers only
+    HISTORY_COMPACT_INTERVAL = int(os.getenv('HISTORY_COMPACT_INTERVAL', 3600))
+
+    # Bandwidth accounting (traffic.py)
+    TRAFFIC_SAMPLE_INTERVAL = int(os.getenv('TRAFFIC_SAMPLE_INTERVAL', 30))
+    TRAFFIC_WINDOWS = os.getenv('TRAFFIC_WINDOWS', '300,3600')  # seconds, for top-N rankings
+
+    # Client config delivery: 'render' builds .ovpn on demand, 'file' serves stored files
+    OVPN_DELIVERY = os.getenv('OVPN_DELIVERY', 'render')
+    VPN_REMOTE_HOST = os.getenv('VPN_REMOTE_HOST', '35.226.234.138')
+    VPN_CLIENT_COMMON_PATH = os.getenv('VPN_CLIENT_COMMON_PATH', None)
+
+    # PKI (easy-rsa) configuration
+    EASYRSA_PATH = os.getenv('EASYRSA_PATH', '/etc/openvpn/easy-rsa/easyrsa')
+    PKI_DIR = os.getenv('PKI_DIR', '/etc/openvpn/easy-rsa/pki')
+    PKI_BACKEND = os.getenv('PKI_BACKEND', 'cryptography')  # 'cryptography' or 'easyrsa'
+    PKI_CA_PASSPHRASE = os.getenv('PKI_CA_PASSPHRASE', None)
+    PKI_CERT_DAYS = int(os.getenv('PKI_CERT_DAYS', 825))
+    PKI_KEY_SIZE = int(os.getenv('PKI_KEY_SIZE', 2048))
+    PKI_LOCK_TIMEOUT = float(os.getenv('PKI_LOCK_TIMEOUT', 30))
+    PKI_CRL_DAYS = int(os.getenv('PKI_CRL_DAYS', 180))
+    VPN_CRL_PATH = os.getenv('VPN_CRL_PATH', '/etc/openvpn/crl.pem')  # crl-verify file OpenVPN reads
+    REVOCATION_COALESCE_SECONDS = float(os.getenv('REVOCATION_COALESCE_SECONDS', 5))
+
+    # OpenVPN management interface
+    VPN_MANAGEMENT_HOST = os.getenv('VPN_MANAGEMENT_HOST', VPN_HOST)
+    VPN_MANAGEMENT_PORT = int(os.getenv('VPN_MANAGEMENT_PORT', 7505))
+    VPN_MANAGEMENT_PASSWORD = os.getenv('VPN_MANAGEMENT_PASSWORD', None)
+    # OpenVPN only sends >CLIENT:ESTABLISHED/DISCONNECT when run with management-client-auth
+    VPN_MANAGEMENT_CLIENT_AUTH = os.getenv('VPN_MANAGEMENT_CLIENT_AUTH', 'false').lower() == 'true'
+    VPN_MANAGEMENT_RESYNC_INTERVAL = int(os.getenv('VPN_MANAGEMENT_RESYNC_INTERVAL', 60))
+    VPN_MANAGEMENT_POLL_INTERVAL = int(os.getenv('VPN_MANAGEMENT_POLL_INTERVAL', 5))  # `status 3` polling without client-auth
+    HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', 1))  # seconds per readiness check
+
+    # Several OpenVPN servers (see servers.py); unset means the single server configured above
+    VPN_SERVERS_FILE = os.getenv('VPN_SERVERS_FILE', None)
+    VPN_DEFAULT_SERVER = os.getenv('VPN_DEFAULT_SERVER', None)  # owns clients provisioned before the inventory
+    VPN_SERVER_CAPACITY = int(os.getenv('VPN_SERVER_CAPACITY', 5000))  # clients per server unless set per entry
+    VPN_PLACEMENT = os.getenv('VPN_PLACEMENT', 'assigned')  # 'assigned' or 'connected'
+    VPN_PLACEMENT_REFRESH = float(os.getenv('VPN_PLACEMENT_REFRESH', 5))
     
     # Hotspot configuration
     HOTSPOT_TEMPLATE_DIR = os.getenv('HOTSPOT_TEMPLATE_DIR', '/var/www/templates')
+    HOTSPOT_RECHECK_INTERVAL = float(os.getenv('HOTSPOT_RECHECK_INTERVAL', 2))
+    HOTSPOT_MAX_AGE = int(os.getenv('HOTSPOT_MAX_AGE', 300))
     
     # Redis configuration
     REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
     REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
     REDIS_DB = int(os.getenv('REDIS_DB', 0))
+    REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 64))  # per process, see redis_client.py
+    REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
     
     # Celery configuration
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
-    CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}') 
\ No newline at end of file
+    CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
+    CELERY_WORKER_MAX_TASKS_PER_CHILD = int(os.getenv('CELERY_WORKER_MAX_TASKS_PER_CHILD', 1000))
+    CELERY_METRICS_PORT = int(os.getenv('CELERY_METRICS_PORT', 9808))  # 0 disables the worker exporter
+    # Worker processes per queue (see celery_config.py)
+    CELERY_PROVISIONING_CONCURRENCY = int(os.getenv('CELERY_PROVISIONING_CONCURRENCY', 4))
+    CELERY_PKI_MAINTENANCE_CONCURRENCY = int(os.getenv('CELERY_PKI_MAINTENANCE_CONCURRENCY', 1))
+    CELERY_ROUTER_IO_CONCURRENCY = int(os.getenv('CELERY_ROUTER_IO_CONCURRENCY', 4))
+    CELERY_HOUSEKEEPING_CONCURRENCY = int(os.getenv('CELERY_HOUSEKEEPING_CONCURRENCY', 2))
+
+    # Task status long-poll / Server-Sent Events (keep below the gunicorn worker timeout)
+    TASK_LONG_POLL_MAX_WAIT = float(os.getenv('TASK_LONG_POLL_MAX_WAIT', 25))
+    TASK_STREAM_MAX_SECONDS = float(os.getenv('TASK_STREAM_MAX_SECONDS', 25))
+    TASK_STREAM_HEARTBEAT = float(os.getenv('TASK_STREAM_HEARTBEAT', 10))
+    TASK_STATUS_BATCH_MAX = int(os.getenv('TASK_STATUS_BATCH_MAX', 1000))  # ids per bulk status request
+
+    # Batch provisioning
+    PROVISION_BATCH_MAX_SIZE = int(os.getenv('PROVISION_BATCH_MAX_SIZE', 1000))
+    PROVISION_BATCH_PARALLELISM = int(os.getenv('PROVISION_BATCH_PARALLELISM', 8))
+    PROVISION_INFLIGHT_TTL = int(os.getenv('PROVISION_INFLIGHT_TTL', 900))  # only reached if a worker dies mid-task
+    PROVISION_IDEMPOTENCY_TTL = int(os.getenv('PROVISION_IDEMPOTENCY_TTL', 86400))
+
+    # Pre-generated key pool
+    KEY_POOL_DIR = os.getenv('KEY_POOL_DIR', f'{PKI_DIR}/pool')
+    KEY_POOL_KEY_SIZE = int(os.getenv('KEY_POOL_KEY_SIZE', PKI_KEY_SIZE))
+    KEY_POOL_LOW_WATERMARK = int(os.getenv('KEY_POOL_LOW_WATERMARK', 20))
+    KEY_POOL_HIGH_WATERMARK = int(os.getenv('KEY_POOL_HIGH_WATERMARK', 100))
+    KEY_POOL_REFILL_INTERVAL = int(os.getenv('KEY_POOL_REFILL_INTERVAL', 60))
+    KEY_POOL_INLINE_PROVISION = os.getenv('KEY_POOL_INLINE_PROVISION', 'true').lower() == 'true'
+
+    # Provisioning admission control
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_CALLER_RATE = float(os.getenv('ADMISSION_CALLER_RATE', 20))  # tokens per second
+    ADMISSION_CALLER_BURST = int(os.getenv('ADMISSION_CALLER_BURST', 200))
+    ADMISSION_PREFIX_RATE = float(os.getenv('ADMISSION_PREFIX_RATE', 10))
+    ADMISSION_PREFIX_BURST = int(os.getenv('ADMISSION_PREFIX_BURST', 100))
+    ADMISSION_PREFIX_LENGTH = int(os.getenv('ADMISSION_PREFIX_LENGTH', 4))
+    ADMISSION_LATENCY_BUDGET = float(os.getenv('ADMISSION_LATENCY_BUDGET', 120))  # seconds
+    ADMISSION_MIN_QUEUE_DEPTH = int(os.getenv('ADMISSION_MIN_QUEUE_DEPTH', 50))
+    ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', 5000))
+
+    # RouterOS API sessions to the MikroTiks over the VPN
+    ROUTEROS_USERNAME = os.getenv('ROUTEROS_USERNAME', 'admin')
+    ROUTEROS_PASSWORD = os.getenv('ROUTEROS_PASSWORD', 'password')
+    ROUTEROS_PORT = int(os.getenv('ROUTEROS_PORT', 8728))
+    ROUTEROS_PLAINTEXT_LOGIN = os.getenv('ROUTEROS_PLAINTEXT_LOGIN', 'false').lower() == 'true'
+    ROUTEROS_MAX_SESSIONS_PER_ROUTER = int(os.getenv('ROUTEROS_MAX_SESSIONS_PER_ROUTER', 2))
+    ROUTEROS_ACQUIRE_TIMEOUT = float(os.getenv('ROUTEROS_ACQUIRE_TIMEOUT', 10))
+    ROUTEROS_COMMAND_TIMEOUT = float(os.getenv('ROUTEROS_COMMAND_TIMEOUT', 15))
+    ROUTEROS_HEALTHCHECK_AFTER = float(os.getenv('ROUTEROS_HEALTHCHECK_AFTER', 30))  # idle seconds before a probe
+    ROUTEROS_IDLE_TIMEOUT = float(os.getenv('ROUTEROS_IDLE_TIMEOUT', 300))
+
+    # Fleet-wide RouterOS command fan-out
+    FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 64))
+    FANOUT_MAX_CONCURRENCY = int(os.getenv('FANOUT_MAX_CONCURRENCY', 256))
+    FANOUT_INLINE_MAX_ROUTERS = int(os.getenv('FANOUT_INLINE_MAX_ROUTERS', 100))  # larger runs go to Celery
+    FANOUT_RESULT_TTL = int(os.getenv('FANOUT_RESULT_TTL', 3600))
@@ -1,6 +1,7 @@
 import os
 import json
 from config import Config
+import servers
 
 class ConfigManager:
     @staticmethod
@@ -22,7 +23,7 @@ class ConfigManager:
     @staticmethod
     def get_client_config(provision_identity):
         """Get client configuration path."""
-        return os.path.join(Config.VPN_CLIENT_DIR, f"{provision_identity}.ovpn")
+        return os.path.join(servers.locate(provision_identity).client_dir, f"{provision_identity}.ovpn")
 
     @staticmethod
     def get_template_path(template_name):
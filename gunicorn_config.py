@@ -1,16 +1,37 @@
+import os
 import multiprocessing
 
+# Worker model: 'sync' (one request per process) or 'gevent' (thousands of
+# concurrent long-polls, event streams and downloads per process; see concurrency.py)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class == 'gevent':
+    # Patch before anything else is imported, including the app under --preload
+    from gevent import monkey
+    monkey.patch_all()
+
+# Prometheus multiprocess mode: must be set before any worker imports prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus')
+
 # Server socket
 bind = "0.0.0.0:8000"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
-worker_connections = 1000
+if worker_class == 'sync':
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+else:
+    # An async worker is limited by CPU, not by waiting clients
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))  # gevent only
 timeout = 30
 keepalive = 2
 
+# Import the app once in the master and fork workers from it, so the CA,
+# templates and hotspot assets are loaded once (app.warm_up) and shared.
+# Connections are not: redis-py pools reconnect after a fork, and the task
+# watcher thread and SQLite connections are only opened on first use.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
 # Logging
 accesslog = '-'
 errorlog = '-'
@@ -29,4 +50,21 @@ tmp_upload_dir = None
 
 # SSL
 keyfile = None
-certfile = None 
\ No newline at end of file
+certfile = None
+
+
+# Server hooks
+def on_starting(server):
+    from metrics import reset_multiprocess_dir
+    reset_multiprocess_dir()
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app import warm_up
+        warm_up()
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid) 
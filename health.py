@@ -0,0 +1,107 @@
+"""
+Liveness and readiness checks.
+
+Every check is bounded by HEALTH_CHECK_TIMEOUT, and none of them opens the
+OpenVPN management port: the management monitor (management.py) holds the
+one shared management connection per server and refreshes a heartbeat in
+Redis while it is connected, so a slow or dead management interface never
+blocks a request. Management, PKI and status file are checked per server.
+"""
+import os
+import time
+import redis
+from config import Config
+from management import ALIVE_KEY
+import servers
+
+_redis = redis.Redis(
+    host=Config.REDIS_HOST,
+    port=Config.REDIS_PORT,
+    db=Config.REDIS_DB,
+    password=Config.REDIS_PASSWORD,
+    socket_connect_timeout=Config.HEALTH_CHECK_TIMEOUT,
+    socket_timeout=Config.HEALTH_CHECK_TIMEOUT,
+    decode_responses=True
+)
+
+
+def check_redis():
+    _redis.ping()
+    return {"ok": True}
+
+
+def per_server(check):
+    """Run check(server) for every server; ok only if it is ok for all of them."""
+    results = {server.name: check(server) for server in servers.all_servers()}
+    return {"ok": all(result["ok"] for result in results.values()), "servers": results}
+
+
+def management_heartbeat(server):
+    heartbeat = _redis.get(server.key(ALIVE_KEY))
+    if heartbeat is None:
+        return {"ok": False, "error": "No management monitor is connected to OpenVPN"}
+    try:
+        age = round(time.time() - float(heartbeat), 1)
+    except ValueError:
+        age = None
+    return {"ok": True, "heartbeat_age_seconds": age}
+
+
+def ca_readable(server):
+    ca_path = f"{server.pki_dir}/ca.crt"
+    if not os.access(ca_path, os.R_OK):
+        return {"ok": False, "error": f"CA certificate not readable at {ca_path}"}
+    return {"ok": True}
+
+
+def status_file_age(server):
+    try:
+        age = round(time.time() - os.stat(server.status_file).st_mtime, 1)
+    except FileNotFoundError:
+        return {"ok": False, "error": f"No status file at {server.status_file}"}
+    return {"ok": True, "age_seconds": age}
+
+
+def check_management():
+    return per_server(management_heartbeat)
+
+
+def check_pki():
+    return per_server(ca_readable)
+
+
+def check_status_file():
+    return per_server(status_file_age)
+
+
+# Required checks make the instance unready; the others only degrade it, since
+# client lookups fall back from the management monitor to the status file.
+CHECKS = (
+    ("redis", check_redis, True),
+    ("pki", check_pki, True),
+    ("management", check_management, False),
+    ("status_file", check_status_file, False),
+)
+
+
+def readiness():
+    """Run all checks and return (payload, http status)."""
+    results = {}
+    ready = True
+    degraded = False
+    for name, check, required in CHECKS:
+        started = time.monotonic()
+        try:
+            result = check()
+        except Exception as e:
+            result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        results[name] = result
+        if not result["ok"]:
+            if required:
+                ready = False
+            else:
+                degraded = True
+
+    status = "unavailable" if not ready else "degraded" if degraded else "ok"
+    return {"status": status, "checks": results}, 200 if ready else 503
@@ -1,38 +1,14 @@
 import os
-import subprocess
+import hashlib
+import datetime
+import threading
 from config import Config
-def generate_openvpn_config(provision_identity, output_path):
-    """Generate OpenVPN client configuration file using system certificates."""
-    try:
-        # Create output directory if it doesn't exist
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        # Create OpenVPN configuration using system certificates
-        ca_path = "/etc/openvpn/easy-rsa/pki/ca.crt"
-        cert_path = f"/etc/openvpn/easy-rsa/pki/issued/{provision_identity}.crt"
-        key_path = f"/etc/openvpn/easy-rsa/pki/private/{provision_identity}.key"
-        
-        # Read certificate files
-        try:
-            with open(ca_path, 'r') as f:
-                ca_content = f.read().strip()
-            
-            with open(cert_path, 'r') as f:
-                cert_content = f.read().strip()
-            
-            with open(key_path, 'r') as f:
-                key_content = f.read().strip()
-        except PermissionError:
-            # If permission error, try using sudo cat
-            ca_content = subprocess.check_output(['cat', ca_path]).decode('utf-8').strip()
-            cert_content = subprocess.check_output(['cat', cert_path]).decode('utf-8').strip()
-            key_content = subprocess.check_output(['cat', key_path]).decode('utf-8').strip()
-        
-        # Create OpenVPN configuration
-        config = f"""client
+import servers
+
+CLIENT_HEADER_TEMPLATE = """client
 dev tun
 proto tcp
-remote 35.226.234.138 {Config.VPN_PORT}
+remote {remote} {port}
 resolv-retry infinite
 nobind
 persist-key
@@ -42,6 +18,47 @@ cipher AES-256-CBC
 data-ciphers AES-256-CBC
 data-ciphers-fallback AES-256-CBC
 verb 3
+"""
+
+_cache_lock = threading.Lock()
+_file_cache = {}
+
+
+def read_cached(path):
+    """Return (content, digest, mtime) of a small shared file, re-read only when it changes.
+
+    Used for the CA certificate and client-common header, which are the same
+    for every client, so each worker reads them once instead of per request.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        content = f.read().strip()
+    entry = (content, hashlib.sha256(content.encode()).hexdigest(), stat.st_mtime)
+    with _cache_lock:
+        _file_cache[path] = (signature, entry)
+    return entry
+
+
+def client_header(server=None):
+    """Return (header, digest, mtime) for the part of the config shared by all clients of a server."""
+    server = server or servers.default_server()
+    if server.client_common_path and os.path.exists(server.client_common_path):
+        return read_cached(server.client_common_path)
+    header = CLIENT_HEADER_TEMPLATE.format(remote=server.remote_host, port=server.remote_port).strip()
+    return header, hashlib.sha256(header.encode()).hexdigest(), None
+
+
+def render_openvpn_config(cert_content, key_content, server=None):
+    """Render a client configuration from the server's cached header and CA plus the client's cert/key."""
+    server = server or servers.default_server()
+    header = client_header(server)[0]
+    ca_content = read_cached(f"{server.pki_dir}/ca.crt")[0]
+    return f"""{header}
 
 
 <ca>
@@ -49,19 +66,108 @@ verb 3
 </ca>
 
 <cert>
-{cert_content}
+{cert_content.strip()}
 </cert>
 
 <key>
-{key_content}
+{key_content.strip()}
 </key>
 """
-        
+
+
+def client_exists(provision_identity):
+    """True if a client was provisioned on any server, whether its config is stored or rendered on demand."""
+    return any(os.path.exists(f"{server.client_dir}/{provision_identity}.ovpn")
+               or server.has_certificate(provision_identity)
+               for server in servers.all_servers())
+
+
+def openvpn_config_version(provision_identity, server=None):
+    """Return (etag, last_modified) of a client's rendered config without rendering it.
+
+    Built from file metadata only, so conditional requests are answered with a
+    couple of stat calls. Returns (None, None) if the client has no certificate.
+    """
+    server = server or servers.locate(provision_identity)
+    try:
+        cert_stat = os.stat(f"{server.pki_dir}/issued/{provision_identity}.crt")
+        key_stat = os.stat(f"{server.pki_dir}/private/{provision_identity}.key")
+    except FileNotFoundError:
+        return None, None
+
+    _, header_digest, header_mtime = client_header(server)
+    _, ca_digest, ca_mtime = read_cached(f"{server.pki_dir}/ca.crt")
+    version = (f"{header_digest}:{ca_digest}:{cert_stat.st_mtime_ns}:{cert_stat.st_size}:"
+               f"{key_stat.st_mtime_ns}:{key_stat.st_size}")
+    etag = hashlib.sha256(version.encode()).hexdigest()[:32]
+    last_modified = max(m for m in (header_mtime, ca_mtime, cert_stat.st_mtime, key_stat.st_mtime) if m)
+    return etag, last_modified
+
+
+def render_client_config(provision_identity, server=None):
+    """Render a client's configuration from its certificate and key in its server's PKI."""
+    server = server or servers.locate(provision_identity)
+    with open(f"{server.pki_dir}/issued/{provision_identity}.crt", 'r') as f:
+        cert_content = f.read()
+    with open(f"{server.pki_dir}/private/{provision_identity}.key", 'r') as f:
+        key_content = f.read()
+    return render_openvpn_config(cert_content, key_content, server)
+
+
+def openvpn_config_response(provision_identity):
+    """Serve a client's .ovpn with ETag/Last-Modified, answering 304 when unchanged.
+
+    In 'render' delivery mode the config is built on demand from the cached CA
+    and header; in 'file' mode the stored .ovpn is sent. Returns None if the
+    client has no configuration.
+    """
+    from flask import request, send_file, Response
+    from werkzeug.http import is_resource_modified, http_date
+
+    server = servers.locate(provision_identity)
+    if Config.OVPN_DELIVERY == 'file':
+        path = f"{server.client_dir}/{provision_identity}.ovpn"
+        if not os.path.exists(path):
+            return None
+        return send_file(path, as_attachment=True, conditional=True, etag=True, max_age=0)
+
+    etag, last_modified = openvpn_config_version(provision_identity, server)
+    if etag is None:
+        return None
+
+    last_modified = datetime.datetime.fromtimestamp(int(last_modified), tz=datetime.timezone.utc)
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": "no-cache",
+    }
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+
+    headers["Content-Disposition"] = f"attachment; filename={provision_identity}.ovpn"
+    return Response(render_client_config(provision_identity, server), mimetype='application/x-openvpn-profile',
+                    headers=headers)
+
+
+def generate_openvpn_config(provision_identity, output_path, cert_content=None, key_content=None, server=None):
+    """Generate OpenVPN client configuration file using system certificates.
+    cert_content/key_content: PEMs already in memory from the issuer, read from the PKI otherwise.
+    server: the client's VPN server, looked up if not given.
+    """
+    try:
+        # Create output directory if it doesn't exist
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        if cert_content is None or key_content is None:
+            config = render_client_config(provision_identity, server)
+        else:
+            config = render_openvpn_config(cert_content, key_content, server or servers.locate(provision_identity))
+
         # Write configuration to file
         with open(output_path, 'w') as f:
             f.write(config)
-            
+
         return True
     except Exception as e:
         print(f"Failed to generate OpenVPN configuration: {str(e)}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,295 @@
+"""
+Connection history of every client, stored as deltas in SQLite.
+
+Only connect and disconnect events are written, never full snapshots. The
+management monitor records them as OpenVPN reports them and reconciles its
+periodic `status 3` resync against the open sessions; servers without a
+running monitor are reconciled from their status file by a Celery beat task.
+A client whose session restarted between two snapshots (a new connect time)
+is recorded as a disconnect followed by a connect, so short flaps are not lost.
+
+Raw events are kept for HISTORY_RAW_DAYS and then downsampled into one row
+per client and day (connects, disconnects, connected seconds), which is kept
+for HISTORY_RETENTION_DAYS.
+"""
+import os
+import time
+import sqlite3
+import datetime
+from contextlib import contextmanager
+from config import Config
+from concurrency import thread_local
+
+DISCONNECT = 0
+CONNECT = 1
+EVENT_NAMES = {CONNECT: "connect", DISCONNECT: "disconnect"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    client TEXT NOT NULL,
+    server TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    at INTEGER NOT NULL,
+    vpn_ip TEXT,
+    real_ip TEXT,
+    duration INTEGER,
+    bytes_received INTEGER,
+    bytes_sent INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_client_at ON events (client, at);
+CREATE INDEX IF NOT EXISTS events_at_kind_client ON events (at, kind, client);
+CREATE TABLE IF NOT EXISTS open_sessions (
+    client TEXT PRIMARY KEY,
+    server TEXT NOT NULL,
+    connected_at INTEGER NOT NULL,
+    vpn_ip TEXT,
+    real_ip TEXT
+);
+CREATE INDEX IF NOT EXISTS open_sessions_server ON open_sessions (server);
+CREATE TABLE IF NOT EXISTS daily (
+    client TEXT NOT NULL,
+    day TEXT NOT NULL,
+    connects INTEGER NOT NULL,
+    disconnects INTEGER NOT NULL,
+    connected_seconds INTEGER NOT NULL,
+    PRIMARY KEY (client, day)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_day ON daily (day);
+"""
+
+_local = thread_local()
+
+
+def get_connection():
+    """Return this thread's connection, creating the database on first use."""
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        path = Config.SESSION_HISTORY_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        _local.connection = connection
+    return connection
+
+
+@contextmanager
+def transaction():
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def _connected_at(session, default):
+    return int(session.get('connected_since_epoch') or 0) or int(default)
+
+
+def _open(connection, server, session, at):
+    connection.execute(
+        "INSERT INTO events (client, server, kind, at, vpn_ip, real_ip) VALUES (?, ?, ?, ?, ?, ?)",
+        (session['common_name'], server, CONNECT, at, session.get('vpn_ip'), session.get('real_ip'))
+    )
+    connection.execute(
+        "INSERT OR REPLACE INTO open_sessions (client, server, connected_at, vpn_ip, real_ip) VALUES (?, ?, ?, ?, ?)",
+        (session['common_name'], server, at, session.get('vpn_ip'), session.get('real_ip'))
+    )
+
+
+def _close(connection, open_session, at, bytes_received=None, bytes_sent=None):
+    connection.execute(
+        "INSERT INTO events (client, server, kind, at, vpn_ip, real_ip, duration, bytes_received, bytes_sent) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (open_session['client'], open_session['server'], DISCONNECT, at, open_session['vpn_ip'],
+         open_session['real_ip'], max(0, at - open_session['connected_at']), bytes_received, bytes_sent)
+    )
+    connection.execute("DELETE FROM open_sessions WHERE client = ?", (open_session['client'],))
+
+
+def record_connect(server, session, at=None):
+    """Record a client connecting to server. A session still open for it is closed first."""
+    at = _connected_at(session, at or time.time())
+    with transaction() as connection:
+        previous = connection.execute(
+            "SELECT * FROM open_sessions WHERE client = ?", (session['common_name'],)
+        ).fetchone()
+        if previous is not None:
+            if previous['server'] == server and previous['connected_at'] == at:
+                return
+            _close(connection, previous, at)
+        _open(connection, server, session, at)
+
+
+def record_disconnect(server, common_name, at=None, bytes_received=None, bytes_sent=None):
+    """Record a client disconnecting from server."""
+    at = int(at or time.time())
+    with transaction() as connection:
+        previous = connection.execute(
+            "SELECT * FROM open_sessions WHERE client = ? AND server = ?", (common_name, server)
+        ).fetchone()
+        if previous is not None:
+            _close(connection, previous, at, bytes_received, bytes_sent)
+
+
+def reconcile(server, clients, at=None):
+    """Turn a snapshot of a server's connected clients into events.
+
+    clients maps common name to session (status file or management format).
+    Clients missing from the snapshot are closed at the snapshot time, which
+    is the best bound available. Returns (connects, disconnects) counts.
+    """
+    at = int(at or time.time())
+    connects = disconnects = 0
+    with transaction() as connection:
+        open_sessions = {row['client']: row for row in connection.execute(
+            "SELECT * FROM open_sessions WHERE server = ?", (server,)
+        )}
+        for common_name, open_session in open_sessions.items():
+            if common_name not in clients:
+                _close(connection, open_session, at)
+                disconnects += 1
+
+        for common_name, session in clients.items():
+            connected_at = _connected_at(session, at)
+            previous = open_sessions.get(common_name)
+            if previous is not None:
+                # Same session unless the server reports a later connect time
+                if not session.get('connected_since_epoch') or connected_at <= previous['connected_at']:
+                    continue
+                _close(connection, previous, connected_at)
+                disconnects += 1
+            _open(connection, server, dict(session, common_name=common_name), connected_at)
+            connects += 1
+    return connects, disconnects
+
+
+def parse_time(value):
+    """Parse a query time given as epoch seconds or ISO 8601 (UTC unless it has an offset)."""
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return int(moment.timestamp())
+
+
+def _event(row):
+    event = dict(row)
+    event['kind'] = EVENT_NAMES[event['kind']]
+    return event
+
+
+def _day(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def client_history(common_name, since=None, until=None, limit=500):
+    """Events of one client in [since, until), newest first, plus a summary of the window.
+
+    Parts of the window older than the raw retention are answered from the
+    daily rollups, which are returned as well.
+    """
+    until = int(until or time.time())
+    since = int(since if since is not None else until - 86400)
+    connection = get_connection()
+    events = [_event(row) for row in connection.execute(
+        "SELECT * FROM events WHERE client = ? AND at >= ? AND at < ? ORDER BY at DESC, id DESC LIMIT ?",
+        (common_name, since, until, limit)
+    )]
+    totals = connection.execute(
+        "SELECT SUM(kind = 1), SUM(kind = 0), SUM(duration) FROM events WHERE client = ? AND at >= ? AND at < ?",
+        (common_name, since, until)
+    ).fetchone()
+    daily = [dict(row) for row in connection.execute(
+        "SELECT day, connects, disconnects, connected_seconds FROM daily "
+        "WHERE client = ? AND day >= ? AND day <= ? ORDER BY day DESC",
+        (common_name, _day(since), _day(until))
+    )]
+    current = connection.execute(
+        "SELECT server, connected_at, vpn_ip, real_ip FROM open_sessions WHERE client = ?", (common_name,)
+    ).fetchone()
+
+    return {
+        "client": common_name,
+        "since": since,
+        "until": until,
+        "summary": {
+            "connects": (totals[0] or 0) + sum(day['connects'] for day in daily),
+            "disconnects": (totals[1] or 0) + sum(day['disconnects'] for day in daily),
+            "connected_seconds": (totals[2] or 0) + sum(day['connected_seconds'] for day in daily),
+        },
+        "current_session": dict(current) if current else None,
+        "events": events,
+        "daily": daily,
+    }
+
+
+def last_disconnect(common_name):
+    row = get_connection().execute(
+        "SELECT * FROM events WHERE client = ? AND kind = ? ORDER BY at DESC, id DESC LIMIT 1",
+        (common_name, DISCONNECT)
+    ).fetchone()
+    return _event(row) if row else None
+
+
+def flapping(since=None, until=None, min_disconnects=3, limit=100):
+    """Clients with the most disconnects in [since, until), at least min_disconnects each."""
+    until = int(until or time.time())
+    since = int(since if since is not None else until - 3600)
+    rows = get_connection().execute(
+        "SELECT client, COUNT(*) AS disconnects, MAX(at) AS last_disconnect FROM events "
+        "WHERE at >= ? AND at < ? AND kind = ? GROUP BY client HAVING COUNT(*) >= ? "
+        "ORDER BY disconnects DESC, client LIMIT ?",
+        (since, until, DISCONNECT, min_disconnects, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def compact(now=None):
+    """Downsample raw events older than HISTORY_RAW_DAYS into daily rows and apply retention.
+
+    Works one day at a time so writers are never blocked for long. Returns
+    the number of raw events removed.
+    """
+    now = int(now or time.time())
+    # Roll up whole days only, so a day is never split between raw and daily rows
+    cutoff = int(datetime.datetime.strptime(_day(now - Config.HISTORY_RAW_DAYS * 86400), '%Y-%m-%d')
+                 .replace(tzinfo=datetime.timezone.utc).timestamp())
+    removed = 0
+    while True:
+        first = get_connection().execute("SELECT MIN(at) FROM events WHERE at < ?", (cutoff,)).fetchone()[0]
+        if first is None:
+            break
+        day = _day(first)
+        day_start = int(datetime.datetime.strptime(day, '%Y-%m-%d')
+                        .replace(tzinfo=datetime.timezone.utc).timestamp())
+        day_end = min(day_start + 86400, cutoff)
+        with transaction() as connection:
+            connection.execute(
+                "INSERT INTO daily (client, day, connects, disconnects, connected_seconds) "
+                "SELECT client, ?, SUM(kind = 1), SUM(kind = 0), COALESCE(SUM(duration), 0) FROM events "
+                "WHERE at >= ? AND at < ? GROUP BY client "
+                "ON CONFLICT(client, day) DO UPDATE SET connects = connects + excluded.connects, "
+                "disconnects = disconnects + excluded.disconnects, "
+                "connected_seconds = connected_seconds + excluded.connected_seconds",
+                (day, day_start, day_end)
+            )
+            removed += connection.execute(
+                "DELETE FROM events WHERE at >= ? AND at < ?", (day_start, day_end)
+            ).rowcount
+
+    get_connection().execute(
+        "DELETE FROM daily WHERE day < ?", (_day(now - Config.HISTORY_RETENTION_DAYS * 86400),)
+    )
+    return removed
@@ -0,0 +1,136 @@
+"""
+In-memory serving of hotspot login pages.
+
+Every customer device behind every router loads these pages, so each file is
+kept in memory with pre-built gzip and brotli variants and a strong ETag. The
+file is stat'ed at most once per HOTSPOT_RECHECK_INTERVAL to pick up edits, so
+a burst of captive-portal loads costs no filesystem syscalls.
+"""
+import os
+import gzip
+import time
+import hashlib
+import mimetypes
+import threading
+from config import Config
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+class HotspotAsset:
+    """One file loaded into memory with its compressed variants."""
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        self.path = path
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        self.last_modified = stat.st_mtime
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.etag = hashlib.sha256(content).hexdigest()[:32]
+        self.checked_at = time.monotonic()
+
+        self.variants = {"identity": content}
+        gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(gzipped) < len(content):
+            self.variants["gzip"] = gzipped
+        if brotli is not None:
+            compressed = brotli.compress(content, quality=11)
+            if len(compressed) < len(content):
+                self.variants["br"] = compressed
+
+    def is_current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == self.signature
+
+
+class HotspotAssetCache:
+    """Cache of hotspot assets keyed by path, revalidated against disk periodically."""
+
+    def __init__(self, recheck_interval):
+        self.recheck_interval = recheck_interval
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory, name):
+        """Return the asset for directory/name. Raises FileNotFoundError if it does not exist."""
+        path = os.path.join(directory, name)
+        asset = self._assets.get(path)
+        now = time.monotonic()
+
+        if asset is not None and now - asset.checked_at < self.recheck_interval:
+            return asset
+
+        with self._lock:
+            asset = self._assets.get(path)
+            if asset is not None and now - asset.checked_at < self.recheck_interval:
+                return asset
+            if asset is not None and asset.is_current():
+                asset.checked_at = now
+                return asset
+            try:
+                asset = HotspotAsset(path)
+            except FileNotFoundError:
+                self._assets.pop(path, None)
+                raise
+            self._assets[path] = asset
+            return asset
+
+
+ENCODING_PREFERENCE = ("br", "gzip", "identity")
+
+
+def choose_encoding(asset, accept_encodings):
+    """Pick the best variant the client accepts, preferring brotli on equal quality.
+
+    Returns None if the client accepts none of the variants.
+    """
+    # identity is acceptable unless excluded by "identity;q=0" or a "*;q=0" without identity
+    identity_listed = any(value.lower() in ("identity", "*") for value, _ in accept_encodings)
+    best = None
+    best_quality = 0
+    for encoding in ENCODING_PREFERENCE:
+        if encoding not in asset.variants:
+            continue
+        quality = accept_encodings[encoding]
+        if encoding == "identity" and not identity_listed:
+            quality = 0.001
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def asset_response(asset):
+    """Build the response for an asset, honouring Accept-Encoding and If-None-Match."""
+    from flask import request, Response
+    from werkzeug.http import http_date
+
+    encoding = choose_encoding(asset, request.accept_encodings)
+    if encoding is None:
+        return Response("No acceptable content encoding", status=406, mimetype="text/plain",
+                        headers={"Vary": "Accept-Encoding"})
+    etag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(asset.last_modified),
+        "Cache-Control": f"public, max-age={Config.HOTSPOT_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset.variants[encoding], mimetype=asset.mimetype, headers=headers)
+
+
+hotspot_assets = HotspotAssetCache(Config.HOTSPOT_RECHECK_INTERVAL)
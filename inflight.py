@@ -0,0 +1,79 @@
+"""
+In-flight provisioning registry and Idempotency-Key replay.
+
+An identity is claimed with SET NX EX before any PKI work is queued, and the
+claim holds the id of the task (or batch) doing the work. A retry of the
+same identity while that work runs gets the existing id back instead of
+starting a second issuance that would race the first in the PKI. The claim
+is dropped when the work finishes; the TTL only covers workers that die
+mid-task.
+
+Responses to requests sent with an Idempotency-Key header are stored per
+caller for PROVISION_IDEMPOTENCY_TTL and replayed on a retry with the same
+key, even after the provisioning has finished.
+"""
+import json
+from config import Config
+from redis_client import redis_client
+
+INFLIGHT_KEY = "provision:inflight:{}"
+IDEMPOTENCY_KEY = "provision:idempotency:{}:{}"
+
+
+def _encode(task_id=None, batch_id=None):
+    return f"batch:{batch_id}" if batch_id else f"task:{task_id}"
+
+
+def _decode(value):
+    kind, _, work_id = value.partition(':')
+    return {"batch_id" if kind == "batch" else "task_id": work_id}
+
+
+def current(provision_identity):
+    """The {"task_id"} or {"batch_id"} provisioning this identity, or None."""
+    value = redis_client.get(INFLIGHT_KEY.format(provision_identity))
+    return _decode(value) if value else None
+
+
+def claim(provision_identity, task_id=None, batch_id=None):
+    """Atomically mark the identity in flight. Returns None if claimed, else the existing work."""
+    key = INFLIGHT_KEY.format(provision_identity)
+    pipe = redis_client.pipeline()
+    pipe.set(key, _encode(task_id, batch_id), nx=True, ex=Config.PROVISION_INFLIGHT_TTL)
+    pipe.get(key)
+    claimed, value = pipe.execute()
+    return None if claimed else _decode(value)
+
+
+def claim_many(provision_identities, batch_id):
+    """Claim identities for a batch. Returns {identity: existing work} for those already in flight."""
+    pipe = redis_client.pipeline()
+    for provision_identity in provision_identities:
+        key = INFLIGHT_KEY.format(provision_identity)
+        pipe.set(key, _encode(batch_id=batch_id), nx=True, ex=Config.PROVISION_INFLIGHT_TTL)
+        pipe.get(key)
+    replies = pipe.execute()
+    return {provision_identity: _decode(value)
+            for provision_identity, claimed, value in zip(provision_identities, replies[::2], replies[1::2])
+            if not claimed}
+
+
+def release(*provision_identities):
+    if provision_identities:
+        redis_client.delete(*(INFLIGHT_KEY.format(identity) for identity in provision_identities))
+
+
+def replay(caller, idempotency_key):
+    """Return (payload, status code) stored for this caller's key, or None."""
+    raw = redis_client.get(IDEMPOTENCY_KEY.format(caller, idempotency_key))
+    if raw is None:
+        return None
+    stored = json.loads(raw)
+    return stored["payload"], stored["status_code"]
+
+
+def remember(caller, idempotency_key, payload, status_code):
+    """Store a response for replay. Only the first response for a key is kept."""
+    redis_client.set(IDEMPOTENCY_KEY.format(caller, idempotency_key),
+                     json.dumps({"payload": payload, "status_code": status_code}),
+                     nx=True, ex=Config.PROVISION_IDEMPOTENCY_TTL)
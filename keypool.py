@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import subprocess
+from config import Config
+
+STATS_FILE = ".stats.json"
+LOCK_FILE = ".refill.lock"
+
+
+def _pool_keys():
+    """Return paths of the ready-to-use keys currently in the pool."""
+    if not os.path.isdir(Config.KEY_POOL_DIR):
+        return []
+    return [entry.path for entry in os.scandir(Config.KEY_POOL_DIR)
+            if entry.name.endswith('.key') and not entry.name.startswith('.')]
+
+
+def depth():
+    """Number of pre-generated keys available."""
+    return len(_pool_keys())
+
+
+def claim(provision_identity, pki_dir=None):
+    """Move a pooled key into a PKI (PKI_DIR by default) as private/<provision_identity>.key.
+
+    The move is an atomic rename, so concurrent workers never hand out the same
+    key; keys are not tied to a CA, so one pool serves every server's PKI as
+    long as they share its filesystem. Returns the key path, or None if the
+    pool is empty.
+    """
+    destination = f"{pki_dir or Config.PKI_DIR}/private/{provision_identity}.key"
+    if os.path.exists(destination):
+        return None
+
+    for path in _pool_keys():
+        try:
+            os.rename(path, destination)
+            return destination
+        except FileNotFoundError:
+            # Another worker claimed this key first
+            continue
+    return None
+
+
+def release(key_path):
+    """Return a key taken by claim() to the pool, e.g. when signing its certificate failed."""
+    try:
+        os.rename(key_path, f"{Config.KEY_POOL_DIR}/{uuid.uuid4().hex}.key")
+    except FileNotFoundError:
+        pass
+
+
+def generate_key(path):
+    """Generate an unencrypted RSA private key at path."""
+    tmp_path = f"{os.path.dirname(path)}/.tmp-{uuid.uuid4().hex}.key"
+    subprocess.run([
+        "openssl", "genpkey",
+        "-algorithm", "RSA",
+        "-pkeyopt", f"rsa_keygen_bits:{Config.KEY_POOL_KEY_SIZE}",
+        "-out", tmp_path
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.chmod(tmp_path, 0o600)
+    # Only publish complete keys to claimers
+    os.rename(tmp_path, path)
+
+
+def refill(low=None, high=None):
+    """Top the pool up to the high watermark once it drops below the low one.
+
+    Only one refill runs at a time per host; concurrent calls return None.
+    """
+    low = Config.KEY_POOL_LOW_WATERMARK if low is None else low
+    high = Config.KEY_POOL_HIGH_WATERMARK if high is None else high
+    os.makedirs(Config.KEY_POOL_DIR, mode=0o700, exist_ok=True)
+
+    with open(f"{Config.KEY_POOL_DIR}/{LOCK_FILE}", 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        current = depth()
+        generated = 0
+        started = time.monotonic()
+        if current < low:
+            for _ in range(high - current):
+                generate_key(f"{Config.KEY_POOL_DIR}/{uuid.uuid4().hex}.key")
+                generated += 1
+        elapsed = time.monotonic() - started
+
+        stats = get_stats()
+        stats.update({
+            "last_refill_at": time.time(),
+            "last_refill_generated": generated,
+            "last_refill_seconds": round(elapsed, 3),
+            "total_generated": stats.get("total_generated", 0) + generated,
+        })
+        if generated:
+            stats["refill_rate_per_second"] = round(generated / elapsed, 3) if elapsed else None
+        _write_stats(stats)
+        return stats
+
+
+def get_stats():
+    """Return the persisted refill statistics."""
+    try:
+        with open(f"{Config.KEY_POOL_DIR}/{STATS_FILE}", 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_stats(stats):
+    tmp_path = f"{Config.KEY_POOL_DIR}/{STATS_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp_path, f"{Config.KEY_POOL_DIR}/{STATS_FILE}")
+
+
+def status():
+    """Pool depth, watermarks and refill statistics for monitoring."""
+    return {
+        "depth": depth(),
+        "low_watermark": Config.KEY_POOL_LOW_WATERMARK,
+        "high_watermark": Config.KEY_POOL_HIGH_WATERMARK,
+        "key_size": Config.KEY_POOL_KEY_SIZE,
+        **get_stats()
+    }
@@ -1,12 +1,21 @@
 # app.py
-import requests
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
 import os
-import subprocess
 import json
+import time
 import datetime
 import secrets
 from functools import wraps
+from management import lookup_client, lookup_clients, count_connected
+import registry
+import history
+import traffic
+from config import Config
+from helper import client_exists, generate_openvpn_config, openvpn_config_response
+from pki import get_backend, set_aside
+import servers
+from main import fanout, export
+from tasks import run_router_command, revoke_clients
 
 # In-memory user store - replace with database later
 USERS = {
@@ -20,7 +29,6 @@ USERS = {
 OPENVPN_DIR = "/etc/openvpn"
 CLIENT_DIR = f"{OPENVPN_DIR}/client"
 CA_DIR = f"{OPENVPN_DIR}/easy-rsa/pki"
-STATUS_FILE = f"/var/log/openvpn/openvpn-status.log"
 
 
 # Login required decorator
@@ -36,12 +44,25 @@ def login_required(f):
 
 
 def init(app: Flask):
+    @app.template_filter('utc_time')
+    def utc_time(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
     @app.route('/')
     @login_required
     def index():
-        clients = get_client_list()
-        connected = get_connected_clients()
-        return render_template('index.html', clients=clients, connected=connected)
+        query = request.args.get('q', '').strip()
+        after = request.args.get('after')
+        per_page = min(request.args.get('per_page', 50, type=int), 500)
+
+        clients = registry.search(query=query or None, after=after, limit=per_page)
+        connected = lookup_clients([client['name'] for client in clients])
+        total = registry.count()
+        next_after = clients[-1]['name'] if len(clients) == per_page else None
+        return render_template('index.html', clients=clients, connected=connected,
+                               total=total, connected_count=count_connected(),
+                               matching=registry.count(query) if query else total,
+                               query=query, after=after, next_after=next_after, per_page=per_page)
 
     @app.route('/login', methods=['GET', 'POST'])
     def login():
@@ -69,22 +90,94 @@ def init(app: Flask):
     @login_required
     def client_details(client_name):
         # Get client status
-        clients = get_client_list()
-        connected = get_connected_clients()
-
-        if client_name not in clients:
+        client = registry.get(client_name)
+        if client is None:
             flash('Client not found', 'danger')
             return redirect(url_for('index'))
 
+        session_info = lookup_client(client_name)
         client_data = {
             'name': client_name,
-            'created': clients[client_name].get('created', 'Unknown'),
-            'connected': client_name in connected,
-            'ip': connected.get(client_name, {}).get('vpn_ip', 'Not connected'),
-            'last_seen': connected.get(client_name, {}).get('last_seen', 'Never')
+            'created': client['created_at'],
+            'cert_serial': client['cert_serial'],
+            'expires': client['expires_at'],
+            'server': client['server'] or servers.default_server().name,
+            'revoked': bool(client['revoked']),
+            'connected': session_info is not None,
+            'ip': session_info['vpn_ip'] if session_info else 'Not connected',
+            'connected_since': session_info['connected_since'] if session_info else None,
+            'last_seen': client['last_seen'] or 'Never'
         }
+        try:
+            recent = history.client_history(client_name, since=time.time() - 7 * 86400, limit=20)
+        except Exception as e:
+            print(f"Error reading connection history: {str(e)}")
+            recent = None
+
+        return render_template('client_details.html', client=client_data, history=recent)
 
-        return render_template('client_details.html', client=client_data)
+    @app.route('/clients/<client_name>/history')
+    @login_required
+    def client_history(client_name):
+        """Connection events of one client in a time window, newest first.
+        since/until: epoch seconds or ISO 8601 (default: the last 24 hours); limit: max events
+        """
+        try:
+            since = history.parse_time(request.args.get('since'))
+            until = history.parse_time(request.args.get('until'))
+            limit = min(request.args.get('limit', 500, type=int), 5000)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid time: {str(e)}"}), 400
+        try:
+            return jsonify(history.client_history(client_name, since, until, limit)), 200
+        except Exception as e:
+            return jsonify({"error": f"Error reading connection history: {str(e)}"}), 500
+
+    @app.route('/history/flapping')
+    @login_required
+    def flapping_clients():
+        """Clients with the most disconnects in a time window.
+        since/until: epoch seconds or ISO 8601 (default: the last hour); min: fewest disconnects to list
+        """
+        try:
+            since = history.parse_time(request.args.get('since'))
+            until = history.parse_time(request.args.get('until'))
+            min_disconnects = max(request.args.get('min', 3, type=int), 1)
+            limit = min(request.args.get('limit', 100, type=int), 1000)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid time: {str(e)}"}), 400
+        try:
+            return jsonify({"clients": history.flapping(since, until, min_disconnects, limit)}), 200
+        except Exception as e:
+            return jsonify({"error": f"Error reading connection history: {str(e)}"}), 500
+
+    @app.route('/traffic/top')
+    @login_required
+    def top_talkers():
+        """Clients with the highest throughput, in bytes per second.
+        window: seconds, one of TRAFFIC_WINDOWS (default 300); direction: total, rx or tx
+        """
+        window = request.args.get('window', 300, type=int)
+        n = min(max(request.args.get('n', 20, type=int), 1), 1000)
+        direction = request.args.get('direction', 'total')
+        try:
+            return jsonify({"window": window, "direction": direction,
+                            "clients": traffic.top(window, n, direction)}), 200
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            return jsonify({"error": f"Error reading traffic: {str(e)}"}), 500
+
+    @app.route('/traffic/<client_name>')
+    @login_required
+    def client_traffic(client_name):
+        """Rate samples of one client, oldest first. window: seconds to return (default: all kept)"""
+        try:
+            window = request.args.get('window', None, type=int)
+            return jsonify({"client": client_name, "interval": Config.TRAFFIC_SAMPLE_INTERVAL,
+                            "samples": traffic.series(client_name, window)}), 200
+        except Exception as e:
+            return jsonify({"error": f"Error reading traffic: {str(e)}"}), 500
 
     @app.route('/create_client', methods=['GET', 'POST'])
     @login_required
@@ -97,13 +190,14 @@ def init(app: Flask):
                 return redirect(url_for('create_client'))
 
             # Check if client already exists
-            if os.path.exists(f"{CLIENT_DIR}/{client_name}.ovpn"):
+            if client_exists(client_name):
                 flash('Client already exists', 'danger')
                 return redirect(url_for('create_client'))
 
             try:
                 # Create client certificate and config
-                create_client_certificate(client_name)
+                server, cert_pem = create_client_certificate(client_name)
+                registry.register(client_name, cert_pem, server.name, server.pki_dir)
                 flash(f'Client {client_name} created successfully', 'success')
                 return redirect(url_for('client_details', client_name=client_name))
             except Exception as e:
@@ -116,18 +210,36 @@ def init(app: Flask):
     @login_required
     def revoke_client(client_name):
         try:
-            revoke_client_certificate(client_name)
-            flash(f'Client {client_name} revoked successfully', 'success')
+            revoke_clients([client_name])
+            flash(f'Client {client_name} queued for revocation', 'success')
         except Exception as e:
             flash(f'Error revoking client: {str(e)}', 'danger')
 
         return redirect(url_for('index'))
 
+    @app.route('/revoke', methods=['POST'])
+    @login_required
+    def revoke_many_clients():
+        """Queue many clients for revocation; they share a single CRL rebuild.
+        Body: {"names": ["client1", "client2", ...]}
+        """
+        data = request.get_json(silent=True) or {}
+        names = data.get('names')
+        if not isinstance(names, list) or not names or not all(isinstance(n, str) and n.isalnum() for n in names):
+            return jsonify({"error": "names must be a non-empty list of client names"}), 400
+        try:
+            names = list(dict.fromkeys(names))
+            revoke_clients(names)
+            return jsonify({"status": "queued", "count": len(names)}), 202
+        except Exception as e:
+            return jsonify({"error": f"Error queueing revocation: {str(e)}"}), 500
+
     @app.route('/delete/<client_name>', methods=['POST'])
     @login_required
     def delete_client(client_name):
         try:
             delete_client_files(client_name)
+            registry.remove(client_name)
             flash(f'Client {client_name} deleted successfully', 'success')
         except Exception as e:
             flash(f'Error deleting client: {str(e)}', 'danger')
@@ -137,138 +249,116 @@ def init(app: Flask):
     @app.route('/download/<client_name>')
     @login_required
     def download_config(client_name):
-        config_path = f"{CLIENT_DIR}/{client_name}.ovpn"
-
-        if not os.path.exists(config_path):
+        response = openvpn_config_response(client_name)
+        if response is None:
             flash('Client configuration not found', 'danger')
             return redirect(url_for('index'))
 
-        return send_file(config_path, as_attachment=True)
-
-
-# Helper functions
-def get_client_list():
-    clients = {}
-
-    # Check client directory
-    if os.path.exists(CLIENT_DIR):
-        for file in os.listdir(CLIENT_DIR):
-            if file.endswith('.ovpn'):
-                client_name = file.replace('.ovpn', '')
-                stat = os.stat(f"{CLIENT_DIR}/{file}")
-                clients[client_name] = {
-                    'created': datetime.datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-                    'file_size': stat.st_size
-                }
-
-    return clients
+        return response
 
-
-def get_connected_clients():
-    connected = {}
-
-    if os.path.exists(STATUS_FILE):
+    @app.route('/export')
+    @login_required
+    def export_configs():
+        """Stream an archive of client configs with a SHA256SUMS manifest.
+        format: tar.gz or zip; q: name prefix; server; revoked=1 to include revoked clients;
+        after: resume after this name; limit: most clients per archive (export.json gives the next cursor)
+        """
+        archive_format = request.args.get('format', 'tar.gz')
+        if archive_format not in export.FORMATS:
+            return jsonify({"error": f"format must be one of {', '.join(export.FORMATS)}"}), 400
+        server = request.args.get('server') or None
+        if server is not None and server not in {s.name for s in servers.all_servers()}:
+            return jsonify({"error": f"Unknown VPN server: {server}"}), 400
+
+        chunks = export.stream(
+            archive_format,
+            query=request.args.get('q', '').strip() or None,
+            after=request.args.get('after') or None,
+            server=server,
+            include_revoked=request.args.get('revoked', 'false').lower() in ('1', 'true'),
+            limit=request.args.get('limit', None, type=int)
+        )
+        return Response(stream_with_context(chunks), mimetype=export.FORMATS[archive_format], headers={
+            "Content-Disposition": f"attachment; filename={export.filename(archive_format)}",
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no"
+        })
+
+    @app.route('/routers/command', methods=['POST'])
+    @login_required
+    def router_command():
+        """Run a RouterOS command on many routers, one NDJSON result line per router.
+        Body: {"target": {"all": true} | {"prefix": "..."} | {"names": [...]},
+               "command": {"path": "/system/resource", "action": "get", "params": {}},
+               "concurrency": 64, "timeout": 15, "async": false}
+        Large targets (or async) run as a Celery task whose results are read from /routers/command/<task_id>.
+        """
         try:
-            with open(STATUS_FILE, 'r') as f:
-                lines = f.readlines()
-                client_section = False
-
-                for line in lines:
-                    if line.strip() == "ROUTING TABLE":
-                        client_section = False
-                        continue
-
-                    if client_section and line.strip() and not line.startswith('Common Name'):
-                        parts = line.strip().split(',')
-                        if len(parts) >= 3:
-                            client_name = parts[0]
-                            real_ip = parts[1]
-                            vpn_ip = parts[2].split(':')[0]
-                            connected_since = parts[3] if len(parts) > 3 else 'Unknown'
-                            connected[client_name] = {
-                                'real_ip': real_ip,
-                                'vpn_ip': vpn_ip,
-                                'last_seen': connected_since
-                            }
-
-                    if line.strip() == "CLIENT LIST":
-                        client_section = True
-        except Exception as e:
-            print(f"Error reading VPN status: {e}")
-
-    return connected
+            data = request.get_json(silent=True) or {}
+            command = fanout.parse_command(data.get('command'))
+            names = fanout.select_routers(data.get('target'))
+            concurrency = data.get('concurrency')
+            timeout = data.get('timeout')
+            if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+                raise ValueError("concurrency must be a positive integer")
+            if timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+                raise ValueError("timeout must be a positive number of seconds")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if data.get('async') or len(names) > Config.FANOUT_INLINE_MAX_ROUTERS:
+            task = run_router_command.delay(names, command, concurrency, timeout)
+            return jsonify({
+                "status": "processing",
+                "task_id": task.id,
+                "routers": len(names),
+                "results": url_for('router_command_results', task_id=task.id)
+            }), 202
+
+        return Response(stream_with_context(fanout.stream(names, command, concurrency, timeout)),
+                        mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+    @app.route('/routers/command/<task_id>')
+    @login_required
+    def router_command_results(task_id):
+        """Stream the NDJSON results of a queued router command.
+        offset: number of lines already received, to resume an interrupted read
+        """
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        return Response(stream_with_context(fanout.follow(task_id, offset)),
+                        mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
 
 
+# Helper functions
 def read_file(path):
     with open(path, 'r') as f:
         return f.read()
 
 
 def create_client_certificate(client_name):
-    os.makedirs(CLIENT_DIR, exist_ok=True)
+    """Issue a client on the least loaded VPN server. Returns (server, cert_pem)."""
+    server = servers.choose_server()
 
     # Generate client certificate and key
-    subprocess.run([
-        f"{OPENVPN_DIR}/easy-rsa/easyrsa",
-        '--batch',
-        '--days=3650',
-        "build-client-full",
-        client_name,
-        "nopass"
-    ], check=True)
-
-    # Create client config
-    server_ip = requests.get("https://api.ipify.org").text.strip()
-    common = read_file("/etc/openvpn/server/client-common.txt")
-    template = f"""{common}
-<ca>
-{open(f"{CA_DIR}/ca.crt").read()}
-</ca>
-<cert>
-{open(f"{CA_DIR}/issued/{client_name}.crt").read()}
-</cert>
-<key>
-{open(f"{CA_DIR}/private/{client_name}.key").read()}
-</key>
-
-"""
-    # < tls - crypt >
-    # {open(f"{OPENVPN_DIR}/server/tc.key").read()}
-    # < / tls - crypt >
-    with open(f"{CLIENT_DIR}/{client_name}.ovpn", "w") as f:
-        f.write(template)
-
-
-def revoke_client_certificate(client_name):
-    # Revoke the client certificate
-    subprocess.run([
-        f"{OPENVPN_DIR}/easy-rsa/easyrsa",
-        "revoke",
-        client_name
-    ], check=True)
-
-    # Update CRL
-    subprocess.run([
-        f"{OPENVPN_DIR}/easy-rsa/easyrsa",
-        "gen-crl"
-    ], check=True)
-
-    # Copy CRL to OpenVPN directory
-    subprocess.run([
-        "cp",
-        f"{CA_DIR}/crl.pem",
-        f"{OPENVPN_DIR}/crl.pem"
-    ], check=True)
-
-    # Restart OpenVPN
-    subprocess.run(["systemctl", "restart", "openvpn@server"], check=False)
-    subprocess.run(["systemctl", "restart", "openvpn"], check=False)
+    cert_pem, key_pem = get_backend(server.pki_dir).issue(client_name, days=3650)
+
+    # Create client config, unless configs are rendered on download
+    if Config.OVPN_DELIVERY == 'file':
+        if not generate_openvpn_config(client_name, f"{server.client_dir}/{client_name}.ovpn", cert_pem, key_pem,
+                                       server=server):
+            raise RuntimeError("Failed to generate client configuration")
+    return server, cert_pem
 
 
 def delete_client_files(client_name):
+    server = servers.locate(client_name)
     # Remove client config
-    if os.path.exists(f"{CLIENT_DIR}/{client_name}.ovpn"):
-        os.remove(f"{CLIENT_DIR}/{client_name}.ovpn")
-
-    # Note: This doesn't remove the certificate from PKI,
-    # it should be revoked first using revoke_client_certificate()
+    config_path = f"{server.client_dir}/{client_name}.ovpn"
+    if os.path.exists(config_path):
+        os.remove(config_path)
+
+    # In 'render' mode the config is built from the certificate and key on
+    # each download, so move them out of the PKI's issued/ and private/.
+    # Note: This doesn't revoke the certificate; revoking it before or after
+    # the delete (see tasks.revoke_clients) puts it on the CRL
+    set_aside(client_name, server.pki_dir)
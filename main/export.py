@@ -0,0 +1,181 @@
+"""
+Streaming export of client configurations as a tar.gz or zip archive.
+
+Clients are read from the registry one page at a time in name order and each
+.ovpn is compressed and yielded as soon as it is written, so memory stays the
+same for a hundred clients or a hundred thousand. Checksums go to a temporary
+file while streaming and are appended at the end:
+
+* SHA256SUMS  - `sha256sum -c` compatible, one line per config
+* export.json - filters, count and the cursor to resume from
+
+An export is resumed with after=<last name in the archive>: every member is
+complete before the next one starts, so the last config present in a cut-off
+download is a valid cursor.
+"""
+import io
+import json
+import time
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+from config import Config
+import registry
+import servers
+from helper import render_client_config
+
+FORMATS = {
+    "tar.gz": "application/gzip",
+    "zip": "application/zip",
+}
+PAGE_SIZE = 500
+
+
+class _Sink:
+    """Write-only file object collecting archive bytes until the next drain()."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class _TarWriter:
+    def __init__(self, sink):
+        self._tar = tarfile.open(fileobj=sink, mode='w|gz')
+
+    def add(self, name, content, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = mtime
+        info.mode = 0o600
+        self._tar.addfile(info, io.BytesIO(content))
+
+    def add_file(self, name, f, size, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        self._tar.addfile(info, f)
+
+    def close(self):
+        self._tar.close()
+
+
+class _ZipWriter:
+    def __init__(self, sink):
+        # Not seekable: sizes and CRCs follow each member in a data descriptor
+        self._zip = zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    def _info(self, name, mtime, mode):
+        info = zipfile.ZipInfo(name, date_time=time.gmtime(mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = mode << 16
+        return info
+
+    def add(self, name, content, mtime):
+        self._zip.writestr(self._info(name, mtime, 0o600), content)
+
+    def add_file(self, name, f, size, mtime):
+        with self._zip.open(self._info(name, mtime, 0o644), mode='w') as member:
+            for block in iter(lambda: f.read(64 * 1024), b""):
+                member.write(block)
+
+    def close(self):
+        self._zip.close()
+
+
+def _read_config(client):
+    """The client's .ovpn as bytes, or None if it has no configuration."""
+    server = servers.get_server(client['server']) if client['server'] else servers.default_server()
+    try:
+        if Config.OVPN_DELIVERY == 'file':
+            with open(f"{server.client_dir}/{client['name']}.ovpn", 'rb') as f:
+                return f.read()
+        return render_client_config(client['name'], server).encode()
+    except FileNotFoundError:
+        return None
+
+
+def iter_clients(query=None, after=None, server=None, include_revoked=False):
+    """Registry rows to export in name order, read in keyset pages."""
+    default = servers.default_server().name
+    while True:
+        page = registry.search(query=query, after=after, limit=PAGE_SIZE, include_revoked=include_revoked)
+        for client in page:
+            if server is None or (client['server'] or default) == server:
+                yield client
+        if len(page) < PAGE_SIZE:
+            return
+        after = page[-1]['name']
+
+
+def stream(archive_format="tar.gz", query=None, after=None, server=None, include_revoked=False, limit=None):
+    """Yield the bytes of an archive of the matching client configs, chunk by chunk."""
+    if archive_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if server is not None:
+        servers.get_server(server)
+
+    started = int(time.time())
+    sink = _Sink()
+    writer = _TarWriter(sink) if archive_format == "tar.gz" else _ZipWriter(sink)
+    exported = missing = 0
+    last = None
+    next_after = None
+
+    with tempfile.TemporaryFile() as checksums:
+        for client in iter_clients(query, after, server, include_revoked):
+            if limit and exported >= limit:
+                next_after = last
+                break
+            content = _read_config(client)
+            if content is None:
+                missing += 1
+                continue
+            name = f"{client['name']}.ovpn"
+            writer.add(f"configs/{name}", content, started)
+            checksums.write(f"{hashlib.sha256(content).hexdigest()}  configs/{name}\n".encode())
+            exported += 1
+            last = client['name']
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+
+        summary = json.dumps({
+            "generated_at": started,
+            "format": archive_format,
+            "filters": {"q": query, "server": server, "after": after, "include_revoked": include_revoked},
+            "count": exported,
+            "missing": missing,
+            "last": last,
+            "next_after": next_after,
+            "complete": next_after is None,
+        }, indent=2).encode()
+
+        size = checksums.tell()
+        checksums.seek(0)
+        writer.add_file("SHA256SUMS", checksums, size, started)
+        writer.add("export.json", summary, started)
+        writer.close()
+    yield sink.drain()
+
+
+def filename(archive_format):
+    return f"ovpn-export-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.{archive_format}"
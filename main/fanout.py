@@ -0,0 +1,151 @@
+"""
+Run one RouterOS command on many routers at once.
+
+Targets are all connected routers, the connected routers whose name starts
+with a prefix, or an explicit list of names. Commands run on a bounded thread
+pool through the shared router session pool, and each router's result is
+yielded as soon as it finishes so callers can stream it as an NDJSON line.
+Queued runs store their lines in a Redis list that readers can follow.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import Config
+from management import get_connected_clients
+from main.router_pool import router_pool
+from redis_client import redis_client
+
+ACTIONS = ('get', 'add', 'set', 'remove', 'call')
+RESULTS_KEY = "fanout:results:{}"
+
+
+def parse_command(data):
+    """Validate a command spec such as {"path": "/ip/hotspot", "action": "get", "params": {}}.
+    Raises ValueError if it is malformed.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("command must be an object")
+    path = data.get('path')
+    if not isinstance(path, str) or not path.startswith('/'):
+        raise ValueError("command.path must be a RouterOS menu path such as /system/resource")
+    action = data.get('action', 'get')
+    if action not in ACTIONS:
+        raise ValueError(f"command.action must be one of {', '.join(ACTIONS)}")
+    params = data.get('params') or {}
+    if not isinstance(params, dict):
+        raise ValueError("command.params must be an object")
+
+    command = {"path": path, "action": action, "params": {str(k): str(v) for k, v in params.items()}}
+    if action == 'call':
+        if not isinstance(data.get('command'), str) or not data['command']:
+            raise ValueError("command.command is required for the call action")
+        command["command"] = data['command']
+    return command
+
+
+def select_routers(target):
+    """Resolve a target selector ({"all": true}, {"prefix": "..."} or {"names": [...]}) to router names."""
+    if not isinstance(target, dict):
+        raise ValueError("target must be an object")
+    if 'names' in target:
+        names = target['names']
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError("target.names must be a list of router names")
+        return list(dict.fromkeys(names))
+    if 'prefix' in target:
+        prefix = target['prefix']
+        if not isinstance(prefix, str) or not prefix:
+            raise ValueError("target.prefix must be a non-empty string")
+        return sorted(name for name in get_connected_clients() if name.startswith(prefix))
+    if target.get('all') is True:
+        return sorted(get_connected_clients())
+    raise ValueError("target must select all, a prefix or a list of names")
+
+
+def run_command(name, command, timeout):
+    """Run the command on one router and return its result line."""
+    started = time.monotonic()
+    try:
+        with router_pool.session(name, timeout=timeout, io_timeout=timeout) as api:
+            resource = api.get_resource(command['path'])
+            if command['action'] == 'call':
+                result = resource.call(command['command'], command['params'])
+            else:
+                result = getattr(resource, command['action'])(**command['params'])
+        outcome = {"router": name, "ok": True, "result": result}
+    except Exception as e:
+        outcome = {"router": name, "ok": False, "error": str(e)}
+    outcome["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+    return outcome
+
+
+def fan_out(names, command, concurrency=None, timeout=None):
+    """Yield one result per router, in completion order.
+
+    At most `concurrency` routers are contacted at once; timeout bounds each
+    router's wait for a session and every socket operation on it. Closing the
+    generator early cancels the routers not started yet.
+    """
+    concurrency = min(concurrency or Config.FANOUT_CONCURRENCY, Config.FANOUT_MAX_CONCURRENCY)
+    timeout = timeout or Config.ROUTEROS_COMMAND_TIMEOUT
+    if not names:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(names))),
+                                  thread_name_prefix='fanout')
+    try:
+        futures = [executor.submit(run_command, name, command, timeout) for name in names]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def to_ndjson(line):
+    return json.dumps(line, default=str) + "\n"
+
+
+def summary(counts):
+    return {"done": True, "total": counts[True] + counts[False], "ok": counts[True], "failed": counts[False]}
+
+
+def stream(names, command, concurrency=None, timeout=None):
+    """NDJSON lines for a fan-out, ending with a summary line."""
+    counts = {True: 0, False: 0}
+    for outcome in fan_out(names, command, concurrency, timeout):
+        counts[outcome["ok"]] += 1
+        yield to_ndjson(outcome)
+    yield to_ndjson(summary(counts))
+
+
+def store(run_id, names, command, concurrency=None, timeout=None):
+    """Run a fan-out, appending each NDJSON line to the run's Redis list. Returns the summary."""
+    key = RESULTS_KEY.format(run_id)
+    redis_client.delete(key)
+    line = None
+    for line in stream(names, command, concurrency, timeout):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.rpush(key, line)
+        pipe.expire(key, Config.FANOUT_RESULT_TTL)
+        pipe.execute()
+    return json.loads(line)
+
+
+def follow(run_id, offset=0, timeout=None, poll_interval=0.5):
+    """Yield stored NDJSON lines from offset on until the summary line or timeout.
+
+    Callers resume an interrupted read by passing the number of lines already
+    received as offset.
+    """
+    key = RESULTS_KEY.format(run_id)
+    deadline = time.monotonic() + (timeout or Config.TASK_STREAM_MAX_SECONDS)
+    while True:
+        lines = redis_client.lrange(key, offset, -1)
+        for line in lines:
+            yield line
+            if json.loads(line).get("done"):
+                return
+        offset += len(lines)
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,153 @@
+"""
+Pool of authenticated RouterOS API sessions, keyed by router identity.
+
+Opening a session means a TCP handshake and a login over the VPN tunnel, which
+costs far more than the command itself, so sessions are kept and reused. Each
+router gets a concurrency cap; idle sessions are health-checked before reuse,
+evicted after ROUTEROS_IDLE_TIMEOUT, and dropped when the router's tunnel IP
+changes.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from config import Config
+from management import lookup_client
+
+
+class RouterUnavailable(Exception):
+    """Raised when a router is not connected to the VPN or its session slots are exhausted."""
+
+
+class RouterSession:
+    """One logged-in RouterOS API connection."""
+
+    def __init__(self, vpn_ip, io_timeout):
+        import routeros_api
+
+        self.vpn_ip = vpn_ip
+        self.connection = routeros_api.RouterOsApiPool(
+            vpn_ip,
+            username=Config.ROUTEROS_USERNAME,
+            password=Config.ROUTEROS_PASSWORD,
+            port=Config.ROUTEROS_PORT,
+            plaintext_login=Config.ROUTEROS_PLAINTEXT_LOGIN
+        )
+        self.connection.socket_timeout = io_timeout
+        self.api = self.connection.get_api()
+        self.last_used = time.monotonic()
+
+    def is_healthy(self):
+        try:
+            self.api.get_resource('/system/identity').get()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.connection.disconnect()
+        except Exception:
+            pass
+
+
+class RouterPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._last_sweep = time.monotonic()
+
+    def _slot(self, identity):
+        with self._lock:
+            slot = self._slots.get(identity)
+            if slot is None:
+                slot = self._slots[identity] = threading.BoundedSemaphore(Config.ROUTEROS_MAX_SESSIONS_PER_ROUTER)
+            return slot
+
+    def _take_idle(self, identity, vpn_ip):
+        """Pop a reusable idle session, closing any that point at an old tunnel IP."""
+        stale = []
+        session = None
+        with self._lock:
+            idle = self._idle.get(identity, [])
+            while idle:
+                candidate = idle.pop()
+                if candidate.vpn_ip == vpn_ip:
+                    session = candidate
+                    break
+                stale.append(candidate)
+        for old in stale:
+            old.close()
+        return session
+
+    def _release(self, identity, session):
+        session.last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(identity, []).append(session)
+
+    def sweep(self):
+        """Close sessions idle for longer than ROUTEROS_IDLE_TIMEOUT."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._last_sweep = now
+            for identity, idle in list(self._idle.items()):
+                keep = [s for s in idle if now - s.last_used < Config.ROUTEROS_IDLE_TIMEOUT]
+                expired.extend(s for s in idle if now - s.last_used >= Config.ROUTEROS_IDLE_TIMEOUT)
+                if keep:
+                    self._idle[identity] = keep
+                else:
+                    del self._idle[identity]
+        for session in expired:
+            session.close()
+
+    @contextmanager
+    def session(self, identity, timeout=None, io_timeout=None):
+        """Yield a RouterOS API for the router, reusing an authenticated session when possible.
+
+        timeout bounds the wait for a free session slot, io_timeout every
+        socket operation (connect, login and the command itself).
+        """
+        if time.monotonic() - self._last_sweep > Config.ROUTEROS_IDLE_TIMEOUT / 4:
+            self.sweep()
+
+        client = lookup_client(identity)
+        if client is None or not client.get('vpn_ip'):
+            raise RouterUnavailable(f"{identity} is not connected to the VPN")
+        vpn_ip = client['vpn_ip']
+
+        slot = self._slot(identity)
+        timeout = Config.ROUTEROS_ACQUIRE_TIMEOUT if timeout is None else timeout
+        io_timeout = io_timeout or Config.ROUTEROS_COMMAND_TIMEOUT
+        if not slot.acquire(timeout=timeout):
+            raise RouterUnavailable(f"All sessions to {identity} are busy")
+        try:
+            session = self._take_idle(identity, vpn_ip)
+            if session is not None and time.monotonic() - session.last_used > Config.ROUTEROS_HEALTHCHECK_AFTER:
+                if not session.is_healthy():
+                    session.close()
+                    session = None
+            if session is None:
+                session = RouterSession(vpn_ip, io_timeout)
+            elif session.connection.socket_timeout != io_timeout:
+                session.connection.set_timeout(io_timeout)
+
+            try:
+                yield session.api
+            except Exception:
+                # The connection may be half-read or dead; never hand it out again
+                session.close()
+                raise
+            self._release(identity, session)
+        finally:
+            slot.release()
+
+    def close_all(self):
+        with self._lock:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+router_pool = RouterPool()
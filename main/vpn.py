@@ -1,64 +1,23 @@
-def get_vpn_clients():
-    """Get list of connected OpenVPN clients and their virtual IPs"""
-    # Read from OpenVPN status file
-    status_file = "/etc/openvpn/openvpn-status.log"
-    clients = {}
-
-    try:
-        with open(status_file, 'r') as f:
-            lines = f.readlines()
-            client_section = False
-
-            for line in lines:
-                if line.strip() == "ROUTING TABLE":
-                    client_section = False
-                    continue
-
-                if client_section and line.strip() and not line.startswith('Common Name'):
-                    parts = line.strip().split(',')
-                    if len(parts) >= 3:
-                        common_name = parts[0]
-                        real_ip = parts[1]
-                        vpn_ip = parts[2].split(':')[0]
-                        clients[common_name] = {
-                            'real_ip': real_ip,
-                            'vpn_ip': vpn_ip
-                        }
-
-                if line.strip() == "CLIENT LIST":
-                    client_section = True
-    except Exception as e:
-        print(f"Error reading VPN status: {e}")
-
-    return clients
+from management import get_connected_clients
+from main.router_pool import router_pool, RouterUnavailable
 
 
-def communicate_with_mikrotik(client_name):
-    """Send commands to a specific Mikrotik router"""
-    clients = get_vpn_clients()
+def get_vpn_clients():
+    """Get list of connected OpenVPN clients and their virtual IPs"""
+    return get_connected_clients()
 
-    if client_name not in clients:
-        return {"error": "Client not connected to VPN"}
 
-    vpn_ip = clients[client_name]['vpn_ip']
+def communicate_with_mikrotik(client_name, path='/system/resource'):
+    """Send commands to a specific Mikrotik router
 
-    # Use RouterOS API to communicate with the Mikrotik
-    # Example using librouteros
+    Reuses a pooled, already authenticated RouterOS API session when one is
+    available for the router.
+    """
     try:
-        import routeros_api
-        connection = routeros_api.RouterOsApiPool(
-            vpn_ip,
-            username='admin',
-            password='password',
-            port=8728
-        )
-        api = connection.get_api()
-
-        # Example: Get system resource info
-        resource = api.get_resource('/system/resource')
-        return resource.get()
+        with router_pool.session(client_name) as api:
+            # Example: Get system resource info
+            return api.get_resource(path).get()
+    except RouterUnavailable as e:
+        return {"error": str(e)}
     except Exception as e:
         return {"error": f"Failed to communicate with router: {e}"}
-    finally:
-        if 'connection' in locals():
-            connection.disconnect()
\ No newline at end of file
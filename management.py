@@ -0,0 +1,515 @@
+"""
+Event driven view of the OpenVPN management interface.
+
+A single monitor process (`python management.py`) holds the management
+connection, subscribes to real-time >CLIENT notifications and mirrors the
+connected-client table into Redis. OpenVPN only sends connect and disconnect
+notifications with `management-client-auth` (VPN_MANAGEMENT_CLIENT_AUTH=true,
+the monitor then approves every client); without it the table is refreshed
+by polling `status 3` every VPN_MANAGEMENT_POLL_INTERVAL seconds. Every gunicorn worker and Celery task then
+answers "is router X online / what is its IP" with one Redis round trip, and
+sends management commands (e.g. `kill`) through a Redis command queue, since
+OpenVPN only accepts one management client at a time.
+
+With several OpenVPN servers (servers.py) the monitor process holds one
+connection per server and each server gets its own table and command queue.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import deque
+import redis
+import redis.asyncio as aioredis
+from config import Config
+from redis_client import redis_client as shared_redis
+from status_log import parse_status
+import registry
+import history
+import traffic
+import servers
+
+CLIENTS_KEY = "vpn:clients"
+ROUTES_KEY = "vpn:routes"
+ALIVE_KEY = "vpn:clients:alive"
+COMMAND_QUEUE = "vpn:mgmt:commands"
+REPLY_KEY = "vpn:mgmt:reply:{}"
+
+HEARTBEAT_INTERVAL = 5
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+class ManagementError(Exception):
+    """Raised when the management interface rejects a command or is unreachable."""
+
+
+class LiveTableUnavailable(Exception):
+    """Raised when no monitor is currently keeping the live client table up to date."""
+
+
+class ManagementClient:
+    """Asyncio client for the OpenVPN management interface.
+
+    Commands are pipelined: OpenVPN answers them strictly in order, so each
+    command only queues a future and the reader resolves them FIFO, while
+    >NOTIFICATION lines are dispatched to `on_client_event` as they arrive.
+    """
+
+    def __init__(self, host, port, password=None, on_client_event=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.on_client_event = on_client_event
+        self._reader = None
+        self._writer = None
+        self._pending = deque()
+        self._client_event = None
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self, timeout=10):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout
+        )
+        if self.password:
+            self._writer.write(f"{self.password}\n".encode())
+            await self._writer.drain()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._writer = None
+        self._fail_pending(ManagementError("Management connection closed"))
+
+    async def command(self, command, timeout=10):
+        """Send a command and return its response lines (without the trailing END)."""
+        if not self.connected:
+            raise ManagementError("Not connected to the management interface")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((future, []))
+        self._writer.write(f"{command}\n".encode())
+        await self._writer.drain()
+        lines = await asyncio.wait_for(future, timeout)
+        if len(lines) == 1 and lines[0].startswith("ERROR:"):
+            raise ManagementError(lines[0])
+        return lines
+
+    async def read_loop(self):
+        """Read until the connection drops, routing responses and notifications."""
+        try:
+            while True:
+                raw = await self._reader.readline()
+                if not raw:
+                    break
+                line = raw.decode(errors='replace').rstrip('\r\n')
+                if line.startswith(">"):
+                    await self._handle_notification(line[1:])
+                elif line.startswith("ENTER PASSWORD:"):
+                    continue
+                else:
+                    self._handle_response(line)
+        finally:
+            await self.close()
+
+    def _handle_response(self, line):
+        if not self._pending:
+            return
+        future, buffer = self._pending[0]
+        if not buffer and (line.startswith("SUCCESS:") or line.startswith("ERROR:")):
+            self._pending.popleft()
+            if not future.done():
+                future.set_result([line])
+        elif line == "END":
+            self._pending.popleft()
+            if not future.done():
+                future.set_result(buffer)
+        else:
+            buffer.append(line)
+
+    def _fail_pending(self, error):
+        while self._pending:
+            future, _ = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def _handle_notification(self, notification):
+        kind, _, payload = notification.partition(":")
+        if kind != "CLIENT":
+            return
+
+        event, _, args = payload.partition(",")
+        if event == "ENV":
+            if self._client_event is None:
+                return
+            if args == "END":
+                name, cid, kid, env = self._client_event
+                self._client_event = None
+                await self._dispatch_client_event(name, cid, kid, env)
+            else:
+                key, _, value = args.partition("=")
+                self._client_event[3][key] = value
+            return
+
+        if event == "ADDRESS":
+            # Single line notification, no ENV block follows
+            return
+
+        ids = args.split(",")
+        cid = ids[0]
+        kid = ids[1] if len(ids) > 1 else None
+        self._client_event = (event, cid, kid, {})
+
+    async def _dispatch_client_event(self, event, cid, kid, env):
+        if event in ("CONNECT", "REAUTH") and Config.VPN_MANAGEMENT_CLIENT_AUTH:
+            # With --management-client-auth every connection waits for our verdict
+            self._pending.append((asyncio.get_running_loop().create_future(), []))
+            self._writer.write(f"client-auth-nt {cid} {kid}\n".encode())
+            await self._writer.drain()
+        if self.on_client_event is not None:
+            await self.on_client_event(event, cid, env)
+
+
+def session_from_env(cid, env):
+    """Build a session dict (same shape as status_log sessions) from a >CLIENT ENV block."""
+    connected_since = env.get("time_ascii", "")
+    return {
+        'common_name': env.get("common_name"),
+        'real_ip': env.get("trusted_ip") or env.get("untrusted_ip"),
+        'vpn_ip': env.get("ifconfig_pool_remote_ip") or None,
+        'bytes_received': int(env.get("bytes_received", 0) or 0),
+        'bytes_sent': int(env.get("bytes_sent", 0) or 0),
+        'connected_since': connected_since,
+        'connected_since_epoch': int(env.get("time_unix", 0) or 0),
+        'last_seen': connected_since,
+        'client_id': cid,
+    }
+
+
+class ConnectionMonitor:
+    """Keeps a server's Redis client table in sync with its management interface."""
+
+    def __init__(self, server=None, client=None, redis_client=None):
+        self.server = server or servers.default_server()
+        self.clients_key = self.server.key(CLIENTS_KEY)
+        self.routes_key = self.server.key(ROUTES_KEY)
+        self.alive_key = self.server.key(ALIVE_KEY)
+        self.command_queue = self.server.key(COMMAND_QUEUE)
+        self.redis = redis_client or aioredis.Redis(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            db=Config.REDIS_DB,
+            password=Config.REDIS_PASSWORD,
+            decode_responses=True
+        )
+        self.client = client or ManagementClient(
+            self.server.management_host,
+            self.server.management_port,
+            self.server.management_password,
+        )
+        self.client.on_client_event = self.on_client_event
+
+    async def resync(self, quiet=False):
+        """Replace the whole table with a fresh `status 3` snapshot."""
+        lines = await self.client.command("status 3")
+        clients, routes = parse_status("\n".join(lines))
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(self.clients_key, self.routes_key)
+        if clients:
+            pipe.hset(self.clients_key, mapping={cn: json.dumps(s) for cn, s in clients.items()})
+        if routes:
+            pipe.hset(self.routes_key, mapping=routes)
+        await pipe.execute()
+        await self._touch(list(clients))
+        await self._record(history.reconcile, self.server.name, clients)
+        if not quiet:
+                print(f"Synchronised {len(clients)} connected clients from management interface of {self.server.name}")
+
+    async def on_client_event(self, event, cid, env):
+        common_name = env.get("common_name")
+        if not common_name:
+            return
+
+        if event == "ESTABLISHED":
+            session = session_from_env(cid, env)
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hset(self.clients_key, common_name, json.dumps(session))
+            if session['vpn_ip']:
+                pipe.hset(self.routes_key, session['vpn_ip'], common_name)
+            await pipe.execute()
+            await self._touch([common_name])
+            await self._record(history.record_connect, self.server.name, session)
+
+        elif event == "DISCONNECT":
+            stored = await self.redis.hget(self.clients_key, common_name)
+            if stored is None:
+                return
+            session = json.loads(stored)
+            # A reconnect under the same name may already have replaced this session
+            if str(session.get('client_id')) != str(cid):
+                return
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.hdel(self.clients_key, common_name)
+            if session.get('vpn_ip'):
+                pipe.hdel(self.routes_key, session['vpn_ip'])
+            await pipe.execute()
+            await self._touch([common_name])
+            await self._record(history.record_disconnect, self.server.name, common_name, None,
+                               int(env.get("bytes_received", 0) or 0), int(env.get("bytes_sent", 0) or 0))
+
+    async def _touch(self, common_names):
+        """Update last-seen times in the client registry without blocking the event loop."""
+        try:
+            await asyncio.to_thread(registry.touch, common_names)
+        except Exception as e:
+            print(f"Error updating client registry: {e}")
+
+    async def _record(self, function, *args):
+        """Write to the connection history or traffic accounting without blocking the event loop."""
+        try:
+            await asyncio.to_thread(function, *args)
+        except Exception as e:
+            print(f"Error recording {function.__module__}.{function.__name__}: {e}")
+
+    async def _heartbeat(self):
+        if Config.VPN_MANAGEMENT_CLIENT_AUTH:
+            interval = Config.VPN_MANAGEMENT_RESYNC_INTERVAL
+        else:
+            # No connect/disconnect notifications arrive, polling is the only source of changes
+            interval = Config.VPN_MANAGEMENT_POLL_INTERVAL
+        step = min(HEARTBEAT_INTERVAL, interval)
+        elapsed = 0
+        while self.client.connected:
+            await self.redis.set(self.alive_key, str(int(time.time())), ex=HEARTBEAT_INTERVAL * 3)
+            await asyncio.sleep(step)
+            elapsed += step
+            if elapsed >= interval:
+                elapsed = 0
+                await self.resync(quiet=not Config.VPN_MANAGEMENT_CLIENT_AUTH)
+
+    async def _sample_traffic(self):
+        """Feed the byte counters of all connected clients to traffic accounting."""
+        while self.client.connected:
+            await asyncio.sleep(Config.TRAFFIC_SAMPLE_INTERVAL)
+            lines = await self.client.command("status 3")
+            clients, _ = parse_status("\n".join(lines))
+            await self._record(traffic.record, clients)
+
+    async def _serve_commands(self):
+        """Execute commands queued by other processes through send_command()."""
+        while self.client.connected:
+            item = await self.redis.blpop(self.command_queue, timeout=1)
+            if item is None:
+                continue
+            request = json.loads(item[1])
+            try:
+                lines = await self.client.command(request['command'])
+                reply = {"ok": True, "lines": lines}
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            reply_key = REPLY_KEY.format(request['id'])
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.rpush(reply_key, json.dumps(reply))
+            pipe.expire(reply_key, 60)
+            await pipe.execute()
+
+    async def run(self):
+        """Connect, sync and follow events forever, reconnecting with backoff."""
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            tasks = []
+            try:
+                print(f"Connecting to OpenVPN management of {self.server.name} at {self.client.host}:{self.client.port}")
+                await self.client.connect()
+                tasks.append(asyncio.create_task(self.client.read_loop(), name="reader"))
+                await self.resync()
+                delay = RECONNECT_MIN_DELAY
+                tasks.append(asyncio.create_task(self._heartbeat(), name="heartbeat"))
+                tasks.append(asyncio.create_task(self._serve_commands(), name="command server"))
+                tasks.append(asyncio.create_task(self._sample_traffic(), name="traffic sampler"))
+                # The connection is only as good as all of its loops: if one stops, reconnect
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is not None:
+                        print(f"Management {task.get_name()} of {self.server.name} failed: "
+                              f"{type(error).__name__}: {error}")
+                    else:
+                        print(f"Management {task.get_name()} of {self.server.name} stopped")
+            except Exception as e:
+                print(f"Management connection to {self.server.name} failed: {type(e).__name__}: {e}")
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await self.client.close()
+                await self.redis.delete(self.alive_key)
+
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+class LiveClientTable:
+    """Synchronous reader of the client table maintained by a server's ConnectionMonitor.
+    Without a server it reads the default server's table.
+    """
+
+    def __init__(self, server=None, redis_client=None):
+        self.server = server
+        key = server.key if server is not None else (lambda base: base)
+        self.clients_key = key(CLIENTS_KEY)
+        self.routes_key = key(ROUTES_KEY)
+        self.alive_key = key(ALIVE_KEY)
+        self.command_queue = key(COMMAND_QUEUE)
+        self.redis = redis_client or shared_redis
+
+    def _fetch(self, command, *args):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.exists(self.alive_key)
+            getattr(pipe, command)(*args)
+            alive, value = pipe.execute()
+        except redis.RedisError as e:
+            raise LiveTableUnavailable(str(e))
+        if not alive:
+            raise LiveTableUnavailable("No management monitor is running")
+        return value
+
+    def get(self, common_name):
+        stored = self._fetch("hget", self.clients_key, common_name)
+        return json.loads(stored) if stored else None
+
+    def clients(self):
+        stored = self._fetch("hgetall", self.clients_key)
+        return {cn: json.loads(s) for cn, s in stored.items()}
+
+    def get_many(self, common_names):
+        if not common_names:
+            return {}
+        stored = self._fetch("hmget", self.clients_key, list(common_names))
+        return {cn: json.loads(s) for cn, s in zip(common_names, stored) if s}
+
+    def count(self):
+        return self._fetch("hlen", self.clients_key)
+
+    def common_name_for(self, virtual_address):
+        return self._fetch("hget", self.routes_key, virtual_address)
+
+
+live_clients = LiveClientTable()
+_live_tables = {}
+
+
+def live_table(server):
+    """Return the live client table of a server, sharing one Redis pool between servers."""
+    if server.name == servers.DEFAULT_SERVER:
+        return live_clients
+    table = _live_tables.get(server.name)
+    if table is None:
+        table = _live_tables.setdefault(server.name, LiveClientTable(server, live_clients.redis))
+    return table
+
+
+def lookup_client(common_name):
+    """Return a connected client's session from its server, preferring the live table over the status file."""
+    server = servers.locate(common_name)
+    try:
+        return live_table(server).get(common_name)
+    except LiveTableUnavailable:
+        return server.status_log.get(common_name)
+
+
+def lookup_clients(common_names):
+    """Return sessions for the connected subset of common_names, across all servers."""
+    sessions = {}
+    for server, names in servers.group_by_server(common_names).items():
+        try:
+            sessions.update(live_table(server).get_many(names))
+            continue
+        except LiveTableUnavailable:
+            pass
+        try:
+            clients = server.status_log.clients()
+        except Exception as e:
+            print(f"Error reading VPN status of {server.name}: {e}")
+            continue
+        sessions.update((cn, clients[cn]) for cn in names if cn in clients)
+    return sessions
+
+
+def count_connected(server=None):
+    """Return the number of connected clients of one server, or of all servers."""
+    if server is None:
+        return sum(count_connected(server) for server in servers.all_servers())
+    try:
+        return live_table(server).count()
+    except LiveTableUnavailable:
+        pass
+    try:
+        return len(server.status_log)
+    except Exception as e:
+        print(f"Error reading VPN status of {server.name}: {e}")
+        return 0
+
+
+def get_connected_clients(server=None):
+    """Return connected clients of one server or all servers, from the live table or the status file."""
+    if server is None:
+        clients = {}
+        for server in servers.all_servers():
+            clients.update(get_connected_clients(server))
+        return clients
+    try:
+        return live_table(server).clients()
+    except LiveTableUnavailable:
+        pass
+    try:
+        return server.status_log.clients()
+    except Exception as e:
+        print(f"Error reading VPN status of {server.name}: {e}")
+        return {}
+
+
+def send_command(command, timeout=10, server=None):
+    """Run a management command through the monitor process and return its output lines.
+    server: the OpenVPN server to send it to, the default one if not given.
+    """
+    table = live_table(server or servers.default_server())
+    request_id = uuid.uuid4().hex
+    client = table.redis
+    if not client.exists(table.alive_key):
+        raise ManagementError("No management monitor is running")
+    client.rpush(table.command_queue, json.dumps({"id": request_id, "command": command}))
+    item = client.blpop(REPLY_KEY.format(request_id), timeout=timeout)
+    if item is None:
+        raise ManagementError(f"Timed out waiting for '{command}'")
+    reply = json.loads(item[1])
+    if not reply['ok']:
+        raise ManagementError(reply['error'])
+    return reply['lines']
+
+
+async def monitor(selected):
+    """Follow the management interfaces of the given servers over one shared Redis connection pool."""
+    redis_client = aioredis.Redis(
+        host=Config.REDIS_HOST,
+        port=Config.REDIS_PORT,
+        db=Config.REDIS_DB,
+        password=Config.REDIS_PASSWORD,
+        decode_responses=True
+    )
+    await asyncio.gather(*(ConnectionMonitor(server, redis_client=redis_client).run() for server in selected))
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python management.py [server ...]: all servers of the inventory by default
+    names = sys.argv[1:]
+    asyncio.run(monitor([servers.get_server(name) for name in names] if names else servers.all_servers()))
@@ -0,0 +1,143 @@
+"""
+Prometheus metrics shared by the web app and the Celery workers.
+
+Gunicorn and Celery both fork several processes, so when
+PROMETHEUS_MULTIPROC_DIR is set every process writes its samples to files in
+that directory and a scrape aggregates them with MultiProcessCollector. The
+variable must be set before prometheus_client is first imported, which
+gunicorn_config.py does for the web app and docker-compose does for the
+workers. Without it metrics are per-process, which is fine for development.
+
+Gauges (connected clients, registry size, queue depth, key pool depth) are
+not recorded by any process: they are read live when /metrics is scraped.
+"""
+import os
+import glob
+import time
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+# Metrics without labels open their file on import, so the directory must exist first
+if multiprocess_dir():
+    os.makedirs(multiprocess_dir(), exist_ok=True)
+
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+)
+from prometheus_client.core import GaugeMetricFamily
+
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUEST_COUNT = Counter(
+    'http_requests_total', 'HTTP requests handled', ['method', 'endpoint', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to build an HTTP response', ['method', 'endpoint']
+)
+TASK_DURATION = Histogram(
+    'celery_task_duration_seconds', 'Celery task run time', ['task', 'state'], buckets=SLOW_BUCKETS
+)
+TASK_QUEUE_WAIT = Histogram(
+    'celery_task_queue_wait_seconds', 'Time from publishing a task to a worker starting it', ['task'],
+    buckets=SLOW_BUCKETS
+)
+PKI_OPERATION_DURATION = Histogram(
+    'pki_operation_duration_seconds', 'Certificate issuance, revocation and CRL generation time',
+    ['backend', 'operation'], buckets=SLOW_BUCKETS
+)
+PKI_LOCK_WAIT = Histogram(
+    'pki_lock_wait_seconds', 'Time spent waiting for the PKI lock', buckets=SLOW_BUCKETS
+)
+STATUS_PARSE_DURATION = Histogram(
+    'openvpn_status_parse_seconds', 'Time to parse an OpenVPN status listing'
+)
+
+
+def reset_multiprocess_dir():
+    """Remove samples left by previous runs; call once in the parent before forking workers."""
+    path = multiprocess_dir()
+    if path:
+        for filename in glob.glob(os.path.join(path, '*.db')):
+            if not filename.endswith(f"_{os.getpid()}.db"):
+                os.remove(filename)
+
+
+def mark_process_dead(pid):
+    """Drop a dead child's live gauges from the multiprocess directory."""
+    if multiprocess_dir():
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+class LiveGaugeCollector:
+    """Gauges read from their source of truth at scrape time."""
+
+    def collect(self):
+        from management import count_connected
+        from admission import queue_depth
+        import registry
+        import keypool
+
+        readings = (
+            ('openvpn_connected_clients', 'Clients currently connected to the VPN', count_connected),
+            ('client_registry_size', 'Clients in the client registry', registry.count),
+            ('celery_queue_depth', 'Identities queued or being issued for provisioning', queue_depth),
+            ('key_pool_depth', 'Pre-generated private keys available', keypool.depth),
+        )
+        for name, documentation, read in readings:
+            try:
+                yield GaugeMetricFamily(name, documentation, value=read())
+            except Exception as e:
+                print(f"Failed to read {name}: {str(e)}")
+
+
+def scrape_registry():
+    """Registry to serve on /metrics: every process's samples plus the live gauges."""
+    if multiprocess_dir():
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return registry
+
+
+_live_gauges = LiveGaugeCollector()
+_web_registry = None
+
+
+def metrics_response():
+    """Flask response with the current metrics in the Prometheus text format."""
+    from flask import Response
+
+    global _web_registry
+    if _web_registry is None:
+        _web_registry = scrape_registry()
+        _web_registry.register(_live_gauges)
+    return Response(generate_latest(_web_registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def start_exporter(port):
+    """Serve worker-side metrics over HTTP, for processes without a web app (Celery)."""
+    start_http_server(port, registry=scrape_registry())
+
+
+def instrument_app(app):
+    """Count and time every request by method and route template."""
+    from flask import request, g
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            endpoint = request.url_rule.rule if request.url_rule else '<unmatched>'
+            REQUEST_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - started)
+            REQUEST_COUNT.labels(request.method, endpoint, str(response.status_code)).inc()
+        return response
@@ -0,0 +1,400 @@
+"""
+Client certificate issuance backends.
+
+`cryptography` signs client certificates in-process with a CA key loaded once
+per worker; `easyrsa` shells out to easy-rsa as before. Both write the same
+easy-rsa PKI layout (issued/, private/, certs_by_serial/, index.txt, serial),
+so easyrsa revoke/gen-crl and other tooling keep working on either. Both
+can also revoke a batch of clients and rebuild the CRL once for all of them.
+Each backend instance works on one PKI directory (one per VPN server).
+"""
+import os
+import glob
+import time
+import fcntl
+import datetime
+import subprocess
+import threading
+from contextlib import contextmanager
+from config import Config
+from metrics import PKI_OPERATION_DURATION, PKI_LOCK_WAIT
+import keypool
+
+LOCK_FILE = ".pki.lock"
+
+
+class PKILockTimeout(Exception):
+    """Raised when the PKI lock could not be acquired in time."""
+
+
+@contextmanager
+def pki_lock(timeout=None, pki_dir=None):
+    """Critical section around a PKI's index.txt/serial updates, shared by all processes on the host.
+
+    Uses flock on a file inside the PKI, so the kernel releases the lock as soon
+    as a holder exits or crashes: a dead worker can never leave it stale. The
+    holder's pid and acquisition time are written to the file for diagnostics.
+    """
+    timeout = Config.PKI_LOCK_TIMEOUT if timeout is None else timeout
+    fd = os.open(f"{pki_dir or Config.PKI_DIR}/{LOCK_FILE}", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    holder = os.pread(fd, 64, 0).decode(errors='replace').strip()
+                    raise PKILockTimeout(f"PKI lock not acquired within {timeout}s (holder: {holder or 'unknown'})")
+                time.sleep(0.01)
+        PKI_LOCK_WAIT.observe(time.monotonic() - started)
+
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, f"{os.getpid()} {time.time():.0f}\n".encode(), 0)
+        yield
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+class EasyRsaBackend:
+    """Issue certificates by running easyrsa (one openssl fork per step)."""
+
+    name = "easyrsa"
+
+    def __init__(self, pki_dir=None):
+        self.pki_dir = pki_dir or Config.PKI_DIR
+
+    @PKI_OPERATION_DURATION.labels(name, 'issue').time()
+    def issue(self, provision_identity, key_path=None, days=None):
+        """Issue a client certificate, reusing the private key at key_path if given."""
+        options = [Config.EASYRSA_PATH, f"--pki-dir={self.pki_dir}", "--batch"]
+        if days:
+            options.append(f"--days={days}")
+
+        req_path = f"{self.pki_dir}/reqs/{provision_identity}.req"
+        try:
+            if key_path is None:
+                # Key generation needs no lock, only signing touches index.txt/serial
+                subprocess.run(options + ["gen-req", provision_identity, "nopass"], check=True)
+            else:
+                subprocess.run([
+                    "openssl", "req", "-new", "-batch",
+                    "-key", key_path,
+                    "-subj", f"/CN={provision_identity}",
+                    "-out", req_path
+                ], check=True)
+            with pki_lock(pki_dir=self.pki_dir):
+                subprocess.run(options + ["sign-req", "client", provision_identity], check=True)
+        except subprocess.CalledProcessError:
+            # Give a claimed pool key back as if nothing happened so a retry can start over
+            if key_path is not None:
+                if os.path.exists(req_path):
+                    os.remove(req_path)
+                keypool.release(key_path)
+            raise
+        return None, None
+
+    @PKI_OPERATION_DURATION.labels(name, 'revoke').time()
+    def revoke(self, provision_identities):
+        """Revoke clients without touching the CRL. Returns (revoked, missing) names.
+        Callers must hold pki_lock().
+        """
+        revoked, missing = [], []
+        for provision_identity in provision_identities:
+            cert_path = f"{self.pki_dir}/issued/{provision_identity}.crt"
+            set_aside_path = None
+            if not os.path.exists(cert_path):
+                # A deleted client (see set_aside) is still valid in index.txt, but
+                # easyrsa only revokes from issued/: put its certificate back for the revoke
+                set_aside_path = set_aside_certificate(provision_identity, self.pki_dir)
+                if set_aside_path is None:
+                    missing.append(provision_identity)
+                    continue
+                os.replace(set_aside_path, cert_path)
+            try:
+                subprocess.run([Config.EASYRSA_PATH, f"--pki-dir={self.pki_dir}", "--batch",
+                                "revoke", provision_identity], check=True)
+            except subprocess.CalledProcessError:
+                if set_aside_path is not None and os.path.exists(cert_path):
+                    os.replace(cert_path, set_aside_path)
+                raise
+            revoked.append(provision_identity)
+        return revoked, missing
+
+    @PKI_OPERATION_DURATION.labels(name, 'gen_crl').time()
+    def gen_crl(self):
+        """Rebuild crl.pem in this PKI. Callers must hold pki_lock()."""
+        subprocess.run([Config.EASYRSA_PATH, f"--pki-dir={self.pki_dir}", "--batch", "gen-crl"], check=True)
+        return f"{self.pki_dir}/crl.pem"
+
+
+class CryptographyBackend:
+    """Issue certificates in-process with the `cryptography` library.
+
+    The CA certificate and key are loaded on first use and kept for the life of
+    the worker; restart workers after rotating the CA.
+    """
+
+    name = "cryptography"
+
+    def __init__(self, pki_dir=None):
+        self.pki_dir = pki_dir or Config.PKI_DIR
+        self._ca_lock = threading.Lock()
+        self._ca = None
+
+    def _load_ca(self):
+        if self._ca is None:
+            from cryptography import x509
+            from cryptography.hazmat.primitives import serialization
+
+            with self._ca_lock:
+                if self._ca is None:
+                    with open(f"{self.pki_dir}/ca.crt", 'rb') as f:
+                        ca_cert = x509.load_pem_x509_certificate(f.read())
+                    with open(f"{self.pki_dir}/private/ca.key", 'rb') as f:
+                        passphrase = Config.PKI_CA_PASSPHRASE.encode() if Config.PKI_CA_PASSPHRASE else None
+                        ca_key = serialization.load_pem_private_key(f.read(), password=passphrase)
+                    self._ca = (ca_cert, ca_key)
+        return self._ca
+
+    @PKI_OPERATION_DURATION.labels(name, 'issue').time()
+    def issue(self, provision_identity, key_path=None, days=None):
+        """Issue a client certificate and return (cert_pem, key_pem) as text."""
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        cert_path = f"{self.pki_dir}/issued/{provision_identity}.crt"
+        claimed_key_path = key_path
+        written = []  # removed if issuance fails
+        try:
+            if os.path.exists(cert_path):
+                raise FileExistsError(f"Certificate for {provision_identity} already exists")
+
+            ca_cert, ca_key = self._load_ca()
+
+            if key_path is None:
+                key = rsa.generate_private_key(public_exponent=65537, key_size=Config.PKI_KEY_SIZE)
+                key_pem = key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption()
+                )
+            else:
+                with open(key_path, 'rb') as f:
+                    key_pem = f.read()
+                key = serialization.load_pem_private_key(key_pem, password=None)
+
+            now = datetime.datetime.utcnow()
+            not_after = now + datetime.timedelta(days=days or Config.PKI_CERT_DAYS)
+            serial = x509.random_serial_number()
+            ca_ski = ca_cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+
+            # Same extensions as easy-rsa's x509-types/client
+            cert = (
+                x509.CertificateBuilder()
+                .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, provision_identity)]))
+                .issuer_name(ca_cert.subject)
+                .public_key(key.public_key())
+                .serial_number(serial)
+                .not_valid_before(now)
+                .not_valid_after(not_after)
+                .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+                .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+                .add_extension(x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ca_ski), critical=False)
+                .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+                .add_extension(x509.KeyUsage(
+                    digital_signature=True, content_commitment=False, key_encipherment=False,
+                    data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                    crl_sign=False, encipher_only=False, decipher_only=False
+                ), critical=False)
+                .sign(ca_key, hashes.SHA256())
+            )
+            cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+
+            if key_path is None:
+                key_path = f"{self.pki_dir}/private/{provision_identity}.key"
+                written.append(key_path)
+                _write_file(key_path, key_pem, mode=0o600)
+            written.append(cert_path)
+            _write_file(cert_path, cert_pem)
+
+            serial_hex = format_serial(serial)
+            written.append(f"{self.pki_dir}/certs_by_serial/{serial_hex}.pem")
+            _write_file(written[-1], cert_pem)
+            with pki_lock(pki_dir=self.pki_dir):
+                record_issued(serial, not_after, provision_identity, self.pki_dir)
+        except BaseException:
+            for path in written:
+                if os.path.exists(path):
+                    os.remove(path)
+            # Give a claimed pool key back as if nothing happened so a retry can start over
+            if claimed_key_path is not None:
+                keypool.release(claimed_key_path)
+            raise
+        return cert_pem.decode().strip(), key_pem.decode().strip()
+
+    @PKI_OPERATION_DURATION.labels(name, 'revoke').time()
+    def revoke(self, provision_identities):
+        """Mark clients revoked in index.txt in one rewrite and move their files to revoked/,
+        like `easyrsa revoke`. Returns (revoked, missing) names. Callers must hold pki_lock().
+        """
+        wanted = set(provision_identities)
+        revoked_at = _format_index_time(datetime.datetime.utcnow())
+        index_path = f"{self.pki_dir}/index.txt"
+        with open(index_path, 'r') as f:
+            lines = f.readlines()
+
+        serials = {}
+        for i, line in enumerate(lines):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 6 or fields[0] != 'V':
+                continue
+            common_name = fields[5].rsplit('/CN=', 1)[-1]
+            if common_name in wanted:
+                fields[0] = 'R'
+                fields[2] = revoked_at
+                lines[i] = '\t'.join(fields) + '\n'
+                serials.setdefault(common_name, []).append(fields[3])
+
+        if serials:
+            _write_file(f"{index_path}.tmp", ''.join(lines).encode())
+            os.replace(f"{index_path}.tmp", index_path)
+
+        for provision_identity, serial_list in serials.items():
+            serial_hex = serial_list[-1]
+            for source, target in (
+                (f"issued/{provision_identity}.crt", f"revoked/certs_by_serial/{serial_hex}.crt"),
+                (f"private/{provision_identity}.key", f"revoked/private_by_serial/{serial_hex}.key"),
+                (f"reqs/{provision_identity}.req", f"revoked/reqs_by_serial/{serial_hex}.req"),
+            ):
+                source = f"{self.pki_dir}/{source}"
+                if os.path.exists(source):
+                    target = f"{self.pki_dir}/{target}"
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(source, target)
+
+        revoked = [name for name in provision_identities if name in serials]
+        missing = [name for name in provision_identities if name not in serials]
+        return revoked, missing
+
+    @PKI_OPERATION_DURATION.labels(name, 'gen_crl').time()
+    def gen_crl(self):
+        """Rebuild crl.pem from the revoked entries of index.txt. Callers must hold pki_lock()."""
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+
+        ca_cert, ca_key = self._load_ca()
+        now = datetime.datetime.utcnow()
+        builder = (
+            x509.CertificateRevocationListBuilder()
+            .issuer_name(ca_cert.subject)
+            .last_update(now)
+            .next_update(now + datetime.timedelta(days=Config.PKI_CRL_DAYS))
+        )
+        with open(f"{self.pki_dir}/index.txt", 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 6 or fields[0] != 'R':
+                    continue
+                builder = builder.add_revoked_certificate(
+                    x509.RevokedCertificateBuilder()
+                    .serial_number(int(fields[3], 16))
+                    .revocation_date(_parse_index_time(fields[2].split(',')[0]))
+                    .build()
+                )
+
+        crl = builder.sign(ca_key, hashes.SHA256())
+        crl_path = f"{self.pki_dir}/crl.pem"
+        _write_file(f"{crl_path}.tmp", crl.public_bytes(serialization.Encoding.PEM))
+        os.replace(f"{crl_path}.tmp", crl_path)
+        return crl_path
+
+
+def format_serial(serial):
+    """Format a serial the way openssl writes it to index.txt and certs_by_serial/."""
+    serial_hex = f"{serial:X}"
+    return serial_hex if len(serial_hex) % 2 == 0 else f"0{serial_hex}"
+
+
+def _format_index_time(moment):
+    # openssl ca uses UTCTime until 2049 and GeneralizedTime afterwards
+    if moment.year < 2050:
+        return moment.strftime("%y%m%d%H%M%SZ")
+    return moment.strftime("%Y%m%d%H%M%SZ")
+
+
+def _parse_index_time(value):
+    return datetime.datetime.strptime(value, "%y%m%d%H%M%SZ" if len(value) == 13 else "%Y%m%d%H%M%SZ")
+
+
+def _write_file(path, data, mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+
+def record_issued(serial, not_after, provision_identity, pki_dir=None):
+    """Append the certificate to index.txt and advance serial, as `openssl ca` does.
+    Callers must hold pki_lock().
+    """
+    pki_dir = pki_dir or Config.PKI_DIR
+    line = f"V\t{_format_index_time(not_after)}\t\t{format_serial(serial)}\tunknown\t/CN={provision_identity}\n"
+    with open(f"{pki_dir}/index.txt", 'a') as f:
+        f.write(line)
+    with open(f"{pki_dir}/serial", 'w') as f:
+        f.write(f"{format_serial(serial + 1)}\n")
+
+
+def set_aside(provision_identity, pki_dir=None):
+    """Move a deleted client's certificate, key and request to deleted/, so no config can be built from them.
+
+    The certificate stays valid in index.txt until the client is revoked,
+    which both backends still do after this; the files are kept for
+    recovery. Returns the paths moved.
+    """
+    pki_dir = pki_dir or Config.PKI_DIR
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    moved = []
+    with pki_lock(pki_dir=pki_dir):
+        for directory, extension in (("issued", "crt"), ("private", "key"), ("reqs", "req")):
+            source = f"{pki_dir}/{directory}/{provision_identity}.{extension}"
+            if os.path.exists(source):
+                target = f"{pki_dir}/deleted/{directory}/{provision_identity}-{stamp}.{extension}"
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(source, target)
+                moved.append(target)
+    return moved
+
+
+def set_aside_certificate(provision_identity, pki_dir=None):
+    """The most recent certificate set_aside() moved for this client, or None."""
+    pki_dir = pki_dir or Config.PKI_DIR
+    # Names are alphanumeric and stamps fixed width, so the last in order is the latest
+    paths = sorted(glob.glob(f"{pki_dir}/deleted/issued/{glob.escape(provision_identity)}-*.crt"))
+    return paths[-1] if paths else None
+
+
+BACKENDS = {
+    EasyRsaBackend.name: EasyRsaBackend,
+    CryptographyBackend.name: CryptographyBackend,
+}
+
+_backends = {}
+
+
+def get_backend(pki_dir=None):
+    """Return this process's issuance backend for a PKI (PKI_DIR by default), selected by Config.PKI_BACKEND."""
+    pki_dir = pki_dir or Config.PKI_DIR
+    key = (Config.PKI_BACKEND, pki_dir)
+    backend = _backends.get(key)
+    if backend is None:
+        if Config.PKI_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown PKI backend: {Config.PKI_BACKEND}")
+        backend = _backends.setdefault(key, BACKENDS[Config.PKI_BACKEND](pki_dir))
+    return backend
@@ -1,36 +1,28 @@
-import redis
-from config import Config
-
-class RedisClient:
-    def __init__(self):
-        self.client = redis.Redis(
-            host=Config.REDIS_HOST,
-            port=Config.REDIS_PORT,
-            db=Config.REDIS_DB,
-            password=Config.REDIS_PASSWORD,
-            decode_responses=True
-        )
-
-    def set_task_status(self, task_id, status):
-        """Set task status in Redis."""
-        self.client.set(f"task:{task_id}", status)
+"""
+The process-wide Redis connection pool.
 
-    def get_task_status(self, task_id):
-        """Get task status from Redis."""
-        return self.client.get(f"task:{task_id}")
+Every module talking to the application Redis (task status, in-flight
+registry, live client tables, traffic, revocation queue, fan-out results)
+uses `redis_client`, so a process holds at most REDIS_MAX_CONNECTIONS
+connections however many threads or greenlets share it. redis-py resets the
+pool in a forked child, so the gunicorn master can create it before forking.
 
-    def delete_task_status(self, task_id):
-        """Delete task status from Redis."""
-        self.client.delete(f"task:{task_id}")
-
-    def set_provision_secret(self, provision_identity, secret):
-        """Set provision secret in Redis."""
-        self.client.set(f"provision:{provision_identity}", secret)
+The readiness probe (health.py) and the Celery broker client (admission.py)
+keep their own connections: the first needs short timeouts, the second may
+point at another Redis.
+"""
+import redis
+from config import Config
 
-    def get_provision_secret(self, provision_identity):
-        """Get provision secret from Redis."""
-        return self.client.get(f"provision:{provision_identity}")
+pool = redis.BlockingConnectionPool(
+    host=Config.REDIS_HOST,
+    port=Config.REDIS_PORT,
+    db=Config.REDIS_DB,
+    password=Config.REDIS_PASSWORD,
+    max_connections=Config.REDIS_MAX_CONNECTIONS,
+    timeout=Config.REDIS_POOL_TIMEOUT,  # wait for a free connection instead of failing
+    health_check_interval=30,
+    decode_responses=True
+)
 
-    def delete_provision_secret(self, provision_identity):
-        """Delete provision secret from Redis."""
-        self.client.delete(f"provision:{provision_identity}") 
\ No newline at end of file
+redis_client = redis.Redis(connection_pool=pool)
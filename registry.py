@@ -0,0 +1,242 @@
+"""
+Persistent registry of provisioned clients, stored in SQLite.
+
+Keeps one row per client (name, created time, certificate serial and expiry,
+revocation, last-seen time and VPN server) so the admin dashboard can page and search
+clients with indexed queries instead of listing and stat'ing every .ovpn file.
+"""
+import os
+import sqlite3
+import datetime
+from contextlib import contextmanager
+from config import Config
+from concurrency import thread_local
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    name TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    cert_serial TEXT,
+    expires_at TEXT,
+    revoked INTEGER NOT NULL DEFAULT 0,
+    revoked_at TEXT,
+    last_seen TEXT,
+    server TEXT
+);
+CREATE INDEX IF NOT EXISTS clients_revoked_name ON clients (revoked, name);
+CREATE INDEX IF NOT EXISTS clients_last_seen ON clients (last_seen);
+"""
+
+# Columns added after the first release, with their definitions
+MIGRATIONS = (
+    ("server", "ALTER TABLE clients ADD COLUMN server TEXT"),
+)
+INDEXES = """
+CREATE INDEX IF NOT EXISTS clients_server_revoked ON clients (server, revoked);
+"""
+
+# Per OS thread: under gevent all greenlets of a worker share one connection
+_local = thread_local()
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def get_connection():
+    """Return this thread's connection, creating the database on first use."""
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        path = Config.CLIENT_REGISTRY_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path)
+        connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        migrate(connection)
+        _local.connection = connection
+        if is_new:
+            import_existing_clients()
+    return connection
+
+
+def migrate(connection):
+    """Add columns missing from a database created by an older version."""
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(clients)")}
+    for column, statement in MIGRATIONS:
+        if column not in columns:
+            connection.execute(statement)
+    connection.executescript(INDEXES)
+
+
+@contextmanager
+def transaction():
+    """Group several writes into one SQLite transaction."""
+    connection = get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def read_certificate(provision_identity, cert_pem=None, pki_dir=None):
+    """Return (serial hex, expiry) of a client's certificate, or (None, None) if unreadable."""
+    from cryptography import x509
+    from pki import format_serial
+
+    try:
+        if cert_pem is None:
+            with open(f"{pki_dir or Config.PKI_DIR}/issued/{provision_identity}.crt", 'rb') as f:
+                cert_pem = f.read()
+        elif isinstance(cert_pem, str):
+            cert_pem = cert_pem.encode()
+        cert = x509.load_pem_x509_certificate(cert_pem)
+        return format_serial(cert.serial_number), cert.not_valid_after.strftime('%Y-%m-%d %H:%M:%S')
+    except (OSError, ValueError):
+        return None, None
+
+
+def register(provision_identity, cert_pem=None, server=None, pki_dir=None):
+    """Insert or refresh a client after its certificate was issued on server."""
+    serial, expires_at = read_certificate(provision_identity, cert_pem, pki_dir)
+    get_connection().execute(
+        "INSERT INTO clients (name, created_at, cert_serial, expires_at, server) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET cert_serial = excluded.cert_serial, "
+        "expires_at = excluded.expires_at, revoked = 0, revoked_at = NULL, "
+        "server = COALESCE(excluded.server, server)",
+        (provision_identity, _now(), serial, expires_at, server)
+    )
+
+
+def mark_revoked(provision_identity):
+    get_connection().execute(
+        "UPDATE clients SET revoked = 1, revoked_at = ? WHERE name = ?",
+        (_now(), provision_identity)
+    )
+
+
+def mark_revoked_many(names):
+    revoked_at = _now()
+    with transaction() as connection:
+        connection.executemany(
+            "UPDATE clients SET revoked = 1, revoked_at = ? WHERE name = ?",
+            [(revoked_at, name) for name in names]
+        )
+
+
+def remove(provision_identity):
+    get_connection().execute("DELETE FROM clients WHERE name = ?", (provision_identity,))
+
+
+def touch(names, seen_at=None):
+    """Record that the given clients were seen connected."""
+    seen_at = seen_at or _now()
+    with transaction() as connection:
+        connection.executemany(
+            "UPDATE clients SET last_seen = ? WHERE name = ?",
+            [(seen_at, name) for name in names]
+        )
+
+
+def get(provision_identity):
+    row = get_connection().execute(
+        "SELECT * FROM clients WHERE name = ?", (provision_identity,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def server_of(provision_identity):
+    """Name of the server a client was provisioned on, or None if not recorded."""
+    row = get_connection().execute(
+        "SELECT server FROM clients WHERE name = ?", (provision_identity,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def servers_of(names, chunk_size=500):
+    """Return {name: server name} for the given clients that have a recorded server."""
+    names = list(names)
+    servers = {}
+    connection = get_connection()
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        rows = connection.execute(
+            f"SELECT name, server FROM clients WHERE server IS NOT NULL "
+            f"AND name IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall()
+        servers.update((row[0], row[1]) for row in rows)
+    return servers
+
+
+def count_by_server():
+    """Return {server name: unrevoked clients}; clients without a recorded server count under None."""
+    rows = get_connection().execute(
+        "SELECT server, COUNT(*) FROM clients WHERE revoked = 0 GROUP BY server"
+    ).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def search(query=None, after=None, limit=50, include_revoked=True):
+    """Return one page of clients ordered by name.
+
+    query is a name prefix; after is the last name of the previous page
+    (keyset pagination), so every page is an index range scan.
+    """
+    clauses = []
+    params = []
+    if query:
+        # Prefix range instead of LIKE so the primary key index is used
+        clauses.append("name >= ? AND name < ?")
+        params.extend([query, query + '\uffff'])
+    if after:
+        clauses.append("name > ?")
+        params.append(after)
+    if not include_revoked:
+        clauses.append("revoked = 0")
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = get_connection().execute(
+        f"SELECT * FROM clients {where} ORDER BY name LIMIT ?", params + [limit]
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def count(query=None):
+    if query:
+        row = get_connection().execute(
+            "SELECT COUNT(*) FROM clients WHERE name >= ? AND name < ?", (query, query + '\uffff')
+        ).fetchone()
+    else:
+        row = get_connection().execute("SELECT COUNT(*) FROM clients").fetchone()
+    return row[0]
+
+
+def import_existing_clients():
+    """Backfill the registry from the .ovpn files already in VPN_CLIENT_DIR."""
+    if not os.path.isdir(Config.VPN_CLIENT_DIR):
+        return 0
+
+    imported = 0
+    with transaction() as connection:
+        for entry in os.scandir(Config.VPN_CLIENT_DIR):
+            if not entry.name.endswith('.ovpn'):
+                continue
+            name = entry.name[:-len('.ovpn')]
+            created_at = datetime.datetime.utcfromtimestamp(entry.stat().st_ctime).strftime('%Y-%m-%d %H:%M:%S')
+            serial, expires_at = read_certificate(name)
+            connection.execute(
+                "INSERT OR IGNORE INTO clients (name, created_at, cert_serial, expires_at) VALUES (?, ?, ?, ?)",
+                (name, created_at, serial, expires_at)
+            )
+            imported += 1
+    print(f"Imported {imported} existing clients into the registry")
+    return imported
+
+
+if __name__ == '__main__':
+    import_existing_clients()
@@ -0,0 +1,111 @@
+"""
+Batched certificate revocation without restarting OpenVPN.
+
+Revocation requests are collected in a Redis set and applied together by one
+Celery task: every pending client is revoked, the CRL is rebuilt once and
+swapped into place atomically (OpenVPN re-reads its crl-verify file on each
+new TLS handshake), and only the revoked clients' sessions are killed through
+the management interface. Other connected routers are not disturbed.
+With several VPN servers, each server's clients are revoked in its own PKI
+and only that server's CRL is rebuilt.
+"""
+import os
+from config import Config
+from pki import get_backend, pki_lock
+from management import lookup_clients, send_command, ManagementError
+from redis_client import redis_client
+import registry
+import servers
+
+PENDING_KEY = "pki:revocations:pending"
+SCHEDULED_KEY = "pki:revocations:scheduled"
+RETRY_SECONDS = 30
+
+
+def enqueue(provision_identities):
+    """Add clients to the revocation queue.
+
+    Returns True if the caller should schedule a run; False if one is already
+    scheduled and will pick these clients up too.
+    """
+    redis_client.sadd(PENDING_KEY, *provision_identities)
+    return schedule()
+
+
+def schedule():
+    """Mark a run as scheduled. Returns True if the caller should schedule it, False if one already is."""
+    # Outlives the coalescing delay so a slow worker is not scheduled twice
+    ttl = int(max(Config.REVOCATION_COALESCE_SECONDS, RETRY_SECONDS) + Config.PKI_LOCK_TIMEOUT) + 60
+    return bool(redis_client.set(SCHEDULED_KEY, 1, nx=True, ex=ttl))
+
+
+def pending():
+    return sorted(redis_client.smembers(PENDING_KEY))
+
+
+def install_crl(crl_path, target=None):
+    """Copy the CRL to target (VPN_CRL_PATH by default) by rename, so OpenVPN never reads a partial file."""
+    target = target or Config.VPN_CRL_PATH
+    if os.path.abspath(target) == os.path.abspath(crl_path):
+        # OpenVPN reads the CRL straight from the PKI, which gen_crl already replaced atomically
+        return
+    tmp_path = f"{target}.tmp"
+    with open(crl_path, 'rb') as f:
+        content = f.read()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(tmp_path, 0o644)  # OpenVPN drops privileges to nobody
+    os.replace(tmp_path, target)
+
+
+def kill_sessions(provision_identities, server=None):
+    """Disconnect the given clients of a server if connected. Returns the names that were killed.
+
+    Without a running management monitor the sessions stay up until their next
+    renegotiation, when the new CRL rejects them.
+    """
+    killed = []
+    for common_name in lookup_clients(provision_identities):
+        try:
+            send_command(f"kill {common_name}", server=server)
+            killed.append(common_name)
+        except ManagementError as e:
+            print(f"Failed to kill session of {common_name}: {str(e)}")
+    return killed
+
+
+def apply_pending():
+    """Revoke every queued client with a single CRL rebuild per server and drop their sessions.
+
+    Each server's clients leave the queue only once its CRL is installed, so
+    if a server fails the exception propagates with its clients still pending
+    (see tasks.process_revocations, which schedules a retry).
+    """
+    # Requests arriving from here on schedule another run instead of being lost
+    redis_client.delete(SCHEDULED_KEY)
+    names = pending()
+    if not names:
+        return {"revoked": [], "missing": [], "killed": []}
+
+    revoked = []
+    missing = []
+    killed = []
+    for server, server_names in servers.group_by_server(names).items():
+        backend = get_backend(server.pki_dir)
+        with pki_lock(pki_dir=server.pki_dir):
+            server_revoked, server_missing = backend.revoke(server_names)
+            registry.mark_revoked_many(server_revoked)
+            # Also when nothing was newly revoked: a retry must still install the CRL a failed run built
+            crl_path = backend.gen_crl()
+        install_crl(crl_path, server.crl_path)
+        # Done for this server: a retry after a later server fails must not repeat it
+        redis_client.srem(PENDING_KEY, *server_names)
+        revoked.extend(server_revoked)
+        missing.extend(server_missing)
+        # Every requested client, so sessions of clients revoked by a failed run are dropped too
+        killed.extend(kill_sessions(server_names, server))
+    print(f"Revoked {len(revoked)} clients ({len(missing)} unknown), killed {len(killed)} sessions")
+    return {"revoked": revoked, "missing": missing, "killed": killed}
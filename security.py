@@ -23,18 +23,24 @@ def require_secret(f):
     """Decorator to require a valid secret for a route."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        secret = request.args.get('secret')
-        provision_identity = request.args.get('provision_identity')
-        
+        # Accept credentials from the query string or from the URL path, never both differing
+        path_secret = kwargs.pop('secret', None)
+        path_identity = kwargs.pop('provision_identity', None)
+        query_secret = request.args.get('secret')
+        query_identity = request.args.get('provision_identity')
+        if (path_secret and query_secret and path_secret != query_secret) or \
+                (path_identity and query_identity and path_identity != query_identity):
+            return jsonify({"error": "Conflicting secret or provision identity"}), 400
+        secret = query_secret or path_secret
+        provision_identity = query_identity or path_identity
+
         if not secret or not provision_identity:
             return jsonify({"error": "Missing secret or provision identity"}), 401
             
         expected_secret = generate_secret(provision_identity)
-        print('secret',expected_secret)    
 
         if not hmac.compare_digest(secret, expected_secret):
             return jsonify({"error": "Invalid secret"}), 401
-        print('gccgchgcg')    
         return f(provision_identity=provision_identity, secret=secret, *args, **kwargs)
 
     return decorated_function 
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+Inventory of the OpenVPN servers clients are placed on.
+
+A single OpenVPN process caps the fleet, so clients can be spread over several
+instances, each with its own remote address, PKI, status file, CRL and
+management endpoint. The inventory is a JSON list in VPN_SERVERS_FILE, e.g.
+
+    [{"name": "edge1", "remote_host": "203.0.113.10", "remote_port": 1194,
+      "pki_dir": "/etc/openvpn/edge1/pki", "status_file": "/var/log/openvpn/edge1-status.log",
+      "management_host": "127.0.0.1", "management_port": 7505, "capacity": 5000}, ...]
+
+Without one, the single server described by the VPN_*/PKI_DIR settings is
+used under the name "default", exactly as before.
+
+New clients are placed by Placement and their server is recorded in the
+client registry; config downloads, IP lookups and revocation resolve against
+that server. Clients registered before the inventory existed belong to
+VPN_DEFAULT_SERVER (the first server if unset).
+"""
+import os
+import json
+import time
+import threading
+from config import Config
+import registry
+
+DEFAULT_SERVER = "default"
+
+
+class NoServerAvailable(Exception):
+    """Raised when every server in the inventory is at capacity."""
+
+
+class VpnServer:
+    """One OpenVPN instance and the paths and endpoints that belong to it."""
+
+    def __init__(self, name, remote_host, pki_dir, status_file, remote_port=1194, client_dir=None,
+                 crl_path=None, management_host='127.0.0.1', management_port=7505,
+                 management_password=None, client_common_path=None, capacity=None):
+        self.name = name
+        self.remote_host = remote_host
+        self.remote_port = int(remote_port)
+        self.pki_dir = pki_dir
+        self.status_file = status_file
+        self.client_dir = client_dir or os.path.join(Config.VPN_CLIENT_DIR, name)
+        self.crl_path = crl_path or f"{pki_dir}/crl.pem"
+        self.management_host = management_host
+        self.management_port = int(management_port)
+        self.management_password = management_password
+        self.client_common_path = client_common_path
+        self.capacity = int(capacity or Config.VPN_SERVER_CAPACITY)
+        self._status_log = None
+
+    def key(self, base):
+        """Redis key of this server's copy of a per-server structure (client table, command queue).
+        The default server keeps the plain names used before there was an inventory.
+        """
+        return base if self.name == DEFAULT_SERVER else f"{base}{{{self.name}}}"
+
+    @property
+    def status_log(self):
+        if self._status_log is None:
+            from status_log import StatusLog
+            self._status_log = StatusLog(self.status_file)
+        return self._status_log
+
+    def has_certificate(self, provision_identity):
+        return os.path.exists(f"{self.pki_dir}/issued/{provision_identity}.crt")
+
+    def __repr__(self):
+        return f"VpnServer({self.name!r})"
+
+
+def _server_from_config():
+    from status_log import status_log
+
+    server = VpnServer(
+        DEFAULT_SERVER,
+        Config.VPN_REMOTE_HOST,
+        Config.PKI_DIR,
+        Config.VPN_STATUS_FILE,
+        remote_port=Config.VPN_PORT,
+        client_dir=Config.VPN_CLIENT_DIR,
+        crl_path=Config.VPN_CRL_PATH,
+        management_host=Config.VPN_MANAGEMENT_HOST,
+        management_port=Config.VPN_MANAGEMENT_PORT,
+        management_password=Config.VPN_MANAGEMENT_PASSWORD,
+        client_common_path=Config.VPN_CLIENT_COMMON_PATH,
+    )
+    # Share the process-wide status file index instead of keeping a second copy
+    server._status_log = status_log
+    return server
+
+
+def load_inventory(path):
+    """Read the server inventory file. Raises ValueError if it is malformed."""
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path} must contain a non-empty list of servers")
+
+    servers = {}
+    for entry in entries:
+        name = entry.get('name') if isinstance(entry, dict) else None
+        if not isinstance(name, str) or not name.replace('-', '').replace('_', '').isalnum():
+            raise ValueError(f"Invalid server name in {path}: {name!r}")
+        if name in servers:
+            raise ValueError(f"Duplicate server {name} in {path}")
+        try:
+            servers[name] = VpnServer(**entry)
+        except TypeError as e:
+            raise ValueError(f"Invalid entry for server {name} in {path}: {str(e)}")
+    return servers
+
+
+_inventory_lock = threading.Lock()
+_inventory = None
+
+
+def inventory():
+    """Return the mapping of server name -> VpnServer, loaded on first use."""
+    global _inventory
+    if _inventory is None:
+        with _inventory_lock:
+            if _inventory is None:
+                if Config.VPN_SERVERS_FILE:
+                    _inventory = load_inventory(Config.VPN_SERVERS_FILE)
+                else:
+                    _inventory = {DEFAULT_SERVER: _server_from_config()}
+    return _inventory
+
+
+def all_servers():
+    return list(inventory().values())
+
+
+def get_server(name):
+    """Return the server with the given name. Raises KeyError if it is not in the inventory."""
+    servers = inventory()
+    if name not in servers:
+        raise KeyError(f"Unknown VPN server: {name}")
+    return servers[name]
+
+
+def default_server():
+    """Server that owns clients without a recorded server."""
+    servers = inventory()
+    if Config.VPN_DEFAULT_SERVER:
+        return get_server(Config.VPN_DEFAULT_SERVER)
+    return next(iter(servers.values()))
+
+
+def locate(provision_identity):
+    """Return the server a client was provisioned on.
+
+    Uses the registry, then looks for the certificate on each server (for a
+    client that is being issued right now), then falls back to the default.
+    """
+    servers = inventory()
+    if len(servers) == 1:
+        return next(iter(servers.values()))
+
+    name = registry.server_of(provision_identity)
+    if name in servers:
+        return servers[name]
+    for server in servers.values():
+        if server.has_certificate(provision_identity):
+            return server
+    return default_server()
+
+
+def group_by_server(provision_identities):
+    """Split client names by the server they were provisioned on: {VpnServer: [names]}."""
+    servers = inventory()
+    if len(servers) == 1:
+        return {next(iter(servers.values())): list(provision_identities)} if provision_identities else {}
+
+    from pki import set_aside_certificate
+
+    recorded = registry.servers_of(provision_identities)
+    default = default_server()
+    groups = {}
+    for provision_identity in provision_identities:
+        server = servers.get(recorded.get(provision_identity))
+        if server is None:
+            # Deleted clients have left the registry; their certificate is set aside in their PKI
+            server = next((candidate for candidate in servers.values()
+                           if set_aside_certificate(provision_identity, candidate.pki_dir)), default)
+        groups.setdefault(server, []).append(provision_identity)
+    return groups
+
+
+class Placement:
+    """Chooses the server for each new client.
+
+    VPN_PLACEMENT selects the load measure: 'assigned' (provisioned, unrevoked
+    clients) or 'connected' (clients connected right now). Either is taken
+    relative to the server's capacity, and a server holding `capacity`
+    assigned clients receives no more. Loads are read at most every
+    VPN_PLACEMENT_REFRESH seconds and placements in between are counted
+    locally, so a burst of provisions is spread instead of piling onto the
+    server that was emptiest at the last refresh.
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loads = {}
+        self._refreshed_at = None
+
+    def loads(self):
+        """Return {server name: {"assigned": n, "connected": n}} for every server."""
+        from management import count_connected
+
+        assigned = registry.count_by_server()
+        loads = {}
+        for server in all_servers():
+            server_assigned = assigned.get(server.name, 0)
+            if server is default_server():
+                server_assigned += assigned.get(None, 0)
+            loads[server.name] = {"assigned": server_assigned, "connected": count_connected(server)}
+        return loads
+
+    def choose(self):
+        """Return the least loaded server with room. Raises NoServerAvailable if all are full."""
+        servers = all_servers()
+        if len(servers) == 1:
+            return servers[0]
+
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshed_at is None or now - self._refreshed_at >= self.refresh_interval:
+                self._loads = self.loads()
+                self._refreshed_at = now
+
+            measure = 'connected' if Config.VPN_PLACEMENT == 'connected' else 'assigned'
+            candidates = [server for server in servers
+                          if self._loads[server.name]['assigned'] < server.capacity]
+            if not candidates:
+                raise NoServerAvailable("All VPN servers are at capacity")
+
+            chosen = min(candidates, key=lambda server: self._loads[server.name][measure] / server.capacity)
+            self._loads[chosen.name]['assigned'] += 1
+            self._loads[chosen.name]['connected'] += 1
+            return chosen
+
+    def release(self, server):
+        """Take back a placement counted by choose() that did not produce a client."""
+        with self._lock:
+            load = self._loads.get(server.name)
+            if load is not None:
+                load['assigned'] = max(0, load['assigned'] - 1)
+                load['connected'] = max(0, load['connected'] - 1)
+
+
+placement = Placement(Config.VPN_PLACEMENT_REFRESH)
+
+
+def choose_server():
+    return placement.choose()
+
+
+def release_server(server):
+    placement.release(server)
+
+
+def status():
+    """Per-server capacity and load for monitoring."""
+    loads = placement.loads()
+    return [{
+        "name": server.name,
+        "remote_host": server.remote_host,
+        "remote_port": server.remote_port,
+        "capacity": server.capacity,
+        **loads[server.name]
+    } for server in all_servers()]
@@ -49,6 +49,9 @@ sudo ./easyrsa build-ca nopass
 sudo ./easyrsa gen-dh
 sudo ./easyrsa build-server-full server nopass
 sudo ./easyrsa build-client-full client1 nopass
+sudo ./easyrsa gen-crl
+sudo cp pki/crl.pem /etc/openvpn/crl.pem
+sudo chmod 644 /etc/openvpn/crl.pem
 
 # Step 4: Create server configuration
 echo "Step 4: Creating server configuration..."
@@ -63,6 +66,7 @@ ca /etc/openvpn/easy-rsa/pki/ca.crt
 cert /etc/openvpn/easy-rsa/pki/issued/server.crt
 key /etc/openvpn/easy-rsa/pki/private/server.key
 dh /etc/openvpn/easy-rsa/pki/dh.pem
+crl-verify /etc/openvpn/crl.pem
 server 10.8.0.0 255.255.255.0
 ifconfig-pool-persist /var/log/openvpn/ipp.txt
 push "dhcp-option DNS 8.8.8.8"
@@ -75,6 +79,11 @@ group nogroup
 persist-key
 persist-tun
 status /var/log/openvpn/openvpn-status.log
+# Management interface followed by `python management.py`
+management 127.0.0.1 7505
+# Uncomment (and set VPN_MANAGEMENT_CLIENT_AUTH=true) for real-time connect/disconnect events;
+# every client then waits for the monitor's approval, otherwise it polls `status 3`
+# management-client-auth
 verb 3
 explicit-exit-notify 1
 CONF_EOF
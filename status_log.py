@@ -0,0 +1,199 @@
+import os
+import threading
+from config import Config
+from metrics import STATUS_PARSE_DURATION
+from concurrency import run_blocking
+
+# Column names used by OpenVPN in the v1 (section based) status format
+V1_CLIENT_COLUMNS = ["Common Name", "Real Address", "Bytes Received", "Bytes Sent", "Connected Since"]
+V1_ROUTING_COLUMNS = ["Virtual Address", "Common Name", "Real Address", "Last Ref"]
+
+
+def _strip_port(address):
+    """Strip the source port from an OpenVPN real address (1.2.3.4:51234 -> 1.2.3.4)."""
+    if not address:
+        return address
+    if address.startswith('[') and ']' in address:
+        return address[1:address.index(']')]
+    if address.count(':') == 1:
+        return address.split(':')[0]
+    return address
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+@STATUS_PARSE_DURATION.time()
+def parse_status(content):
+    """Parse an OpenVPN status file in v1, v2 or v3 format.
+
+    Returns a tuple (clients, routes) where clients maps common name to a session
+    dict and routes maps each virtual address to its common name.
+    """
+    clients = {}
+    routes = {}
+    headers = {
+        "CLIENT_LIST": V1_CLIENT_COLUMNS,
+        "ROUTING_TABLE": V1_ROUTING_COLUMNS,
+    }
+    v1_section = None
+
+    def add_client(row):
+        common_name = row.get("Common Name")
+        if not common_name:
+            return
+        connected_since = row.get("Connected Since", "")
+        clients[common_name] = {
+            'common_name': common_name,
+            'real_ip': _strip_port(row.get("Real Address", "")),
+            'vpn_ip': row.get("Virtual Address") or None,
+            'bytes_received': _to_int(row.get("Bytes Received")),
+            'bytes_sent': _to_int(row.get("Bytes Sent")),
+            'connected_since': connected_since,
+            'connected_since_epoch': _to_int(row.get("Connected Since (time_t)")),
+            'last_seen': connected_since,
+            'client_id': row.get("Client ID"),
+        }
+
+    def add_route(row):
+        virtual_address = row.get("Virtual Address")
+        common_name = row.get("Common Name")
+        if not virtual_address or not common_name:
+            return
+        # Skip iroute subnets, only host addresses identify a client
+        if '/' not in virtual_address:
+            routes[virtual_address] = common_name
+        session = clients.get(common_name)
+        if session is not None:
+            if not session['vpn_ip'] and '/' not in virtual_address:
+                session['vpn_ip'] = virtual_address
+            if row.get("Last Ref"):
+                session['last_seen'] = row["Last Ref"]
+
+    for raw_line in content.splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+
+        # v1 format: plain section titles followed by a column header line
+        if line == "OpenVPN CLIENT LIST":
+            v1_section = "CLIENT_LIST"
+            continue
+        if line == "ROUTING TABLE":
+            v1_section = "ROUTING_TABLE"
+            continue
+        if line in ("GLOBAL STATS", "END"):
+            v1_section = None
+            continue
+
+        # v2 uses commas, v3 uses tabs
+        parts = line.split('\t') if '\t' in line else line.split(',')
+        kind = parts[0]
+
+        if kind in ("TITLE", "TIME", "Updated", "GLOBAL_STATS"):
+            continue
+
+        if kind == "HEADER" and len(parts) > 2:
+            headers[parts[1]] = parts[2:]
+            continue
+
+        if kind in ("CLIENT_LIST", "ROUTING_TABLE"):
+            row = dict(zip(headers[kind], parts[1:]))
+            if kind == "CLIENT_LIST":
+                add_client(row)
+            else:
+                add_route(row)
+            continue
+
+        if v1_section is not None:
+            columns = headers[v1_section]
+            if parts[0] == columns[0]:
+                # Column header line of a v1 section
+                headers[v1_section] = parts
+                continue
+            row = dict(zip(columns, parts))
+            if v1_section == "CLIENT_LIST":
+                add_client(row)
+            else:
+                add_route(row)
+
+    # v1 lists clients before routes, v2/v3 may not carry Virtual Address on
+    # older servers: make sure every routed client has its IP filled in.
+    for virtual_address, common_name in routes.items():
+        session = clients.get(common_name)
+        if session is not None and not session['vpn_ip']:
+            session['vpn_ip'] = virtual_address
+
+    return clients, routes
+
+
+class StatusLog:
+    """Indexed view of the OpenVPN status file, re-parsed only when it changes.
+
+    All lookups are O(1) dictionary hits; the file is stat'ed on access and
+    parsed again only if its mtime or size differs from the last parse.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._clients = {}
+        self._routes = {}
+
+    def refresh(self):
+        """Re-parse the status file if it changed. Raises FileNotFoundError if missing."""
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return False
+
+        with self._lock:
+            if signature == self._signature:
+                return False
+            with open(self.path, 'r') as f:
+                content = f.read()
+            clients, routes = run_blocking(parse_status, content)
+            # Swap references so concurrent readers always see a complete index
+            self._clients, self._routes = clients, routes
+            self._signature = signature
+        return True
+
+    def clients(self):
+        """Return the mapping of common name -> session for all connected clients."""
+        self.refresh()
+        return self._clients
+
+    def get(self, common_name):
+        """Return the session for a common name, or None if not connected."""
+        self.refresh()
+        return self._clients.get(common_name)
+
+    def common_name_for(self, virtual_address):
+        """Return the common name that owns a virtual address, or None."""
+        self.refresh()
+        return self._routes.get(virtual_address)
+
+    def is_connected(self, common_name):
+        return self.get(common_name) is not None
+
+    def __len__(self):
+        self.refresh()
+        return len(self._clients)
+
+
+# Shared instance used by every lookup in this process
+status_log = StatusLog(Config.VPN_STATUS_FILE)
+
+
+def get_connected_clients():
+    """Return connected clients, or an empty mapping if the status file is unavailable."""
+    try:
+        return status_log.clients()
+    except Exception as e:
+        print(f"Error reading VPN status: {e}")
+        return {}
@@ -0,0 +1,186 @@
+"""
+Task status lookups driven by the Celery result backend.
+
+Celery's Redis backend stores each state change under `celery-task-meta-<id>`
+and PUBLISHes the same payload on a channel of that name, so waiting for a
+task is a pub/sub subscription instead of repeated polling. All waiters of a
+process share a single pattern subscription.
+"""
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+import redis
+from redis_client import redis_client
+
+TASK_META_KEY = "celery-task-meta-{}"
+TERMINAL_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+SUBSCRIBE_WAIT = 2
+RECHECK_INTERVAL = 5
+MGET_CHUNK_SIZE = 500
+
+
+def read_task_meta(task_id):
+    """Return the stored task meta, or a PENDING placeholder if nothing is stored yet."""
+    raw = redis_client.get(TASK_META_KEY.format(task_id))
+    return json.loads(raw) if raw else {"status": "PENDING", "task_id": task_id}
+
+
+def read_task_metas(task_ids):
+    """Return {task_id: meta} for many tasks in one round trip of pipelined MGETs."""
+    task_ids = list(dict.fromkeys(task_ids))
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(0, len(task_ids), MGET_CHUNK_SIZE):
+        pipe.mget([TASK_META_KEY.format(task_id) for task_id in task_ids[i:i + MGET_CHUNK_SIZE]])
+    raws = [raw for chunk in pipe.execute() for raw in chunk]
+    return {task_id: json.loads(raw) if raw else {"status": "PENDING", "task_id": task_id}
+            for task_id, raw in zip(task_ids, raws)}
+
+
+class TaskWatcher:
+    """One pattern subscription per worker process, fanning task state changes out to waiters.
+
+    Each waiting request costs a queue instead of a Redis connection, so a
+    gevent worker can hold thousands of long-polls and event streams open.
+    The listener thread starts on first use, i.e. after the worker has forked.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._ready = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name="task-watcher", daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        prefix = TASK_META_KEY.format("")
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                pubsub.psubscribe(TASK_META_KEY.format("*"))
+                for message in pubsub.listen():
+                    if message["type"] == "psubscribe":
+                        self._ready.set()
+                        continue
+                    if message["type"] != "pmessage":
+                        continue
+                    with self._lock:
+                        waiters = list(self._waiters.get(message["channel"][len(prefix):], ()))
+                    for waiter in waiters:
+                        waiter.put(message["data"])
+            except redis.RedisError as e:
+                print(f"Task watcher lost its subscription: {str(e)}")
+            finally:
+                self._ready.clear()
+                pubsub.close()
+            time.sleep(1)
+
+    @contextmanager
+    def watch(self, task_id):
+        """Yield a queue receiving the raw meta of every state change of the task."""
+        self._start()
+        updates = queue.Queue()
+        with self._lock:
+            self._waiters.setdefault(task_id, set()).add(updates)
+        try:
+            self._ready.wait(SUBSCRIBE_WAIT)
+            yield updates
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(task_id)
+                waiters.discard(updates)
+                if not waiters:
+                    del self._waiters[task_id]
+
+
+task_watcher = TaskWatcher(redis_client)
+
+
+def iter_task_states(task_id, timeout, heartbeat=None):
+    """Yield the task meta now and on every state change until it finishes or timeout expires.
+
+    With heartbeat set, yields None after that many idle seconds so callers
+    can keep a stream alive.
+    """
+    with task_watcher.watch(task_id) as updates:
+        # Read after subscribing so a completion in between is never missed
+        meta = read_task_meta(task_id)
+        yield meta
+
+        deadline = time.monotonic() + timeout
+        last_yield = time.monotonic()
+        while meta["status"] not in TERMINAL_STATES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                meta = json.loads(updates.get(timeout=min(remaining, heartbeat or RECHECK_INTERVAL,
+                                                          RECHECK_INTERVAL)))
+            except queue.Empty:
+                # Covers messages published while the watcher was reconnecting
+                latest = read_task_meta(task_id)
+                if latest["status"] != meta["status"]:
+                    meta = latest
+                elif heartbeat and time.monotonic() - last_yield >= heartbeat:
+                    last_yield = time.monotonic()
+                    yield None
+                    continue
+                else:
+                    continue
+            last_yield = time.monotonic()
+            yield meta
+
+
+def wait_for_task(task_id, timeout):
+    """Block until the task finishes or timeout expires and return the latest meta."""
+    meta = None
+    for meta in iter_task_states(task_id, timeout):
+        pass
+    return meta
+
+
+def task_status_payload(task_id, meta):
+    """Build the (payload, http status) returned by the task status endpoints."""
+    state = meta["status"]
+    result = meta.get("result")
+
+    if state == "SUCCESS":
+        if isinstance(result, dict) and result.get("status") == "success":
+            return {
+                "status": "success",
+                "message": "Certificate generated successfully",
+                "provision_identity": result.get("provision_identity"),
+                "task_id": task_id,
+                "state": "completed"
+            }, 200
+        result = result if isinstance(result, dict) else {}
+        return {
+            "status": "error",
+            "message": result.get("message", "Unknown error"),
+            "provision_identity": result.get("provision_identity"),
+            "task_id": task_id,
+            "state": "failed"
+        }, 400
+
+    if state in TERMINAL_STATES:
+        message = result.get("exc_message") if isinstance(result, dict) else None
+        return {
+            "status": "error",
+            "message": str(message) if message else "Unknown error",
+            "task_id": task_id,
+            "state": "failed"
+        }, 400
+
+    return {
+        "status": "pending",
+        "message": "Certificate generation in progress",
+        "task_id": task_id,
+        "state": state
+    }, 202
@@ -1,34 +1,44 @@
 #tasks.py
 
 import os
+import json
+import math
+import time
 import subprocess
 from celery import Celery
+from celery.signals import (
+    task_postrun, task_prerun, before_task_publish, worker_init, worker_process_shutdown
+)
+from celery.result import GroupResult
 from config import Config
+import celery_config
 from helper import generate_openvpn_config
+import keypool
+import inflight
+import pki
+import registry
+import history
+import traffic
+import servers
+import admission
+import revocation
+from management import live_table, LiveTableUnavailable
+import metrics
+from main import fanout
 
-# Initialize Celery with both broker and backend
-celery = Celery('tasks', 
-                broker=Config.CELERY_BROKER_URL,
-                backend=Config.CELERY_RESULT_BACKEND)
-
-# Configure Celery (optional - move these settings from your other file if needed)
-celery.conf.update(
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
-    timezone='UTC',
-    enable_utc=True,
-    task_track_started=True,
-    task_time_limit=300,  # 5 minutes
-    worker_max_tasks_per_child=1,  # Restart worker after each task
-    broker_connection_retry_on_startup=True,
-    broker_connection_retry=True,
-    broker_connection_max_retries=10
-)
+# The one Celery app; queues, routing and beat schedule are in celery_config.py
+celery = Celery('tasks')
+celery.config_from_object(celery_config)
 
-@celery.task
-def generate_certificate(provision_identity):
-    """Generate OpenVPN client certificate and configuration."""
+
+def issue_client(provision_identity, pooled_only=False):
+    """Generate OpenVPN client certificate and configuration.
+
+    The client is placed on the least loaded VPN server with room. Uses a key
+    from the pre-generated pool when one is available, so only signing and
+    config rendering remain. With pooled_only=True returns None instead of
+    falling back to full key generation when the pool is empty.
+    """
     try:
         # Ensure the client name is valid
         if not provision_identity.isalnum():
@@ -37,27 +47,32 @@ def generate_certificate(provision_identity):
                 "message": "Invalid client name. Use only alphanumeric characters.",
                 "provision_identity": provision_identity
             }
-        
-        # Path to the EasyRSA script on the host system
-        easyrsa_path = "/etc/openvpn/easy-rsa/easyrsa"
-        
-        # Generate the client certificate and key
-        subprocess.run([
-            easyrsa_path, 
-            "--pki-dir=/etc/openvpn/easy-rsa/pki",
-            "build-client-full", 
-            provision_identity, 
-            "nopass"
-        ], check=True)
-        
-        # Generate the client configuration file
-        output_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
-        if generate_openvpn_config(provision_identity, output_path):
+
+        server = servers.choose_server()
+        key_path = keypool.claim(provision_identity, server.pki_dir)
+        if key_path is None and pooled_only:
+            # The caller queues the identity, which places it again
+            servers.release_server(server)
+            return None
+
+        cert_pem, key_pem = pki.get_backend(server.pki_dir).issue(provision_identity, key_path)
+        if key_path is not None and keypool.depth() < Config.KEY_POOL_LOW_WATERMARK:
+            refill_key_pool.delay()
+
+        # Generate the client configuration file (rendered on request in 'render' mode)
+        output_path = f"{server.client_dir}/{provision_identity}.ovpn"
+        if Config.OVPN_DELIVERY != 'file' or generate_openvpn_config(
+                provision_identity, output_path, cert_pem, key_pem, server=server):
+            try:
+                registry.register(provision_identity, cert_pem, server.name, server.pki_dir)
+            except Exception as e:
+                print(f"Failed to register {provision_identity} in client registry: {str(e)}")
 
             return {
                 "status": "success",
                 "message": "Certificate generated successfully",
-                "provision_identity": provision_identity
+                "provision_identity": provision_identity,
+                "server": server.name
             }
         else:
             return {
@@ -65,6 +80,12 @@ def generate_certificate(provision_identity):
                 "message": "Failed to generate client configuration",
                 "provision_identity": provision_identity
             }
+    except servers.NoServerAvailable as e:
+        return {
+            "status": "error",
+            "message": str(e),
+            "provision_identity": provision_identity
+        }
     except subprocess.CalledProcessError as e:
         return {
             "status": "error",
@@ -77,3 +98,206 @@ def generate_certificate(provision_identity):
             "message": f"Failed to generate certificate: {str(e)}",
             "provision_identity": provision_identity
         }
+
+
+@celery.task
+def generate_certificate(provision_identity):
+    """Generate OpenVPN client certificate and configuration."""
+    try:
+        return issue_client(provision_identity)
+    finally:
+        # Once the client exists (or issuance failed) retries need no in-flight answer
+        inflight.release(provision_identity)
+        # Here rather than in task_postrun, which never fires for the items of a batch chunk
+        record_provisioning_throughput(provision_identity)
+
+
+def record_provisioning_throughput(provision_identity=None):
+    """Feed admission control's backlog and throughput measurement with one issued identity.
+    provision_identity: the queued identity to take off the backlog, None for inline provisioning
+    """
+    try:
+        admission.record_completion(provision_identity)
+    except Exception as e:
+        print(f"Failed to record provisioning throughput: {str(e)}")
+
+
+_task_started = {}
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    """Record when a task was queued so workers can measure its queue wait."""
+    if headers is not None:
+        headers.setdefault('published_at', time.time())
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.monotonic()
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at:
+        metrics.TASK_QUEUE_WAIT.labels(task.name).observe(max(0, time.time() - published_at))
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.monotonic() - started)
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """Expose the worker processes' metrics on CELERY_METRICS_PORT."""
+    if Config.CELERY_METRICS_PORT:
+        metrics.reset_multiprocess_dir()
+        metrics.start_exporter(Config.CELERY_METRICS_PORT)
+
+
+@worker_process_shutdown.connect
+def forget_worker_process(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+@celery.task
+def refill_key_pool():
+    """Refill the pre-generated key pool up to its high watermark."""
+    return keypool.refill()
+
+
+@celery.task
+def snapshot_session_history():
+    """Record connects/disconnects of servers without a management monitor from their status files."""
+    recorded = {}
+    for server in servers.all_servers():
+        try:
+            live_table(server).count()
+            # The monitor records this server's events as they happen
+            continue
+        except LiveTableUnavailable:
+            pass
+        try:
+            clients = server.status_log.clients()
+        except FileNotFoundError:
+            continue
+        recorded[server.name] = history.reconcile(server.name, clients)
+    return recorded
+
+
+@celery.task
+def sample_traffic():
+    """Sample byte counters of servers without a management monitor from their status files."""
+    sampled = {}
+    for server in servers.all_servers():
+        try:
+            live_table(server).count()
+            continue
+        except LiveTableUnavailable:
+            pass
+        try:
+            clients = server.status_log.clients()
+            # OpenVPN rewrites the file every `status` interval: sample it as of that time
+            sampled[server.name] = traffic.record(clients, at=os.path.getmtime(server.status_file))
+        except FileNotFoundError:
+            continue
+    return sampled
+
+
+@celery.task
+def compact_session_history():
+    """Downsample old connection history and drop what is past retention."""
+    return history.compact()
+
+
+@celery.task(bind=True, time_limit=3600)
+def run_router_command(self, names, command, concurrency=None, timeout=None):
+    """Run a RouterOS command on many routers; per-router results are stored as NDJSON lines."""
+    return fanout.store(self.request.id, names, command, concurrency, timeout)
+
+
+@celery.task
+def process_revocations():
+    """Apply all queued revocations with one CRL rebuild."""
+    try:
+        return revocation.apply_pending()
+    except Exception:
+        # The failed clients are still pending; retry unless a new request already scheduled a run
+        if revocation.schedule():
+            process_revocations.apply_async(countdown=revocation.RETRY_SECONDS)
+        raise
+
+
+def revoke_clients(provision_identities):
+    """Queue clients for revocation; requests within REVOCATION_COALESCE_SECONDS share one run."""
+    if revocation.enqueue(provision_identities):
+        process_revocations.apply_async(countdown=Config.REVOCATION_COALESCE_SECONDS)
+
+
+BATCH_KEY = "provision-batch-{}"
+
+
+def dispatch_batch(provision_identities, batch_id=None):
+    """Queue certificate generation for many identities as one Celery group.
+
+    Identities are split into at most PROVISION_BATCH_PARALLELISM chunks, each
+    processed sequentially by a single worker, so one large batch never
+    occupies more than that many worker slots. Returns the batch id, which
+    is batch_id when given.
+    """
+    chunk_size = max(1, math.ceil(len(provision_identities) / Config.PROVISION_BATCH_PARALLELISM))
+    chunks = [provision_identities[i:i + chunk_size]
+              for i in range(0, len(provision_identities), chunk_size)]
+
+    job = generate_certificate.chunks(((identity,) for identity in provision_identities), chunk_size).group()
+    admission.add_pending(*provision_identities)
+    try:
+        # Below single provisioning requests, which must not queue behind a large batch
+        result = job.apply_async(task_id=batch_id, queue=celery_config.PROVISIONING,
+                                 priority=celery_config.BATCH_PRIORITY)
+    except Exception:
+        admission.release_pending(*provision_identities)
+        raise
+    result.save()
+
+    celery.backend.set(BATCH_KEY.format(result.id), json.dumps({"chunks": chunks}))
+    return result.id
+
+
+def get_batch_status(batch_id):
+    """Return per-identity progress of a batch, or None if the batch is unknown."""
+    manifest = celery.backend.get(BATCH_KEY.format(batch_id))
+    result = GroupResult.restore(batch_id, app=celery)
+    if manifest is None or result is None:
+        return None
+
+    chunks = json.loads(manifest)["chunks"]
+    results = {}
+    for chunk, chunk_result in zip(chunks, result.results):
+        if not chunk_result.ready():
+            for identity in chunk:
+                results[identity] = {"state": "pending"}
+            continue
+
+        if chunk_result.failed():
+            for identity in chunk:
+                results[identity] = {"state": "failed", "message": str(chunk_result.result)}
+            continue
+
+        for identity, outcome in zip(chunk, chunk_result.result):
+            if outcome.get('status') == 'success':
+                results[identity] = {"state": "completed"}
+            else:
+                results[identity] = {"state": "failed", "message": outcome.get('message', 'Unknown error')}
+
+    states = [r["state"] for r in results.values()]
+    return {
+        "batch_id": batch_id,
+        "state": "processing" if "pending" in states else "completed",
+        "total": len(states),
+        "completed": states.count("completed"),
+        "failed": states.count("failed"),
+        "pending": states.count("pending"),
+        "results": results,
+    }
+
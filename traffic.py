@@ -0,0 +1,163 @@
+"""
+Per-client bandwidth accounting from the OpenVPN byte counters.
+
+Every TRAFFIC_SAMPLE_INTERVAL the connected-client table of each server is
+sampled (by the management monitor, or by a beat task from the status file)
+and each client's counters are appended to a fixed-size ring buffer in Redis
+(a list trimmed to cover the longest window that expires once the client is
+gone), so memory stays bounded however long it runs.
+
+The counters OpenVPN reports restart from zero with every session, so the
+ring stores running totals: a reconnect (new connect time, or counters lower
+than last time) adds the new session's bytes instead of subtracting. Rates
+over each of TRAFFIC_WINDOWS are computed when a sample is taken and kept in
+one sorted set per window and direction, so "top N talkers" is a single
+ZREVRANGE instead of a scan over every client.
+
+rx is traffic received by the VPN server from the router, tx what it sent to
+the router.
+"""
+import time
+from config import Config
+from redis_client import redis_client
+
+SERIES_KEY = "traffic:series:{}"
+TOP_KEY = "traffic:top:{}:{}"
+UPDATED_KEY = "traffic:updated"
+DIRECTIONS = ("total", "rx", "tx")
+
+
+def windows():
+    return [int(window) for window in Config.TRAFFIC_WINDOWS.split(',')]
+
+
+def ring_size():
+    """Entries needed to cover the longest window, plus one for its start."""
+    return max(windows()) // Config.TRAFFIC_SAMPLE_INTERVAL + 2
+
+
+def _encode(at, total_rx, total_tx, raw_rx, raw_tx, since):
+    return f"{at}:{total_rx}:{total_tx}:{raw_rx}:{raw_tx}:{since}"
+
+
+def _decode(entry):
+    at, total_rx, total_tx, raw_rx, raw_tx, since = (int(value) for value in entry.split(':'))
+    return {"at": at, "total_rx": total_rx, "total_tx": total_tx,
+            "raw_rx": raw_rx, "raw_tx": raw_tx, "since": since}
+
+
+def _rates(newer, older):
+    """Bytes per second of each direction between two ring entries."""
+    elapsed = newer['at'] - older['at']
+    if elapsed <= 0:
+        return None
+    rx = (newer['total_rx'] - older['total_rx']) / elapsed
+    tx = (newer['total_tx'] - older['total_tx']) / elapsed
+    return {"rx": rx, "tx": tx, "total": rx + tx}
+
+
+def record(clients, at=None):
+    """Append a sample of a server's connected clients and update the top-N sets.
+
+    clients maps common name to session (status file or management format).
+    Clients already sampled at or after `at` are skipped, so re-reading an
+    unchanged status file never produces a zero-rate sample. Returns the
+    number of clients sampled.
+    """
+    at = int(at or time.time())
+    names = list(clients)
+    if not names:
+        return 0
+
+    size = ring_size()
+    window_indexes = {window: max(1, round(window / Config.TRAFFIC_SAMPLE_INTERVAL)) for window in windows()}
+
+    # One round trip for every client's last entry and its window starts
+    pipe = redis_client.pipeline(transaction=False)
+    for common_name in names:
+        key = SERIES_KEY.format(common_name)
+        pipe.lindex(key, 0)
+        for index in window_indexes.values():
+            pipe.lindex(key, index - 1)
+        pipe.lindex(key, -1)
+    stored = pipe.execute()
+
+    per_client = len(window_indexes) + 2
+    pipe = redis_client.pipeline(transaction=False)
+    sampled = 0
+    for i, common_name in enumerate(names):
+        last, *window_starts, oldest = stored[i * per_client:(i + 1) * per_client]
+        last = _decode(last) if last else None
+        if last is not None and last['at'] >= at:
+            continue
+
+        session = clients[common_name]
+        raw_rx = int(session.get('bytes_received') or 0)
+        raw_tx = int(session.get('bytes_sent') or 0)
+        since = int(session.get('connected_since_epoch') or 0)
+        if last is None:
+            total_rx, total_tx = raw_rx, raw_tx
+        elif since != last['since'] or raw_rx < last['raw_rx'] or raw_tx < last['raw_tx']:
+            # A new session: its counters started from zero
+            total_rx, total_tx = last['total_rx'] + raw_rx, last['total_tx'] + raw_tx
+        else:
+            total_rx = last['total_rx'] + raw_rx - last['raw_rx']
+            total_tx = last['total_tx'] + raw_tx - last['raw_tx']
+        entry = {"at": at, "total_rx": total_rx, "total_tx": total_tx}
+
+        key = SERIES_KEY.format(common_name)
+        pipe.lpush(key, _encode(at, total_rx, total_tx, raw_rx, raw_tx, since))
+        pipe.ltrim(key, 0, size - 1)
+        pipe.expire(key, max(windows()) + Config.TRAFFIC_SAMPLE_INTERVAL * 2)
+
+        # The new entry pushes the others one place down, so the window start is index - 1 today
+        for window, start in zip(window_indexes, window_starts):
+            start = start or oldest
+            rates = _rates(entry, _decode(start)) if start else None
+            for direction in DIRECTIONS:
+                pipe.zadd(TOP_KEY.format(window, direction), {common_name: rates[direction] if rates else 0})
+        pipe.zadd(UPDATED_KEY, {common_name: at})
+        sampled += 1
+    pipe.execute()
+    prune(at)
+    return sampled
+
+
+def prune(now=None):
+    """Drop clients that have not been sampled for a few intervals from the top-N sets."""
+    now = int(now or time.time())
+    stale = redis_client.zrangebyscore(UPDATED_KEY, 0, now - Config.TRAFFIC_SAMPLE_INTERVAL * 3)
+    if not stale:
+        return 0
+    pipe = redis_client.pipeline(transaction=False)
+    for window in windows():
+        for direction in DIRECTIONS:
+            pipe.zrem(TOP_KEY.format(window, direction), *stale)
+    pipe.zrem(UPDATED_KEY, *stale)
+    pipe.execute()
+    return len(stale)
+
+
+def top(window=300, n=20, direction="total"):
+    """The n clients with the highest throughput over window seconds, in bytes per second."""
+    if window not in windows():
+        raise ValueError(f"window must be one of {Config.TRAFFIC_WINDOWS}")
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}")
+    ranked = redis_client.zrevrange(TOP_KEY.format(window, direction), 0, n - 1, withscores=True)
+    return [{"client": common_name, "bytes_per_second": round(rate, 1)} for common_name, rate in ranked]
+
+
+def series(common_name, window=None):
+    """Rate samples of one client, oldest first: [{"at", "rx", "tx", "total"}] in bytes per second."""
+    entries = [_decode(entry) for entry in redis_client.lrange(SERIES_KEY.format(common_name), 0, -1)]
+    if window:
+        cutoff = time.time() - window
+        entries = [entry for entry in entries if entry['at'] >= cutoff]
+    samples = []
+    for newer, older in zip(entries, entries[1:]):
+        rates = _rates(newer, older)
+        if rates is not None:
+            samples.append({"at": newer['at'], **{direction: round(rate, 1) for direction, rate in rates.items()}})
+    samples.reverse()
+    return samples